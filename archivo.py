@@ -0,0 +1,245 @@
+import time
+import logging
+import datetime
+from array import array
+
+import pytz
+
+# --- Archivo mensual de gastos antiguos ---
+#
+# Los gastos anteriores al horizonte se pliegan en un documento por
+# usuario y mes (usuarios/{id}/archivo/{AAAA-MM}) con columnas empaquetadas:
+# montos y fechas como int64, la categoría como índice uint16 sobre la lista
+# `categorias` y la descripción como índice uint32 sobre `descripciones`,
+# ambas del propio documento. Los pocos gastos en otra moneda llevan su
+# moneda y monto original en `extranjeros` ({i: fila, mo, mor}). Los
+# originales se borran por lotes.
+#
+# El proceso es reanudable e idempotente: el documento se escribe con
+# `borrando=True` en la misma operación que incorpora los gastos y solo se
+# baja al terminar el borrado. Mientras esté puesto, quien lee ignora los
+# originales de ese mes (ya están en el archivo), y la siguiente pasada
+# retoma el mes: los originales que coinciden con una fila archivada se
+# borran y los que no (llegados después) se incorporan primero. El avance
+# entre usuarios se guarda en sistema/compactacion.
+
+ZONA = pytz.timezone("America/Bogota")
+
+log = logging.getLogger("gastos.archivo")
+TAM_LOTE = 500
+# Un documento de Firestore admite 1 MiB; cada fila ocupa 22 bytes más sus
+# descripciones distintas y, si es en otra moneda, su entrada en `extranjeros`
+MAX_BYTES_MES = 1_000_000
+BYTES_EXTRANJERO = 40
+
+
+def inicio_de_mes(fecha):
+    fecha = fecha.astimezone(ZONA)
+    return ZONA.localize(datetime.datetime(fecha.year, fecha.month, 1))
+
+
+def mes_siguiente(inicio):
+    siguiente = (inicio.replace(tzinfo=None) + datetime.timedelta(days=32)).replace(day=1)
+    return ZONA.localize(siguiente)
+
+
+def desempaquetar(data):
+    montos = array("q", data.get("montos", b""))
+    fechas = array("q", data.get("fechas", b""))
+    indices = array("H", data.get("categorias_idx", b""))
+    categorias = data.get("categorias", [])
+    # Los meses archivados antes de guardar descripciones no las tienen
+    descripciones = data.get("descripciones") or [""]
+    desc_idx = array("I", data.get("descripciones_idx", b""))
+    if len(desc_idx) < len(montos):
+        if "" not in descripciones:
+            descripciones.append("")
+        desc_idx.extend([descripciones.index("")] * (len(montos) - len(desc_idx)))
+    extranjeros = {e["i"]: (e["mo"], e["mor"]) for e in data.get("extranjeros", [])}
+    return montos, fechas, indices, categorias, desc_idx, descripciones, extranjeros
+
+
+def _agregar(lista, valor):
+    lista.append(valor)
+    return len(lista) - 1
+
+
+def ya_archivado(fecha, en_curso):
+    # True si el original es de un mes cuyo archivo todavía se está borrando
+    return isinstance(fecha, datetime.datetime) and any(inicio <= fecha < fin for inicio, fin in en_curso)
+
+
+def leer_archivados(db, user_id, desde=None, hasta=None, en_curso=None):
+    # en_curso: si se pasa una lista, recibe (inicio, fin) de los meses con
+    # borrando=True para que quien lee después los originales los salte
+    consulta = db.collection("usuarios").document(user_id).collection("archivo")
+    if desde is not None:
+        consulta = consulta.where("inicio", ">=", inicio_de_mes(desde))
+    if hasta is not None:
+        consulta = consulta.where("inicio", "<", hasta)
+
+    limite_desde = desde.timestamp() if desde is not None else None
+    limite_hasta = hasta.timestamp() if hasta is not None else None
+    for doc in consulta.stream():
+        data = doc.to_dict()
+        if en_curso is not None and data.get("borrando"):
+            en_curso.append((data["inicio"], data["fin"]))
+        montos, fechas, indices, categorias, desc_idx, descripciones, extranjeros = desempaquetar(data)
+        for i, (monto, epoch, indice, desc) in enumerate(zip(montos, fechas, indices, desc_idx)):
+            if limite_desde is not None and epoch < limite_desde:
+                continue
+            if limite_hasta is not None and epoch >= limite_hasta:
+                continue
+            gasto = {
+                "monto": monto,
+                "categoria": categorias[indice],
+                "descripcion": descripciones[desc],
+                "fecha": datetime.datetime.fromtimestamp(epoch, tz=ZONA),
+            }
+            if i in extranjeros:
+                gasto["moneda"], gasto["monto_original"] = extranjeros[i]
+            yield gasto
+
+
+# --- Compactación ---
+
+def _clave_fila(monto, epoch, categoria, descripcion):
+    return int(monto), int(epoch), categoria, descripcion or ""
+
+
+def _clave_doc(d):
+    return _clave_fila(d.get("monto", 0), d["fecha"].timestamp(), d.get("categoria", "otros"), d.get("descripcion"))
+
+
+def _tamano(montos, categorias, descripciones, extranjeros):
+    texto = sum(len(c.encode()) + 1 for c in categorias) + sum(len(d.encode()) + 1 for d in descripciones)
+    return len(montos) * 22 + texto + len(extranjeros) * BYTES_EXTRANJERO
+
+
+def _archivar_mes(db, user_ref, inicio, docs):
+    archivo_ref = user_ref.collection("archivo").document(inicio.strftime("%Y-%m"))
+    snap = archivo_ref.get()
+    existente = snap.to_dict() if snap.exists else None
+    montos, fechas, indices, categorias, desc_idx, descripciones, extranjeros = desempaquetar(existente or {})
+
+    coincidentes, nuevos = [], list(docs)
+    if existente is not None and existente.get("borrando"):
+        # Pasada interrumpida: lo que ya tiene fila en el archivo solo falta borrarlo
+        filas = {}
+        for monto, epoch, indice, desc in zip(montos, fechas, indices, desc_idx):
+            clave = _clave_fila(monto, epoch, categorias[indice], descripciones[desc])
+            filas[clave] = filas.get(clave, 0) + 1
+        coincidentes, nuevos = [], []
+        for doc in docs:
+            clave = _clave_doc(doc.to_dict())
+            if filas.get(clave):
+                filas[clave] -= 1
+                coincidentes.append(doc)
+            else:
+                nuevos.append(doc)
+
+    if nuevos:
+        posiciones = {cat: i for i, cat in enumerate(categorias)}
+        pos_desc = {d: i for i, d in enumerate(descripciones)}
+        agregados = (montos[:], fechas[:], indices[:], categorias[:], desc_idx[:], descripciones[:], dict(extranjeros))
+        for doc in nuevos:
+            d = doc.to_dict()
+            categoria = d.get("categoria", "otros")
+            if categoria not in posiciones:
+                posiciones[categoria] = _agregar(categorias, categoria)
+            descripcion = d.get("descripcion") or ""
+            if descripcion not in pos_desc:
+                pos_desc[descripcion] = _agregar(descripciones, descripcion)
+            if d.get("moneda"):
+                extranjeros[len(montos)] = (d["moneda"], d.get("monto_original"))
+            montos.append(int(d.get("monto", 0)))
+            fechas.append(int(d["fecha"].timestamp()))
+            indices.append(posiciones[categoria])
+            desc_idx.append(pos_desc[descripcion])
+
+        if _tamano(montos, categorias, descripciones, extranjeros) > MAX_BYTES_MES:
+            # Los que no caben se quedan como originales; el archivo sigue como estaba
+            log.warning("mes demasiado grande para archivar", extra={"mes": f"{inicio:%Y-%m}", "user_id": user_ref.id})
+            montos, fechas, indices, categorias, desc_idx, descripciones, extranjeros = agregados
+            nuevos = []
+        else:
+            archivo_ref.set({
+                "inicio": inicio,
+                "fin": mes_siguiente(inicio),
+                "montos": montos.tobytes(),
+                "fechas": fechas.tobytes(),
+                "categorias_idx": indices.tobytes(),
+                "categorias": categorias,
+                "descripciones_idx": desc_idx.tobytes(),
+                "descripciones": descripciones,
+                "extranjeros": [{"i": i, "mo": mo, "mor": mor} for i, (mo, mor) in sorted(extranjeros.items())],
+                "cantidad": len(montos),
+                "borrando": True,
+            })
+
+    borrar = coincidentes + nuevos
+    for i in range(0, len(borrar), TAM_LOTE):
+        lote = db.batch()
+        for doc in borrar[i:i + TAM_LOTE]:
+            lote.delete(doc.reference)
+        lote.commit()
+
+    if nuevos or (existente or {}).get("borrando"):
+        archivo_ref.update({"borrando": False})
+    return len(borrar)
+
+
+def compactar_usuario(db, user_id, corte):
+    user_ref = db.collection("usuarios").document(user_id)
+
+    # Primero los meses que quedaron a medio borrar (aunque el corte haya cambiado)
+    archivados = 0
+    for snap in user_ref.collection("archivo").where("borrando", "==", True).stream():
+        data = snap.to_dict()
+        restantes = list(
+            user_ref.collection("gastos").where("fecha", ">=", data["inicio"]).where("fecha", "<", data["fin"]).stream()
+        )
+        archivados += _archivar_mes(db, user_ref, inicio_de_mes(data["inicio"]), restantes)
+
+    antiguos = user_ref.collection("gastos").where("fecha", "<", corte).order_by("fecha").stream()
+    mes_actual, pendientes = None, []
+    for doc in antiguos:
+        fecha = doc.to_dict().get("fecha")
+        if not isinstance(fecha, datetime.datetime):
+            continue  # fechas guardadas como texto: se dejan como están
+        mes = inicio_de_mes(fecha)
+        if mes != mes_actual and pendientes:
+            archivados += _archivar_mes(db, user_ref, mes_actual, pendientes)
+            pendientes = []
+        mes_actual = mes
+        pendientes.append(doc)
+    if pendientes:
+        archivados += _archivar_mes(db, user_ref, mes_actual, pendientes)
+    return archivados
+
+
+def compactar(db, meses_horizonte, segundos_max=600):
+    ahora = datetime.datetime.now(ZONA)
+    corte = inicio_de_mes(ahora)
+    for _ in range(meses_horizonte):
+        corte = inicio_de_mes(corte - datetime.timedelta(days=1))
+
+    progreso_ref = db.collection("sistema").document("compactacion")
+    progreso = progreso_ref.get()
+    ultimo_usuario = progreso.to_dict().get("ultimo_usuario") if progreso.exists else None
+
+    consulta = db.collection("usuarios").order_by("__name__")
+    if ultimo_usuario:
+        consulta = consulta.start_after({"__name__": db.collection("usuarios").document(ultimo_usuario)})
+
+    inicio = time.monotonic()
+    total = 0
+    for usuario in consulta.select([]).stream():
+        total += compactar_usuario(db, usuario.id, corte)
+        progreso_ref.set({"ultimo_usuario": usuario.id, "corte": corte}, merge=True)
+        if time.monotonic() - inicio > segundos_max:
+            log.info("compactación pausada; continúa en la próxima ejecución", extra={"user_id": usuario.id})
+            return total
+
+    progreso_ref.set({"ultimo_usuario": None, "corte": corte, "completado": ahora}, merge=True)
+    return total
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+from google.cloud import firestore
+
+# --- Índice descripción → categoría por usuario ---
+#
+# Un solo documento por usuario (usuarios/{id}/indices/descripciones) con
+# {frecuencias: {descripcion: {categoria: veces}}}, mantenido con
+# incrementos en la misma escritura del gasto. Se lee una vez por usuario y
+# luego se actualiza en memoria.
+#
+# La lectura (leer) no toca la memoria y puede correr en otro hilo; cargar
+# guarda el resultado desde el event loop. `contadores` lleva consultas,
+# lecturas a Firestore y sugerencias para medir cuántas se ahorra la memoria.
+
+MIN_VECES = 2
+MIN_PROPORCION = 0.8
+MAX_USUARIOS = 5000
+
+
+def normalizar(descripcion):
+    return " ".join(descripcion.lower().split())
+
+
+class IndiceDescripciones:
+    def __init__(self, db):
+        self.db = db
+        self._usuarios = OrderedDict()
+        self.contadores = {"consultas": 0, "lecturas": 0, "sugeridas": 0}
+
+    def __len__(self):
+        return len(self._usuarios)
+
+    def ref(self, user_id):
+        return self.db.collection("usuarios").document(user_id).collection("indices").document("descripciones")
+
+    def cargado(self, user_id):
+        return user_id in self._usuarios
+
+    def leer(self, user_id):
+        doc = self.ref(user_id).get()
+        return (doc.to_dict() or {}).get("frecuencias", {}) if doc.exists else {}
+
+    def cargar(self, user_id, datos):
+        # Si otra carga se adelantó, gana la que ya está (tiene los incrementos posteriores)
+        self.contadores["lecturas"] += 1
+        if user_id not in self._usuarios:
+            self._usuarios[user_id] = datos
+            if len(self._usuarios) > MAX_USUARIOS:
+                self._usuarios.popitem(last=False)
+        return self._usuarios[user_id]
+
+    def frecuencias(self, user_id):
+        if user_id in self._usuarios:
+            self._usuarios.move_to_end(user_id)
+            return self._usuarios[user_id]
+        return self.cargar(user_id, self.leer(user_id))
+
+    def olvidar(self, user_id):
+        # Descarta la copia en memoria; la próxima lectura la trae de Firestore
+        self._usuarios.pop(user_id, None)
+
+    def sugerir(self, user_id, descripcion):
+        self.contadores["consultas"] += 1
+        conteo = self.frecuencias(user_id).get(normalizar(descripcion))
+        if not conteo:
+            return None
+        categoria, veces = max(conteo.items(), key=lambda item: item[1])
+        if veces >= MIN_VECES and veces / sum(conteo.values()) >= MIN_PROPORCION:
+            self.contadores["sugeridas"] += 1
+            return categoria
+        return None
+
+    def estadisticas(self):
+        consultas = self.contadores["consultas"]
+        return {
+            **self.contadores,
+            "usuarios": len(self._usuarios),
+            "aciertos_memoria": round(1 - self.contadores["lecturas"] / consultas, 3) if consultas else None,
+        }
+
+    def registrar(self, lote, user_id, descripcion, categoria, delta=1):
+        self.registrar_varios(lote, user_id, {(descripcion, categoria): delta})
+
+    def registrar_varios(self, lote, user_id, deltas):
+        # Agrega los incrementos {(descripcion, categoria): delta} al lote de
+        # escritura de los gastos, en una sola escritura del índice, y refleja
+        # el cambio en memoria si el usuario ya estaba cargado
+        sumados = {}
+        for (descripcion, categoria), delta in deltas.items():
+            clave = (normalizar(descripcion), categoria)
+            sumados[clave] = sumados.get(clave, 0) + delta
+        frecuencias = {}
+        for (clave, categoria), delta in sumados.items():
+            frecuencias.setdefault(clave, {})[categoria] = firestore.Increment(delta)
+        lote.set(self.ref(user_id), {"frecuencias": frecuencias}, merge=True)
+        if user_id in self._usuarios:
+            for (clave, categoria), delta in sumados.items():
+                conteo = self._usuarios[user_id].setdefault(clave, {})
+                conteo[categoria] = conteo.get(categoria, 0) + delta
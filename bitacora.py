@@ -0,0 +1,337 @@
+import json
+import time
+import sqlite3
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as gexc
+
+from registro import log
+from resiliencia import AlmacenNoDisponible
+
+# --- Bitácora local de gastos (write-ahead) ---
+#
+# Con BITACORA_ARCHIVO, un gasto nuevo se confirma al usuario en cuanto queda
+# escrito en una base SQLite local (modo WAL, synchronous=FULL: cada commit
+# hace fsync), no cuando Firestore responde. Las escrituras que llegan
+# mientras se hace un fsync se juntan en el siguiente commit, así que el
+# costo por gasto baja con la carga.
+#
+# Un volcador en segundo plano lleva los pendientes a Firestore en lotes de
+# hasta `lote_max`, en orden de llegada. El id del documento se decide al
+# anotar y el lote usa create(): si un lote ya se había aplicado (un plazo
+# vencido que sí llegó, un reinicio a mitad de camino) Firestore lo rechaza
+# entero con AlreadyExists en vez de sumar dos veces los índices, y entonces
+# se reintenta gasto por gasto para descartar los que ya estaban. Lo que no
+# llegó sigue en el archivo y se vuelca al reiniciar el bot.
+#
+# `anotar` espera el disco a lo sumo `plazo` segundos; si vence (un fsync
+# trabado) devuelve False y el bot escribe el gasto directo con create(), así
+# que si la fila llega igual al archivo, el segundo en llegar a Firestore
+# falla con AlreadyExists en vez de duplicarlo.
+#
+# `preparar(lote, gastos)` agrega al lote el gasto y sus índices;
+# `al_volcar(gastos)` y `al_fallar(gastos)` ajustan lo que hay en memoria
+# cuando el lote se aplicó o no. gastos = [(user_id, gasto_id, gasto)].
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS pendientes (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    gasto TEXT NOT NULL,
+    creado REAL NOT NULL,
+    intentos INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS rechazados (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    gasto TEXT NOT NULL,
+    creado REAL NOT NULL,
+    error TEXT
+);
+"""
+
+
+def serializar(gasto):
+    return json.dumps({**gasto, "fecha": gasto["fecha"].isoformat()}, ensure_ascii=False)
+
+
+def deserializar(texto):
+    gasto = json.loads(texto)
+    gasto["fecha"] = datetime.datetime.fromisoformat(gasto["fecha"])
+    return gasto
+
+
+class Bitacora:
+    def __init__(self, ruta, db, resiliencia, preparar, al_volcar=None, al_fallar=None, lote_max=100,
+                 espera_max=30.0, plazo=5.0):
+        self.ruta = ruta
+        self.db = db
+        self.resiliencia = resiliencia
+        self.preparar = preparar
+        self.al_volcar = al_volcar
+        self.al_fallar = al_fallar
+        self.lote_max = lote_max
+        self.espera_max = espera_max
+        self.plazo = plazo
+        # Un solo hilo usa la conexión: commits en orden y sin bloquear el event loop
+        self._hilo = ThreadPoolExecutor(1, thread_name_prefix="bitacora")
+        self._conexion = self._hilo.submit(self._abrir).result()
+        self._ids = set(self._hilo.submit(self._ids_pendientes).result())
+        self._cola = []            # (fila, futuro) esperando el próximo commit
+        self._esperas = {}         # gasto_id -> futuro de quien espera que llegue a Firestore
+        self._hay_cola = None
+        self._hay_pendientes = None
+        self._tareas = []
+        self._mas_antiguo = None
+        self.contadores = {
+            "anotados": 0, "commits": 0, "volcados": 0, "lotes": 0,
+            "ya_aplicados": 0, "rechazados": 0, "fallos": 0, "sin_anotar": 0,
+        }
+        if self._ids:
+            log.warning("bitácora con gastos sin volcar", extra={"pendientes": len(self._ids), "archivo": ruta})
+
+    # --- SQLite (solo en el hilo de la bitácora) ---
+
+    def _abrir(self):
+        conexion = sqlite3.connect(self.ruta, isolation_level=None, check_same_thread=False)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=FULL")
+        conexion.executescript(ESQUEMA)
+        return conexion
+
+    def _ids_pendientes(self):
+        return [fila[0] for fila in self._conexion.execute("SELECT id FROM pendientes")]
+
+    def _insertar(self, filas):
+        with self._conexion:
+            self._conexion.execute("BEGIN")
+            self._conexion.executemany(
+                "INSERT OR IGNORE INTO pendientes (id, user_id, gasto, creado) VALUES (?, ?, ?, ?)", filas
+            )
+
+    def _leer(self, limite):
+        return self._conexion.execute(
+            "SELECT id, user_id, gasto, creado FROM pendientes ORDER BY rowid LIMIT ?", (limite,)
+        ).fetchall()
+
+    def _borrar(self, ids):
+        with self._conexion:
+            self._conexion.execute("BEGIN")
+            self._conexion.executemany("DELETE FROM pendientes WHERE id = ?", [(i,) for i in ids])
+
+    def _sumar_intento(self, ids):
+        with self._conexion:
+            self._conexion.execute("BEGIN")
+            self._conexion.executemany("UPDATE pendientes SET intentos = intentos + 1 WHERE id = ?", [(i,) for i in ids])
+
+    def _rechazar(self, fila, error):
+        with self._conexion:
+            self._conexion.execute("BEGIN")
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO rechazados (id, user_id, gasto, creado, error) VALUES (?, ?, ?, ?, ?)",
+                (*fila, error)
+            )
+            self._conexion.execute("DELETE FROM pendientes WHERE id = ?", (fila[0],))
+
+    async def _en_hilo(self, funcion, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._hilo, funcion, *args)
+
+    # --- Ciclo de vida ---
+
+    def iniciar(self):
+        if self._tareas:
+            return
+        self._hay_cola = asyncio.Event()
+        self._hay_pendientes = asyncio.Event()
+        if self._ids:
+            self._hay_pendientes.set()
+        self._tareas = [
+            asyncio.create_task(self._escritor(), name="bitacora-escritor"),
+            asyncio.create_task(self._volcador(), name="bitacora-volcador"),
+        ]
+
+    async def cerrar(self):
+        # Lo ya anotado queda en el archivo y se vuelca al próximo arranque
+        # wait_for (en resiliencia) puede tragarse una cancelación que llega
+        # justo cuando su resultado está listo: se cancela hasta que terminen
+        pendientes = self._tareas
+        while pendientes:
+            for tarea in pendientes:
+                tarea.cancel()
+            _, pendientes = await asyncio.wait(pendientes, timeout=0.1)
+        self._tareas = []
+        if self._cola:
+            grupo, self._cola = self._cola, []
+            try:
+                await self._en_hilo(self._insertar, [fila for fila, _ in grupo])
+            except Exception as e:
+                self._resolver(grupo, e)
+            else:
+                self._resolver(grupo)
+        await self._en_hilo(self._conexion.close)
+        self._hilo.shutdown(wait=True)
+
+    # --- Anotar (lo que espera el usuario) ---
+
+    async def anotar(self, user_id, gasto_id, gasto):
+        # True cuando el gasto ya está en disco; False si no se pudo y hay que escribirlo directo
+        self.iniciar()
+        futuro = asyncio.get_running_loop().create_future()
+        entrada = ((gasto_id, user_id, serializar(gasto), time.time()), futuro)
+        self._cola.append(entrada)
+        self._hay_cola.set()
+        try:
+            # wait_for cancela el futuro al vencer: el escritor ya no lo resuelve
+            await asyncio.wait_for(futuro, self.plazo)
+        except asyncio.TimeoutError:
+            self._cola = [e for e in self._cola if e is not entrada]
+            self.contadores["sin_anotar"] += 1
+            log.error("la bitácora no respondió a tiempo", extra={"gasto_id": gasto_id, "plazo_s": self.plazo})
+            return False
+        except Exception as e:
+            self.contadores["sin_anotar"] += 1
+            log.error("no se pudo anotar el gasto en la bitácora", extra={"error": repr(e)})
+            return False
+        return True
+
+    async def _escritor(self):
+        while True:
+            await self._hay_cola.wait()
+            self._hay_cola.clear()
+            grupo, self._cola = self._cola, []
+            if not grupo:
+                continue
+            try:
+                await self._en_hilo(self._insertar, [fila for fila, _ in grupo])
+            except asyncio.CancelledError:
+                # cerrar(): el grupo vuelve a la cola y se escribe ahí (INSERT OR IGNORE)
+                self._cola = grupo + self._cola
+                raise
+            except Exception as e:
+                # Un error que no sea de SQLite tampoco puede dejar esperando a nadie ni parar el escritor
+                log.error("no se pudo escribir en la bitácora", extra={"error": repr(e), "gastos": len(grupo)})
+                self._resolver(grupo, e)
+                continue
+            self.contadores["commits"] += 1
+            self.contadores["anotados"] += len(grupo)
+            self._ids.update(fila[0] for fila, _ in grupo)
+            self._resolver(grupo)
+            self._hay_pendientes.set()
+
+    @staticmethod
+    def _resolver(grupo, error=None):
+        for _, futuro in grupo:
+            if futuro.done():
+                continue
+            if error is None:
+                futuro.set_result(None)
+            else:
+                futuro.set_exception(error)
+
+    # --- Volcado a Firestore ---
+
+    async def _volcador(self):
+        fallos = 0
+        while True:
+            await self._hay_pendientes.wait()
+            self._hay_pendientes.clear()
+            while True:
+                filas = await self._en_hilo(self._leer, self.lote_max)
+                if not filas:
+                    self._mas_antiguo = None
+                    break
+                self._mas_antiguo = filas[0][3]
+                try:
+                    volcado = await self._volcar(filas)
+                except Exception:
+                    log.exception("error volcando la bitácora")
+                    volcado = False
+                if volcado:
+                    fallos = 0
+                    continue
+                fallos += 1
+                await asyncio.sleep(min(self.espera_max, 0.5 * 2 ** fallos))
+
+    async def _volcar(self, filas):
+        gastos = [(user_id, gasto_id, deserializar(texto)) for gasto_id, user_id, texto, _ in filas]
+        lote = self.db.batch()
+        try:
+            self.preparar(lote, gastos)
+            # Reintentar es seguro: create() no deja aplicar dos veces el mismo lote
+            await self.resiliencia.llamar("volcar_bitacora", lote.commit)
+        except gexc.AlreadyExists:
+            self._fallo(gastos)
+            if len(filas) > 1:
+                for fila in filas:
+                    if not await self._volcar([fila]):
+                        return False
+                return True
+            self.contadores["ya_aplicados"] += 1
+        except AlmacenNoDisponible as e:
+            self._fallo(gastos)
+            self.contadores["fallos"] += 1
+            await self._en_hilo(self._sumar_intento, [fila[0] for fila in filas])
+            log.warning("bitácora sin volcar", extra={"error": str(e), "pendientes": len(self._ids)})
+            return False
+        except gexc.GoogleAPICallError as e:
+            # Datos que Firestore no acepta: un gasto malo no debe frenar a los demás
+            self._fallo(gastos)
+            if len(filas) > 1:
+                for fila in filas:
+                    if not await self._volcar([fila]):
+                        return False
+                return True
+            log.error("gasto rechazado por el almacén", extra={"gasto_id": filas[0][0], "error": repr(e)})
+            await self._en_hilo(self._rechazar, filas[0][:4], repr(e))
+            self.contadores["rechazados"] += 1
+            self._terminar([filas[0][0]])
+            return True
+        except Exception:
+            self._fallo(gastos)
+            raise
+        else:
+            self.contadores["lotes"] += 1
+            self.contadores["volcados"] += len(filas)
+
+        ids = [fila[0] for fila in filas]
+        await self._en_hilo(self._borrar, ids)
+        self._terminar(ids)
+        if self.al_volcar is not None:
+            self.al_volcar(gastos)
+        return True
+
+    def _fallo(self, gastos):
+        # preparar() ya reflejó los índices en memoria; no llegaron (o ya estaban)
+        if self.al_fallar is not None:
+            self.al_fallar(gastos)
+
+    def _terminar(self, ids):
+        for gasto_id in ids:
+            self._ids.discard(gasto_id)
+            futuro = self._esperas.pop(gasto_id, None)
+            if futuro is not None and not futuro.done():
+                futuro.set_result(None)
+
+    # --- Consultas ---
+
+    async def esperar(self, gasto_id, plazo):
+        # True cuando el gasto ya salió de la bitácora (o nunca estuvo)
+        if gasto_id not in self._ids:
+            return True
+        futuro = self._esperas.get(gasto_id)
+        if futuro is None:
+            futuro = self._esperas[gasto_id] = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), plazo)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def estado(self):
+        return {
+            **self.contadores,
+            "pendientes": len(self._ids),
+            "antiguedad_s": round(time.time() - self._mas_antiguo, 1) if self._mas_antiguo else 0,
+        }
@@ -4,31 +4,73 @@ import os
 import asyncio
 import pytz
 import datetime
-import matplotlib.pyplot as plt
 from io import BytesIO
 from dateutil import parser 
 import re
+import tempfile
+import zlib
+import calendar
+import secrets
+import json
+import contextvars
 
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton, 
-    ReplyKeyboardMarkup, KeyboardButton
-)
-from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, filters, ContextTypes, 
-    ChatMemberHandler, ConversationHandler
+    ReplyKeyboardMarkup, KeyboardButton,
+    InlineQueryResultArticle, InputTextMessageContent
 )
+from telegram.ext import ApplicationBuilder, ContextTypes, ConversationHandler, TypeHandler
 
+from google.api_core import exceptions as gexc
 from google.cloud import firestore
 
+from cache_gastos import CacheGastos, a_epoch
+from resiliencia import Resiliencia, AlmacenNoDisponible, CIRCUITO_ABIERTO
+from ciclo_estado import CicloDeVida, rss_mb
+from perfilador import Perfilador, ProcesadorPerfilado
+from limitador import Limitador
+from despachador import Despachador
+from bitacora import Bitacora
+from conexiones import Canales
+import registro
+from registro import log
+import respuestas
+from coherencia import CoherenciaTiempoReal
+from exportar import exportar_usuario, FORMATOS
+from archivo import leer_archivados, ya_archivado, compactar
+from graficos import renderizar
+from autocategoria import IndiceDescripciones
+from indice_diario import IndiceDiario
+from pronostico import pronosticar
+from busqueda import tokenizar, buscar_pagina
+from historial import pagina_historial, eliminar_gastos
+from grupos import (
+    registrar_gasto_grupo, totales_mes_grupo, presupuestos_grupo,
+    guardar_presupuesto_grupo, categorias_grupo, mes_grupo, nuevo_gasto_id
+)
+from recurrentes import guardar_regla, reglas_usuario, borrar_regla, reglas_del_dia, materializar
+from divisas import TablaCambio, leer_decimal
+
 # --- Configuración ---
 load_dotenv()
+
+# Registro JSON por una cola acotada: formato y escritura fuera del event loop
+registro.configurar(
+    os.getenv("LOG_NIVEL", "INFO").upper(),
+    os.getenv("LOG_MUESTREO", ""),
+    int(os.getenv("LOG_COLA", "10000"))
+)
 import base64
 
 firebase_key_base64 = os.getenv("FIREBASE_KEY_BASE64")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Servidor de la Bot API alternativo (servidor local o el falso de carga.py)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
 
-if firebase_key_base64:
+if os.getenv("FIRESTORE_EMULATOR_HOST"):
+    # Con el emulador de Firestore no hacen falta credenciales
+    log.info("usando el emulador de Firestore", extra={"host": os.getenv("FIRESTORE_EMULATOR_HOST")})
+elif firebase_key_base64:
     with open("firebase_key.json", "wb") as f:
         f.write(base64.b64decode(firebase_key_base64))
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "firebase_key.json"
@@ -42,12 +84,233 @@ ESCOGER_CATEGORIA, ESPECIFICAR_LIMITE, PREGUNTAR_ACCION_POST_PRESUPUESTO, ESPERA
 HANDLE_GASTO_CATEGORIA, HANDLE_GASTO_PERSONALIZADA = range(6, 8)
 ESPECIFICAR_LIMITE_GASTO, PREGUNTAR_ACCION_POST_PRESUPUESTO_GASTO = range(8, 10)
 
+# Una conversación sin respuesta se cierra sola; el estado de usuarios y chats
+# sin actividad se descarta en el barrido periódico
+CONVERSACION_TIMEOUT = int(os.getenv("CONVERSACION_TIMEOUT_MIN", "10")) * 60
+ESTADO_TTL = int(os.getenv("ESTADO_TTL_MIN", "60")) * 60
+ciclo_estado = CicloDeVida(ESTADO_TTL)
+
+ADMIN_IDS = {u.strip() for u in os.getenv("ADMIN_IDS", "").split(",") if u.strip()}
+
+def es_admin(user_id: str):
+    return user_id in ADMIN_IDS
+
+# Los montos se guardan en MONEDA_BASE; los gastos en otra moneda se convierten
+# con la tabla local de tasas diarias
+MONEDA_BASE = os.getenv("MONEDA_BASE", "COP").upper()
+tabla_cambio = TablaCambio(MONEDA_BASE, os.getenv("TASAS_CAMBIO_ARCHIVO", "tasas_cambio.csv"))
+
 CATEGORIAS_VALIDAS = [
     "comida", "transporte", "salud", "ocio", "educación", "hogar", "servicios"
 ]
 
 # --- Utilidades ---
 
+ZONA_POR_DEFECTO = "America/Bogota"
+MINUTOS_VENTANA_ENVIO = 60
+
+# Zona horaria de cada usuario (campo `zona_horaria` del documento de usuario)
+zonas_usuario = {}
+# Usuario del update en curso cuya zona no se pudo leer: se usa la zona por
+# defecto sin guardarla y se vuelve a intentar en su próximo update
+zona_provisional = contextvars.ContextVar("zona_provisional", default=None)
+
+def zona_usuario(user_id=None):
+    if user_id is None:
+        return pytz.timezone(ZONA_POR_DEFECTO)
+    zona = zonas_usuario.get(user_id)
+    if zona is None:
+        if zona_provisional.get() == user_id:
+            return pytz.timezone(ZONA_POR_DEFECTO)
+        doc = db.collection("usuarios").document(user_id).get()
+        zona = (doc.to_dict() or {}).get("zona_horaria") if doc.exists else None
+        zona = zona if zona in pytz.all_timezones_set else ZONA_POR_DEFECTO
+        zonas_usuario[user_id] = zona
+    return pytz.timezone(zona)
+
+async def precargar_zona(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Antes de los handlers: la primera lectura de la zona de un usuario va
+    # en el pool del almacén y no en el event loop
+    zona_provisional.set(None)
+    if update.effective_user is None:
+        return
+    user_id = str(update.effective_user.id)
+    if user_id in zonas_usuario:
+        return
+    try:
+        await resiliencia.llamar("zona", zona_usuario, user_id)
+    except AlmacenNoDisponible as e:
+        log.warning("zona no disponible, se usa la por defecto", extra={"error": str(e)})
+        zona_provisional.set(user_id)
+
+def ahora(user_id=None):
+    return datetime.datetime.now(zona_usuario(user_id))
+
+def limites_mes(user_id=None, now=None):
+    now = now or ahora(user_id)
+    # Se calcula sobre la hora local ingenua para que el cambio de mes respete
+    # el horario de verano de zonas que lo tienen
+    tz = now.tzinfo
+    local = now.replace(tzinfo=None)
+    inicio_mes = local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    inicio_mes_anterior = (inicio_mes - timedelta(days=1)).replace(day=1)
+    if hasattr(tz, "localize"):
+        return tz.localize(inicio_mes), tz.localize(inicio_mes_anterior)
+    return inicio_mes.replace(tzinfo=tz), inicio_mes_anterior.replace(tzinfo=tz)
+
+def cargar_gastos_recientes(user_id: str, desde):
+    docs = db.collection("usuarios").document(user_id).collection("gastos") \
+        .where("fecha", ">=", desde).stream()
+    for doc in docs:
+        d = doc.to_dict()
+        fecha_val = d.get("fecha")
+        if isinstance(fecha_val, str):
+            fecha_val = parser.parse(fecha_val)
+        yield doc.id, d.get("monto", 0), d.get("categoria", "otros"), fecha_val
+
+# Meses completos que se conservan como documentos individuales antes de
+# compactarlos; nunca menos de 3 para no tocar lo que usa la cache
+MESES_ARCHIVO = max(3, int(os.getenv("ARCHIVO_MESES", "12")))
+# Los meses compactados ya no tienen un documento por gasto: /buscar y
+# /historial no los recorren, /exportar sí
+AVISO_ARCHIVO = (
+    f"ℹ️ Los gastos de hace más de {MESES_ARCHIVO} meses están archivados y no aparecen aquí; "
+    "descárgalos con /exportar todo."
+)
+
+# Gastos del mes actual y del anterior de los usuarios activos, en memoria
+cache_gastos = CacheGastos(
+    cargar_gastos_recientes,
+    int(os.getenv("CACHE_GASTOS_MB", "64")) * 1024 * 1024
+)
+
+# Plazos, reintentos e interruptor de circuito para las llamadas a Firestore
+resiliencia = Resiliencia(
+    plazo=float(os.getenv("ALMACEN_PLAZO_S", "5")),
+    reintentos=int(os.getenv("ALMACEN_REINTENTOS", "3")),
+    umbral_fallos=int(os.getenv("ALMACEN_UMBRAL_FALLOS", "5")),
+    enfriamiento=float(os.getenv("ALMACEN_ENFRIAMIENTO_S", "30"))
+)
+
+# Perfilado opcional: fracción de updates muestreados y umbral de captura de lentos
+perfilador = Perfilador(
+    fraccion=float(os.getenv("PERFIL_FRACCION", "0")),
+    umbral_ms=int(os.getenv("PERFIL_LENTO_MS", "0")),
+    directorio=os.getenv("PERFIL_DIR", "capturas_lentas"),
+    max_archivos=int(os.getenv("PERFIL_MAX_ARCHIVOS", "200"))
+)
+
+async def avisar_limite(update: Update, segundos):
+    await responder(update, f"⏳ Vas muy rápido. Intenta de nuevo en {max(1, round(segundos))} s.")
+
+# Fichas por usuario para las consultas costosas y respuestas recientes reutilizables
+limitador = Limitador(
+    rafaga=int(os.getenv("CONSULTAS_RAFAGA", "5")),
+    por_minuto=float(os.getenv("CONSULTAS_POR_MINUTO", "6")),
+    ventana=float(os.getenv("CONSULTAS_VENTANA_S", "30")),
+    aviso=avisar_limite
+)
+
+# Pools de conexiones a la Bot API: respuestas a usuarios y envíos programados por separado
+canales = Canales(
+    conexiones=int(os.getenv("TELEGRAM_CONEXIONES", "32")),
+    conexiones_masivas=int(os.getenv("TELEGRAM_CONEXIONES_MASIVAS", "2")),
+    keepalive=float(os.getenv("TELEGRAM_KEEPALIVE_S", "60")),
+    masivos_por_s=float(os.getenv("TELEGRAM_MASIVOS_POR_S", "20"))
+)
+
+def aviso_respaldo(antiguedad):
+    if antiguedad is None:
+        return ""
+    return f"\n\n⚠️ Datos de hace {max(1, round(antiguedad / 60))} min: el almacén no responde en este momento."
+
+# Listeners en tiempo real sobre presupuestos y categorías (opcional)
+coherencia = None
+if os.getenv("COHERENCIA_TIEMPO_REAL") == "1":
+    coherencia = CoherenciaTiempoReal(
+        db,
+        max_listeners=int(os.getenv("COHERENCIA_MAX_LISTENERS", "500")),
+        inactividad_segundos=int(os.getenv("COHERENCIA_INACTIVIDAD_MIN", "30")) * 60
+    )
+
+def obtener_presupuestos(user_id: str):
+    if coherencia:
+        presupuestos = coherencia.presupuestos(user_id)
+        if presupuestos is not None:
+            return presupuestos
+    docs = db.collection("usuarios").document(user_id).collection("presupuestos").stream()
+    return {doc.id: doc.to_dict().get("limite", 0) for doc in docs}
+
+def obtener_presupuesto(user_id: str, categoria: str):
+    if coherencia:
+        presupuestos = coherencia.presupuestos(user_id)
+        if presupuestos is not None:
+            return presupuestos.get(categoria)
+    doc = db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).get()
+    return doc.to_dict().get("limite", 0) if doc.exists else None
+
+def obtener_categorias_personalizadas(user_id: str):
+    if coherencia:
+        categorias = coherencia.categorias(user_id)
+        if categorias is not None:
+            return sorted(categorias)
+    docs = db.collection("usuarios").document(user_id).collection("categorias").stream()
+    return [doc.id for doc in docs]
+
+def gastos_recientes(user_id: str):
+    _, inicio_mes_anterior = limites_mes(user_id)
+    return cache_gastos.obtener(user_id, inicio_mes_anterior)
+
+def gastos_recientes_de_paso(user_id: str):
+    # Para los recorridos de todos los usuarios: no desplaza a los activos del cache
+    _, inicio_mes_anterior = limites_mes(user_id)
+    return cache_gastos.leer(user_id, inicio_mes_anterior)
+
+def leer_gastos(user_id: str, desde=None, hasta=None):
+    # Primero los meses compactados en usuarios/{id}/archivo, luego los
+    # originales (salvo los de un mes que se está compactando: ya se leyeron)
+    en_curso = []
+    yield from leer_archivados(db, user_id, desde, hasta, en_curso)
+    consulta = db.collection("usuarios").document(user_id).collection("gastos")
+    if desde is not None:
+        consulta = consulta.where("fecha", ">=", desde)
+    if hasta is not None:
+        consulta = consulta.where("fecha", "<", hasta)
+    for doc in consulta.stream():
+        d = doc.to_dict()
+        if not ya_archivado(d.get("fecha"), en_curso):
+            yield d
+
+# Sumas diarias acumuladas por usuario y año para totales de cualquier rango
+indice_diario = IndiceDiario(db, leer_gastos, zona_usuario)
+
+# Respuestas ya armadas para el modo inline, por usuario. Se invalidan en
+# cada escritura propia y caducan a los INLINE_CACHE_SEGUNDOS.
+respuestas_inline = {}
+INLINE_CACHE_SEGUNDOS = int(os.getenv("INLINE_CACHE_SEGUNDOS", "60"))
+
+def invalidar_inline(user_id: str):
+    respuestas_inline.pop(user_id, None)
+    limitador.olvidar(user_id)  # las respuestas guardadas de resumen, total, etc. ya no valen
+
+def obtener_ultimo_gasto(user_id: str):
+    ultimo_cache = gastos_recientes(user_id).ultimo()
+    if ultimo_cache:
+        gasto_id, monto, categoria, epoch = ultimo_cache
+        fecha_val = datetime.datetime.fromtimestamp(epoch, tz=zona_usuario(user_id))
+        return gasto_id, monto, categoria, fecha_val
+
+    # Sin gastos en los dos últimos meses: se consulta el histórico
+    gastos = list(db.collection("usuarios").document(user_id).collection("gastos")
+        .order_by("fecha", direction=firestore.Query.DESCENDING).limit(1).stream())
+    if not gastos:
+        return None
+    d = gastos[0].to_dict()
+    fecha_val = d["fecha"]
+    if isinstance(fecha_val, str):
+        fecha_val = parser.parse(fecha_val)  # convierte string a datetime
+    return gastos[0].id, d["monto"], d["categoria"], fecha_val
+
 teclado_menu = ReplyKeyboardMarkup(
     [[KeyboardButton("📋 Menú")]],
     resize_keyboard=True
@@ -62,9 +325,70 @@ def obtener_teclado_principal():
         ["💼 Presupuesto"]
     ], resize_keyboard=True)
 
-def obtener_categorias_con_botones(user_id: str):
-    categorias_ref = db.collection("usuarios").document(user_id).collection("categorias").stream()
-    personalizadas = [doc.id for doc in categorias_ref]
+indice_descripciones = IndiceDescripciones(db)
+
+async def sugerir_categoria(user_id: str, descripcion: str):
+    # Solo la primera consulta de cada usuario va a Firestore, fuera del event loop
+    if not indice_descripciones.cargado(user_id):
+        try:
+            datos = await resiliencia.llamar("indice_descripciones", indice_descripciones.leer, user_id)
+        except AlmacenNoDisponible:
+            return None  # sin sugerencia: el usuario elige en los botones
+        indice_descripciones.cargar(user_id, datos)
+    return indice_descripciones.sugerir(user_id, descripcion)
+
+# --- Bitácora local de gastos (opcional) ---
+
+def preparar_volcado(lote, gastos):
+    # Los gastos con create() y los índices de cada usuario en una sola escritura
+    por_usuario = {}
+    for user_id, gasto_id, gasto in gastos:
+        lote.create(db.collection("usuarios").document(user_id).collection("gastos").document(gasto_id), gasto)
+        por_usuario.setdefault(user_id, []).append(gasto)
+    for user_id, lista in por_usuario.items():
+        descripciones = {}
+        for g in lista:
+            if g["descripcion"]:
+                clave = (g["descripcion"], g["categoria"])
+                descripciones[clave] = descripciones.get(clave, 0) + 1
+        if descripciones:
+            indice_descripciones.registrar_varios(lote, user_id, descripciones)
+        indice_diario.registrar_varios(lote, user_id, [(g["categoria"], g["fecha"], g["monto"]) for g in lista])
+
+def gastos_volcados(gastos):
+    # Si la cache se recargó de Firestore antes del volcado, le faltaban
+    for user_id, gasto_id, gasto in gastos:
+        cache_gastos.agregar(user_id, gasto_id, gasto["monto"], gasto["categoria"], gasto["fecha"])
+    for user_id in {g[0] for g in gastos}:
+        invalidar_inline(user_id)
+
+def volcado_fallido(gastos):
+    # Los incrementos en memoria no llegaron a Firestore
+    for user_id in {g[0] for g in gastos}:
+        indice_descripciones.olvidar(user_id)
+        indice_diario.invalidar(user_id)
+
+bitacora = None
+if os.getenv("BITACORA_ARCHIVO"):
+    bitacora = Bitacora(
+        os.getenv("BITACORA_ARCHIVO"), db, resiliencia, preparar_volcado,
+        al_volcar=gastos_volcados, al_fallar=volcado_fallido,
+        lote_max=int(os.getenv("BITACORA_LOTE", "100")), plazo=resiliencia.plazo
+    )
+
+def es_grupo(update: Update):
+    return update.effective_chat is not None and update.effective_chat.type in ("group", "supergroup")
+
+async def obtener_categorias_con_botones(user_id: str, chat_id=None):
+    # Con el almacén caído basta la última lista conocida para armar los botones
+    if chat_id is not None:
+        personalizadas, _ = await resiliencia.leer_con_respaldo(
+            ("categorias_grupo", chat_id), "categorias_grupo", categorias_grupo, db, chat_id
+        )
+    else:
+        personalizadas, _ = await resiliencia.leer_con_respaldo(
+            ("categorias", user_id), "categorias", obtener_categorias_personalizadas, user_id
+        )
     todas = list(dict.fromkeys(CATEGORIAS_VALIDAS + personalizadas))
     botones = [[InlineKeyboardButton(cat.capitalize(), callback_data=f"cat:{cat}")] for cat in todas]
     botones.append([InlineKeyboardButton("➕ Otra categoría", callback_data="catref:personalizada")])
@@ -102,6 +426,17 @@ def extraer_monto_descripcion(texto):
 def formatear_pesos(valor):
     return f"${valor:,.0f}".replace(",", ".")
 
+def formatear_moneda(valor, moneda):
+    decimales = 0 if float(valor).is_integer() else 2
+    texto = f"{valor:,.{decimales}f}".replace(",", "_").replace(".", ",").replace("_", ".")
+    return f"{texto} {moneda}"
+
+def detalle_moneda(gasto: dict):
+    # " (20 USD)" para los gastos registrados en otra moneda
+    if gasto.get("moneda") and gasto["moneda"] != MONEDA_BASE:
+        return f" ({formatear_moneda(gasto['monto_original'], gasto['moneda'])})"
+    return ""
+
 def detectar_gasto_repetitivo(user_id, categoria, historial):
     promedio = sum(historial) / len(historial)
     if all(abs(g - promedio) / promedio < 0.1 for g in historial):
@@ -109,19 +444,27 @@ def detectar_gasto_repetitivo(user_id, categoria, historial):
     return None
 
 async def responder(update: Update, texto: str, **kwargs):
+    limitador.anotar(responder, texto, **kwargs)
+    if respuestas.agregar(update, texto, **kwargs):
+        return  # sale al final del update junto con lo demás
     if update.message:
         await update.message.reply_text(texto, **kwargs)
     elif update.callback_query:
         await update.callback_query.message.reply_text(texto, **kwargs)
     else:
-        print("⚠️ No se pudo enviar mensaje: update sin message ni callback.")
+        log.warning("no se pudo enviar mensaje: update sin message ni callback")
 
 
 async def responder_foto(update: Update, foto: BytesIO, **kwargs):
+    await respuestas.enviar_pendientes(update)  # lo que iba antes de la foto sale antes
+    mensaje = None
     if update.message:
-        await update.message.reply_photo(foto, **kwargs)
+        mensaje = await update.message.reply_photo(foto, **kwargs)
     elif update.callback_query:
-        await update.callback_query.message.reply_photo(foto, **kwargs)
+        mensaje = await update.callback_query.message.reply_photo(foto, **kwargs)
+    if mensaje is not None and mensaje.photo:
+        # Repetirla es reenviar el file_id, sin volver a dibujar ni subir la imagen
+        limitador.anotar(responder_foto, mensaje.photo[-1].file_id, **kwargs)
 
 def detectar_categoria_sin_limite(resumen, limites):
     sugerencias = []
@@ -131,27 +474,25 @@ def detectar_categoria_sin_limite(resumen, limites):
     return sugerencias
 
 async def verificar_presupuesto(update: Update, user_id: str, categoria: str):
-    presupuesto_ref = db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).get()
-    if not presupuesto_ref.exists:
+    presupuestos = await resiliencia.llamar("presupuestos", obtener_presupuestos, user_id)
+    if categoria not in presupuestos:
         return
 
-    limite = presupuesto_ref.to_dict().get("limite", 0)
+    limite = presupuestos[categoria]
 
-    inicio_mes = datetime.datetime.now(pytz.timezone("America/Bogota")).replace(
-        day=1, hour=0, minute=0, second=0, microsecond=0
-    )
+    inicio_mes, _ = limites_mes(user_id)
+    gastos_usuario = await resiliencia.llamar("gastos_recientes", gastos_recientes, user_id)
+    total_mes = gastos_usuario.total(desde=inicio_mes, categoria=categoria)
 
-    gastos = db.collection("usuarios").document(user_id).collection("gastos") \
-        .where("categoria", "==", categoria) \
-        .where("fecha", ">=", inicio_mes).stream()
-
-    total_mes = sum(doc.to_dict().get("monto", 0) for doc in gastos)
-
-    print(f"🧾 Total gastado en {categoria}: {formatear_pesos(total_mes)}")
-    print(f"💸 Límite definido: {formatear_pesos(limite)}")
+    log.debug("verificando presupuesto", extra={"categoria": categoria, "gastado": total_mes, "limite": limite})
 
     if total_mes <= limite:
-        return  # No se ha excedido el presupuesto
+        # Aún no se excede: se avisa si el pronóstico del día dice que se excederá
+        pronostico = await resiliencia.llamar("pronostico", pronostico_usuario, user_id)
+        aviso = aviso_pronostico(user_id, categoria, pronostico.get(categoria), limite)
+        if aviso:
+            await responder(update, aviso, parse_mode="Markdown")
+        return
 
     exceso = total_mes - limite
     mensaje = (
@@ -165,18 +506,11 @@ async def verificar_presupuesto(update: Update, user_id: str, categoria: str):
     sugerencias = []
     botones = []
 
-    presupuestos = db.collection("usuarios").document(user_id).collection("presupuestos").stream()
-    for doc in presupuestos:
-        cat = doc.id
+    for cat, limite_cat in presupuestos.items():
         if cat == categoria:
             continue  # omitimos la ya excedida
 
-        data = doc.to_dict()
-        limite_cat = data.get("limite", 0)
-        gastos_cat = db.collection("usuarios").document(user_id).collection("gastos") \
-            .where("categoria", "==", cat) \
-            .where("fecha", ">=", inicio_mes).stream()
-        total_cat = sum(g.to_dict().get("monto", 0) for g in gastos_cat)
+        total_cat = gastos_usuario.total(desde=inicio_mes, categoria=cat)
         restante = limite_cat - total_cat
 
         if restante > 0:
@@ -207,11 +541,87 @@ async def verificar_presupuesto(update: Update, user_id: str, categoria: str):
         mensaje += "ℹ️ No hay otras categorías con presupuesto disponible actualmente."
 
     reply_markup = InlineKeyboardMarkup(botones) if botones else None
+    await responder(update, mensaje, parse_mode="Markdown", reply_markup=reply_markup)
+
+# --- Pronóstico de fin de mes ---
+#
+# El pronóstico de cada usuario se calcula una vez por día local (en el
+# trabajo nocturno para todos los usuarios con presupuesto, o en la primera
+# consulta del día) y el camino interactivo solo lee el valor guardado.
+
+pronosticos = {}         # user_id -> (fecha local, {categoria: (gastado, proyectado, dia_exceso)})
+avisos_pronostico = {}   # user_id -> (mes, categorías ya avisadas)
+
+def entrada_pronostico(user_id: str, presupuestos: dict, lector=gastos_recientes):
+    now = ahora(user_id)
+    inicio_mes, _ = limites_mes(user_id, now)
+    dias_mes = calendar.monthrange(now.year, now.month)[1]
+    return (user_id, lector(user_id), presupuestos, a_epoch(inicio_mes), now.day, dias_mes)
+
+def pronostico_usuario(user_id: str):
+    hoy = ahora(user_id).date()
+    guardado = pronosticos.get(user_id)
+    if guardado and guardado[0] == hoy:
+        return guardado[1]
+    resultado = pronosticar([entrada_pronostico(user_id, obtener_presupuestos(user_id))])[user_id]
+    pronosticos[user_id] = (hoy, resultado)
+    return resultado
+
+def aviso_pronostico(user_id: str, categoria: str, pronostico, limite):
+    if not pronostico or pronostico[2] is None:
+        return None
+    mes = ahora(user_id).strftime("%Y-%m")
+    mes_avisos, avisadas = avisos_pronostico.get(user_id, (mes, set()))
+    if mes_avisos != mes:
+        avisadas = set()
+    if categoria in avisadas:
+        return None
+    avisadas.add(categoria)
+    avisos_pronostico[user_id] = (mes, avisadas)
+    _, proyectado, dia = pronostico
+    return (
+        f"📈 Al ritmo actual superarás *{categoria}* el día {dia}.\n"
+        f"• Proyección a fin de mes: {formatear_pesos(proyectado)} de {formatear_pesos(limite)}"
+    )
 
-    if update.message:
-        await update.message.reply_text(mensaje, parse_mode="Markdown", reply_markup=reply_markup)
-    elif update.callback_query:
-        await update.callback_query.message.reply_text(mensaje, parse_mode="Markdown", reply_markup=reply_markup)
+def calcular_pronosticos_todos():
+    # Todos los presupuestos de usuarios en una sola consulta de grupo de colecciones
+    presupuestos = {}
+    for doc in db.collection_group("presupuestos").stream():
+        padre = doc.reference.parent.parent
+        if padre is None or padre.parent.id != "usuarios":
+            continue  # presupuestos de grupos
+        presupuestos.setdefault(padre.id, {})[doc.id] = doc.to_dict().get("limite", 0)
+
+    cargar_zonas(presupuestos)
+    entradas = [
+        entrada_pronostico(user_id, limites, gastos_recientes_de_paso) for user_id, limites in presupuestos.items()
+    ]
+    resultados = pronosticar(entradas)
+    # Solo se renueva el de quienes ya lo tenían (usuarios activos); el de
+    # los demás se calcula en su primera consulta del día
+    for user_id, _, _, _, _, _ in entradas:
+        if user_id in pronosticos:
+            pronosticos[user_id] = (ahora(user_id).date(), resultados[user_id])
+    return presupuestos, resultados
+
+async def pronosticar_presupuestos(context: ContextTypes.DEFAULT_TYPE):
+    # Un recorrido largo: si vence el plazo, el hilo sigue; reintentarlo lo duplicaría
+    presupuestos, resultados = await resiliencia.llamar(
+        "pronosticos", calcular_pronosticos_todos, idempotente=False, plazo=600
+    )
+    avisos = 0
+    for user_id, limites in presupuestos.items():
+        for categoria, pronostico in resultados[user_id].items():
+            aviso = aviso_pronostico(user_id, categoria, pronostico, limites.get(categoria))
+            if not aviso:
+                continue
+            try:
+                await canales.bot(context).send_message(chat_id=int(user_id), text=aviso, parse_mode="Markdown")
+                avisos += 1
+            except Exception as e:
+                log.warning("no se pudo enviar el pronóstico", extra={"user_id": user_id, "error": repr(e)})
+    log.info("pronósticos calculados", extra={"usuarios": len(presupuestos), "avisos": avisos})
 
 # --- Funciones del bot ---
 
@@ -240,10 +650,10 @@ async def mostrar_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📉 Gráfico", callback_data="menu:grafico")]
     ])
 
-    if update.message:
-        await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=botones)
-    elif update.callback_query:
-        await update.callback_query.message.reply_text(texto, parse_mode="Markdown", reply_markup=botones)
+    await responder(update, texto, parse_mode="Markdown", reply_markup=botones)
+
+async def pedir_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await responder(update, "✍️ Escribe el gasto en el formato: 100.000 mercado")
 
 async def manejar_menu_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -252,7 +662,7 @@ async def manejar_menu_inline(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Ejecutar la función correspondiente
     if data == "menu:registrar_gasto":
-        await query.message.reply_text("✍️ Escribe el gasto en el formato: 100.000 mercado")
+        await pedir_gasto(update, context)
     elif data == "menu:resumen":
         await resumen(update, context)
     elif data == "menu:comparar":
@@ -266,11 +676,11 @@ async def manejar_menu_inline(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif data == "menu:grafico":
         await grafico(update, context)
     else:
-        await query.message.reply_text("❌ Opción no reconocida.")
+        await responder(update, "❌ Opción no reconocida.")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    now = datetime.datetime.now(pytz.timezone("America/Bogota"))
+    now = ahora(user_id)
     user_ref = db.collection("usuarios").document(user_id)
 
     def verificar_y_crear():
@@ -279,14 +689,96 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if "fecha_inicio" not in data:
             user_ref.set({"fecha_inicio": now}, merge=True)
 
-    await asyncio.to_thread(verificar_y_crear)
+    await resiliencia.llamar("crear_usuario", verificar_y_crear)
+    if user_id not in bucket_de_usuario:
+        registrar_envio(context.job_queue, user_id, zona_usuario(user_id).zone)
 
     await mostrar_menu(update, context)
 
+async def cambiar_zona(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        await responder(
+            update,
+            f"🕑 Tu zona horaria es *{zona_usuario(user_id).zone}*.\n"
+            f"Cámbiala con `/zona America/Mexico_City`.",
+            parse_mode="Markdown"
+        )
+        return
+
+    nueva = context.args[0]
+    # Acepta mayúsculas/minúsculas distintas: "america/lima" -> "America/Lima"
+    nueva = next((z for z in pytz.all_timezones if z.lower() == nueva.lower()), None)
+    if nueva is None:
+        await responder(update, "❌ Zona horaria no reconocida. Ejemplo: `/zona America/Lima`", parse_mode="Markdown")
+        return
+
+    await resiliencia.llamar(
+        "guardar_zona",
+        lambda: db.collection("usuarios").document(user_id).set({"zona_horaria": nueva}, merge=True)
+    )
+    registrar_envio(context.job_queue, user_id, nueva)
+    cache_gastos.invalidar(user_id)  # el inicio de mes cambia con la zona
+    await responder(update, f"✅ Zona horaria actualizada a *{nueva}*.", parse_mode="Markdown")
+
+async def tasas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    args = context.args or []
+    hoy = ahora(user_id).date()
+
+    if not args:
+        monedas = [m for m in tabla_cambio.monedas() if m != MONEDA_BASE]
+        if not monedas:
+            await responder(update, f"💱 No hay tasas de cambio cargadas; todo se registra en {MONEDA_BASE}.")
+            return
+        mensaje = f"💱 *Tasas de hoy en {MONEDA_BASE}:*\n\n"
+        for moneda in monedas:
+            mensaje += f"• 1 {moneda} = {formatear_pesos(tabla_cambio.tasa(moneda, hoy))}\n"
+        mensaje += "\nRegistra gastos en otra moneda así: `20 usd taxi`"
+        await responder(update, mensaje, parse_mode="Markdown")
+        return
+
+    if not es_admin(user_id):
+        await responder(update, "⛔ Solo los administradores pueden cambiar las tasas.")
+        return
+
+    if args[0].lower() == "recargar":
+        if not os.path.exists(tabla_cambio.ruta):
+            await responder(update, f"❌ No existe {tabla_cambio.ruta}.")
+            return
+        try:
+            filas = await asyncio.to_thread(tabla_cambio.cargar_csv, tabla_cambio.ruta)
+        except (OSError, ValueError) as e:
+            log.warning("no se pudieron recargar las tasas", extra={"ruta": tabla_cambio.ruta, "error": str(e)})
+            await responder(update, f"❌ No recargué {tabla_cambio.ruta} ({e}); siguen las tasas anteriores.")
+            return
+        await responder(update, f"✅ Recargué {filas} tasas desde {tabla_cambio.ruta}; reemplazan a las anteriores.")
+        return
+
+    try:
+        moneda, tasa = args[0].upper(), leer_decimal(args[1])
+        fecha = datetime.date.fromisoformat(args[2]) if len(args) > 2 else hoy
+    except (IndexError, ValueError):
+        moneda = None
+    if not moneda or len(moneda) != 3 or not moneda.isalpha() or moneda == MONEDA_BASE or tasa <= 0:
+        await responder(
+            update,
+            "❌ Uso: `/tasa USD 4100 [AAAA-MM-DD]` o `/tasa recargar`",
+            parse_mode="Markdown"
+        )
+        return
+    try:
+        await asyncio.to_thread(tabla_cambio.fijar, moneda, fecha, tasa)
+    except OSError as e:
+        log.warning("no se pudo guardar la tasa", extra={"ruta": tabla_cambio.ruta, "error": str(e)})
+        await responder(update, f"⚠️ La tasa rige desde ya, pero no pude guardarla en {tabla_cambio.ruta}: se perderá al reiniciar.")
+        return
+    await responder(update, f"✅ Desde el {fecha:%Y-%m-%d}, 1 {moneda} = {formatear_pesos(tasa)}.")
+
 # --- Flujo para establecer presupuesto ---
 async def presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    botones_markup = obtener_categorias_con_botones(user_id)
+    botones_markup = await obtener_categorias_con_botones(user_id)
 
     # Convertimos a lista de listas para modificar
     botones_lista = list(botones_markup.inline_keyboard)
@@ -294,16 +786,11 @@ async def presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     reply_markup = InlineKeyboardMarkup(botones_lista)
 
-    if update.message:
-        await update.message.reply_text(
-            "¿Para qué categoría deseas establecer un presupuesto mensual?", 
-            reply_markup=reply_markup
-        )
-    elif update.callback_query:
-        await update.callback_query.message.reply_text(
-            "¿Para qué categoría deseas establecer un presupuesto mensual?", 
-            reply_markup=reply_markup
-        )
+    await responder(
+        update,
+        "¿Para qué categoría deseas establecer un presupuesto mensual?",
+        reply_markup=reply_markup
+    )
 
     context.chat_data["conversation"] = "presupuesto"
     return ESCOGER_CATEGORIA
@@ -311,18 +798,19 @@ async def presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def seleccionar_categoria_presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("✍️ Escribe el nombre de la nueva categoría personalizada:")
+    await respuestas.editar(update, "✍️ Escribe el nombre de la nueva categoría personalizada:")
     return ESPECIFICAR_CATEGORIA_PERSONALIZADA
 
 async def escoger_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("🎯 Entró al handler escoger_categoria")  # << Este sí debe aparecer
+    log.debug("categoría de presupuesto elegida")
     query = update.callback_query
     await query.answer()
 
     categoria = query.data.split(":")[1]
     context.user_data['categoria_presupuesto'] = categoria
 
-    await query.edit_message_text(
+    await respuestas.editar(
+        update,
         f"¿Cuál es tu presupuesto mensual para *{categoria}*?",
         parse_mode="Markdown"
     )
@@ -336,7 +824,8 @@ async def guardar_categoria_personalizada_presupuesto(update: Update, context: C
     categoria = update.message.text.strip().lower()
     context.user_data['categoria_presupuesto'] = categoria
 
-    await update.message.reply_text(
+    await responder(
+        update,
         f"¿Cuál es tu presupuesto mensual para *{categoria}*?",
         parse_mode="Markdown"
     )
@@ -345,7 +834,7 @@ async def guardar_categoria_personalizada_presupuesto(update: Update, context: C
 async def especificar_limite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         texto = update.message.text.strip().replace(".", "").replace(",", "")
-        print(f"🟢 especificar_limite: texto={texto}, user={update.effective_user.id}, estado={context.chat_data.get('conversation')}")
+        log.debug("límite recibido", extra={"texto": texto, "conversacion": context.chat_data.get("conversation")})
 
         if not texto.isdigit():
             keyboard = InlineKeyboardMarkup([
@@ -354,7 +843,8 @@ async def especificar_limite(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     InlineKeyboardButton("❌ Cancelar", callback_data="cancelar_presupuesto")
                 ]
             ])
-            await update.message.reply_text(
+            await responder(
+                update,
                 "❌ El valor debe ser numérico. Por ejemplo: `20000`",
                 parse_mode="Markdown",
                 reply_markup=keyboard
@@ -367,35 +857,33 @@ async def especificar_limite(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = str(update.effective_user.id)
 
        # Validar que el nuevo límite no sea menor a lo ya gastado
-        inicio_mes = datetime.datetime.now(pytz.timezone("America/Bogota")).replace(
-            day=1, hour=0, minute=0, second=0, microsecond=0
-        )
-        gastos = db.collection("usuarios").document(user_id).collection("gastos") \
-            .where("categoria", "==", categoria) \
-            .where("fecha", ">=", inicio_mes).stream()
-        total_gastado = sum(doc.to_dict().get("monto", 0) for doc in gastos)
+        inicio_mes, _ = limites_mes(user_id)
+        gastos_usuario = await resiliencia.llamar("gastos_recientes", gastos_recientes, user_id)
+        total_gastado = gastos_usuario.total(desde=inicio_mes, categoria=categoria)
 
         if limite < total_gastado:
-            await update.message.reply_text(
+            await responder(
+                update,
                 f"❌ Ya has gastado *{formatear_pesos(total_gastado)}* en esta categoría.\n"
                 f"No puedes establecer un presupuesto menor a lo que ya gastaste.",
                 parse_mode="Markdown"
             )
 
-            botones = obtener_categorias_con_botones(user_id)
-            await update.message.reply_text(
+            botones = await obtener_categorias_con_botones(user_id)
+            await responder(
+                update,
                 "💼 Por favor, elige otra categoría para ajustar el presupuesto:",
                 reply_markup=botones
             )
             return ESCOGER_CATEGORIA        
 
         # Verificar si ya existe
-        presupuesto_doc = db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).get()
+        limite_actual = await resiliencia.llamar("presupuesto", obtener_presupuesto, user_id, categoria)
 
-        if presupuesto_doc.exists:
-            limite_actual = presupuesto_doc.to_dict().get("limite", 0)
+        if limite_actual is not None:
             context.user_data["nuevo_limite"] = limite
-            await update.message.reply_text(
+            await responder(
+                update,
                 f"⚠️ Ya tienes un presupuesto para *{categoria}* de ${limite_actual:,}.\n"
                 f"¿Quieres reemplazarlo por ${limite:,}?",
                 parse_mode="Markdown",
@@ -415,31 +903,45 @@ async def especificar_limite(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return PREGUNTAR_ACCION_POST_PRESUPUESTO
 
     except ValueError:
-        await update.message.reply_text("❌ El valor debe ser numérico. Usa: [monto]. Ej: 12.000")
+        await responder(update, "❌ El valor debe ser numérico. Usa: [monto]. Ej: 12.000")
         return ESPECIFICAR_LIMITE
 
 async def reintentar_especificar_limite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     categoria = context.user_data.get('categoria_presupuesto', 'la categoría seleccionada')
-    await query.edit_message_text(
+    await respuestas.editar(
+        update,
         f"✍️ ¿Cuál es el *límite mensual* para la categoría *{categoria}*?\n\n"
         f"Por ejemplo: `50.000`",
         parse_mode="Markdown"
     )
     return ESPECIFICAR_LIMITE
 
-async def guardar_presupuesto(user_id, categoria, limite, update):
-    db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).set({
+def escribir_presupuesto(user_id, categoria, limite, actualizado):
+    # El límite y su categoría en una sola escritura; repetirla deja lo mismo
+    usuario_ref = db.collection("usuarios").document(user_id)
+    lote = db.batch()
+    lote.set(usuario_ref.collection("presupuestos").document(categoria), {
         "limite": limite,
-        "actualizado": datetime.datetime.now(pytz.timezone("America/Bogota"))
+        "actualizado": actualizado
     })
-
-    db.collection("usuarios").document(user_id).collection("categorias").document(categoria).set({
+    lote.set(usuario_ref.collection("categorias").document(categoria), {
         "nombre": categoria
     }, merge=True)
+    lote.commit()
+
+async def guardar_presupuesto(user_id, categoria, limite, update):
+    await resiliencia.llamar(
+        "guardar_presupuesto", escribir_presupuesto, user_id, categoria, limite, ahora(user_id)
+    )
+
+    if coherencia:
+        coherencia.guardar_presupuesto(user_id, categoria, limite)
+    invalidar_inline(user_id)
 
-    await update.message.reply_text(
+    await responder(
+        update,
         rf"✅ Listo. Tu presupuesto para *{categoria}* es de ${limite:,} al mes.",
         parse_mode="Markdown"
     )
@@ -450,7 +952,7 @@ async def guardar_presupuesto(user_id, categoria, limite, update):
         [InlineKeyboardButton("🚪 Salir", callback_data="salir")],
     ])
 
-    await update.message.reply_text("¿Qué deseas hacer ahora?", reply_markup=keyboard)
+    await responder(update, "¿Qué deseas hacer ahora?", reply_markup=keyboard)
 
 async def confirmar_reemplazo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -459,7 +961,7 @@ async def confirmar_reemplazo(update: Update, context: ContextTypes.DEFAULT_TYPE
     categoria = context.user_data.get("categoria_presupuesto")
     limite = context.user_data.get("nuevo_limite")
 
-    await guardar_presupuesto(user_id, categoria, limite, query)
+    await guardar_presupuesto(user_id, categoria, limite, update)
 
     context.chat_data.pop("conversation", None)
 
@@ -467,7 +969,7 @@ async def confirmar_reemplazo(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def cancelar_reemplazo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text("❌ Operación cancelada. El presupuesto anterior se mantuvo.")
+    await respuestas.editar(update, "❌ Operación cancelada. El presupuesto anterior se mantuvo.")
     context.chat_data.pop("conversation", None)
     return ConversationHandler.END
 
@@ -476,38 +978,37 @@ async def manejar_accion_post_presupuesto(update: Update, context: ContextTypes.
     await query.answer()
 
     opcion = query.data
-    print(f"🔄 manejar_accion_post_presupuesto: opción={opcion}, user={update.effective_user.id}")
+    log.debug("acción tras presupuesto", extra={"opcion": opcion})
 
     if opcion == "otro_presupuesto":
         origen = context.chat_data.get("conversation")
-        print(origen)
+        log.debug("origen de la conversación", extra={"conversacion": origen})
         if origen not in ["presupuesto", "gasto"]:
         # Si no está seteado aún, por defecto asumimos "presupuesto"
             context.chat_data["conversation"] = "presupuesto"
         user_id = str(update.effective_user.id)
-        botones = obtener_categorias_con_botones(user_id) 
-        await query.edit_message_text("📝 ¿Para qué categoría deseas establecer otro presupuesto?")
-        await query.message.reply_text("Selecciona una categoría:", reply_markup=botones)
+        botones = await obtener_categorias_con_botones(user_id)
+        await respuestas.editar(update, "📝 ¿Para qué categoría deseas establecer otro presupuesto?")
+        await responder(update, "Selecciona una categoría:", reply_markup=botones)
         return ESCOGER_CATEGORIA
 
     elif opcion == "registrar_gasto":
-        print("✅ Entró en 'registrar_gasto'")
         context.chat_data.pop("conversation", None)
-        await query.edit_message_text("✍️ Escribe el gasto en el formato: 12000 Uber")
+        await respuestas.editar(update, "✍️ Escribe el gasto en el formato: 12000 Uber")
         return ConversationHandler.END
 
     elif opcion == "salir":
         context.chat_data.pop("conversation", None)
-        await query.edit_message_text("🚪 ¡Listo! Puedes seguir usando otros comandos cuando quieras.")
+        await respuestas.editar(update, "🚪 ¡Listo! Puedes seguir usando otros comandos cuando quieras.")
         return ConversationHandler.END
 
 
 async def cancelar_presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         await update.callback_query.answer()  # opcional, para cerrar el "loading" en Telegram
-        await update.callback_query.message.reply_text("❌ Cancelado. No se guardó ningún presupuesto.")
+        await responder(update, "❌ Cancelado. No se guardó ningún presupuesto.")
     elif update.message:
-        await update.message.reply_text("❌ Cancelado. No se guardó ningún presupuesto.")
+        await responder(update, "❌ Cancelado. No se guardó ningún presupuesto.")
     
     context.chat_data.pop("conversation", None)
 
@@ -522,18 +1023,17 @@ async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_T
 
 async def consulta_presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    presupuestos_ref = db.collection("usuarios").document(user_id).collection("presupuestos")
-    docs = list(presupuestos_ref.stream())
+    presupuestos = await resiliencia.llamar("presupuestos", obtener_presupuestos, user_id)
 
-    if not docs:
-        await update.message.reply_text("📭 Aún no tienes categorías con presupuesto registrado.")
+    if not presupuestos:
+        await responder(update, "📭 Aún no tienes categorías con presupuesto registrado.")
         return ConversationHandler.END  # Puedes usar END si no hay conversación que continuar
 
     # Crear lista de botones con categorías
-    categorias = [doc.id for doc in docs]
+    categorias = list(presupuestos)
 
     if not categorias:
-        await update.message.reply_text("⚠️ No hay categorías disponibles.")
+        await responder(update, "⚠️ No hay categorías disponibles.")
         return ConversationHandler.END
 
     botones = [
@@ -543,7 +1043,8 @@ async def consulta_presupuesto(update: Update, context: ContextTypes.DEFAULT_TYP
 
     reply_markup = InlineKeyboardMarkup(botones)
 
-    await update.message.reply_text(
+    await responder(
+        update,
         "📊 ¿De qué categoría deseas consultar el presupuesto?",
         reply_markup=reply_markup
     )
@@ -557,25 +1058,18 @@ async def responder_consulta_presupuesto(update: Update, context: ContextTypes.D
     categoria = query.data.split("consulta_categoria:")[-1]
     user_id = str(update.effective_user.id)
 
-    presupuesto_doc = db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).get()
-    if not presupuesto_doc.exists:
-        await query.edit_message_text("❌ Esa categoría no tiene presupuesto registrado.")
+    presupuesto = await resiliencia.llamar("presupuesto", obtener_presupuesto, user_id, categoria)
+    if presupuesto is None:
+        await respuestas.editar(update, "❌ Esa categoría no tiene presupuesto registrado.")
         return ConversationHandler.END
 
-    presupuesto = presupuesto_doc.to_dict().get("limite", 0)
-
-    ahora = datetime.datetime.now(pytz.timezone("America/Bogota"))
-    inicio_mes = ahora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-    gastos = db.collection("usuarios").document(user_id).collection("gastos") \
-        .where(field_path="categoria", op_string="==", value=categoria) \
-        .where(field_path="fecha", op_string=">=", value=inicio_mes) \
-        .stream()
-        
-    total_gastado = sum(doc.to_dict()["monto"] for doc in gastos)
+    inicio_mes, _ = limites_mes(user_id)
+    gastos_usuario = await resiliencia.llamar("gastos_recientes", gastos_recientes, user_id)
+    total_gastado = gastos_usuario.total(desde=inicio_mes, categoria=categoria)
     restante = presupuesto - total_gastado
 
-    await query.edit_message_text(
+    await respuestas.editar(
+        update,
         f"📋 *Presupuesto para {categoria}:*\n"
         f"• Límite mensual: ${presupuesto:,}\n"
         f"• Gastado: ${total_gastado:,}\n"
@@ -586,14 +1080,13 @@ async def responder_consulta_presupuesto(update: Update, context: ContextTypes.D
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE): 
-    print(f"📥 handle_message recibido: {update.message.text}")
     chat_id = update.effective_chat.id
 
     # Verifica si hay una conversación activa
     chat_data = context.chat_data
     conversation_state = chat_data.get('conversation')
 
-    print(context.chat_data.get("conversation"))
+    log.debug("mensaje recibido", extra={"conversacion": conversation_state})
 
     if conversation_state is not None:
         # El usuario está en una conversación activa (presupuesto, eliminar, etc.)
@@ -601,44 +1094,74 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         texto = update.message.text.strip()
-        monto, descripcion = extraer_monto_descripcion(texto)
+        user_id = str(update.effective_user.id)
+        en_moneda = tabla_cambio.separar(texto)
+        moneda = None
+        if en_moneda:
+            # "20 usd taxi": se guarda convertido con la tasa del día
+            monto_original, moneda, descripcion = en_moneda
+            monto = tabla_cambio.a_base(monto_original, moneda, ahora(user_id))
+        elif tabla_cambio.sin_tasa(texto):
+            await responder(
+                update,
+                f"💱 No tengo tasas de cambio para {tabla_cambio.sin_tasa(texto)}. "
+                f"Registra el gasto en {MONEDA_BASE} o pide a un administrador que cargue la tasa."
+            )
+            return
+        else:
+            monto, descripcion = extraer_monto_descripcion(texto)
 
         if monto is None or not descripcion:
-            await update.message.reply_text(
+            await responder(
+                update,
                 "❌ No entendí el formato. Prueba con ejemplos como:\n"
-                "• `5000 comida`\n• `comida 5000`\n• `comida: 5.000`",
+                "• `5000 comida`\n• `comida 5000`\n• `comida: 5.000`\n• `20 usd taxi`",
                 parse_mode="Markdown"
             )
             return
 
+        anterior = context.user_data.get("gasto", {})
         context.user_data["gasto"] = {
             "monto": monto,
             "descripcion": descripcion
         }
+        if moneda and moneda != MONEDA_BASE:
+            context.user_data["gasto"].update(moneda=moneda, monto_original=monto_original)
+        mismo = {k: v for k, v in anterior.items() if k in ("monto", "descripcion", "moneda", "monto_original")}
+        if "id" in anterior and mismo == context.user_data["gasto"]:
+            # Reintento de un gasto cuyo commit venció el plazo: mismo id, para que no se duplique
+            context.user_data["gasto"].update(id=anterior["id"], fecha=anterior["fecha"])
+
+        # Si la descripción siempre ha ido a la misma categoría, se guarda sin preguntar
+        if not es_grupo(update):
+            sugerida = await sugerir_categoria(user_id, descripcion)
+            if sugerida:
+                context.user_data["gasto"]["categoria"] = sugerida
+                return await guardar_gasto_con_categoria(update, context, automatica=True)
 
         # Mostrar botones con categorías
-        user_id = str(update.effective_user.id)
-        keyboard = obtener_categorias_con_botones(user_id)
-        await update.message.reply_text("Selecciona la categoría del gasto:", reply_markup=keyboard)
+        keyboard = await obtener_categorias_con_botones(user_id, chat_id if es_grupo(update) else None)
+        await responder(update, "Selecciona la categoría del gasto:", reply_markup=keyboard)
 
         return HANDLE_GASTO_CATEGORIA
 
-    except Exception as e:
-        print(f"❌ Error en handle_message: {e}")
-        await update.message.reply_text(
+    except Exception:
+        log.exception("error en handle_message")
+        await responder(
+            update,
             "❌ Formato no válido. Usa: [monto] [descripción]. Ej: 12000 uber"
         )
 
 async def seleccionar_categoria_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    print("👉 Callback capturado", query.data)
+    log.debug("categoría elegida", extra={"callback": query.data})
 
     user_id = str(query.from_user.id)
     data = query.data.replace("catref:", "").replace("cat:", "")
 
     if data == "personalizada":
-        await query.edit_message_text("✍️ Escribe el nombre de la nueva categoría:")
+        await respuestas.editar(update, "✍️ Escribe el nombre de la nueva categoría:")
         return HANDLE_GASTO_PERSONALIZADA
 
     categoria = data.strip().lower()
@@ -657,40 +1180,103 @@ async def handle_categoria_personalizada(update: Update, context: ContextTypes.D
     await guardar_gasto_con_categoria(update, context)
     return HANDLE_GASTO_CATEGORIA
 
-async def guardar_gasto_con_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id=None):
+async def guardar_gasto_con_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id=None, automatica=False):
     user_id = str(update.effective_user.id)
     gasto_data = context.user_data.get("gasto", {})
     categoria = gasto_data.get("categoria")
     monto = gasto_data.get("monto")
-    fecha = datetime.datetime.now(pytz.timezone("America/Bogota"))
+    descripcion = gasto_data.get("descripcion", "")
+    fecha = gasto_data.get("fecha") or ahora(user_id)
 
     if not categoria or not monto:
-        await update.message.reply_text("❌ Hubo un error guardando el gasto.")
+        await responder(update, "❌ Hubo un error guardando el gasto.")
+        return ConversationHandler.END
+
+    if message_id is not None:
+        # Elegida en los botones: la confirmación reemplaza el mensaje de categorías
+        respuestas.reemplazar(update)
+
+    if es_grupo(update):
+        await guardar_gasto_grupo(update, user_id, monto, categoria, fecha, descripcion)
+        context.chat_data.pop("conversation", None)
         return ConversationHandler.END
 
-    # Guardar el gasto en Firestore
+    # Guardar el gasto y actualizar el índice de descripciones en una sola escritura
     gasto = {
         "monto": monto,
         "categoria": categoria,
+        "descripcion": descripcion,
+        "tokens": tokenizar(descripcion, categoria),
         "fecha": fecha
     }
-    db.collection("usuarios").document(user_id).collection("gastos").add(gasto)
-
-    if update.message:
-        await update.message.reply_text(
-            f"💾 Gasto registrado en la categoría *{categoria}* por *${monto:,.0f}*",
-            parse_mode="Markdown"
-        )
-    elif update.callback_query:
-        await update.callback_query.message.reply_text(
-        f"💾 Gasto registrado en la categoría *{categoria}* por *${monto:,.0f}*",
-            parse_mode="Markdown"
-        )
+    if gasto_data.get("moneda"):
+        gasto["moneda"] = gasto_data["moneda"]
+        gasto["monto_original"] = gasto_data["monto_original"]
+    # Un reintento tras un plazo vencido trae el id del intento anterior
+    gasto_ref = db.collection("usuarios").document(user_id).collection("gastos").document(gasto_data.get("id"))
+    # Con la bitácora el gasto queda confirmado al escribirse en disco y el
+    # volcador lo lleva a Firestore con sus índices
+    en_bitacora = bitacora is not None and await bitacora.anotar(user_id, gasto_ref.id, gasto)
+    if not en_bitacora:
+        lote = db.batch()
+        # create(): si la bitácora venció el plazo pero igual lo anotó, solo uno de los dos llega
+        lote.create(gasto_ref, gasto)
+        if descripcion:
+            indice_descripciones.registrar(lote, user_id, descripcion, categoria)
+        indice_diario.registrar(lote, user_id, categoria, fecha, monto)
+        # Los incrementos de los índices no son idempotentes: sin reintentos automáticos
+        try:
+            await resiliencia.llamar("guardar_gasto", lote.commit, idempotente=False)
+        except gexc.AlreadyExists:
+            # Lo volcó la bitácora: el gasto está, pero los índices en memoria se sumaron dos veces
+            indice_descripciones.olvidar(user_id)
+            indice_diario.invalidar(user_id)
+        except AlmacenNoDisponible as e:
+            log.error("no se pudo guardar el gasto", extra={"error": str(e), "gasto_id": gasto_ref.id})
+            # Los incrementos en memoria no llegaron a Firestore (o no se sabe)
+            indice_descripciones.olvidar(user_id)
+            indice_diario.invalidar(user_id)
+            if e.motivo == CIRCUITO_ABIERTO:
+                await responder(update, "⚠️ No pude guardar el gasto: el almacén no responde. Inténtalo de nuevo en un momento.")
+                context.chat_data.pop("conversation", None)
+                return ConversationHandler.END
+            # El commit salió y puede aplicarse aunque venció el plazo: el
+            # reintento usa el mismo id y create() choca si ya había llegado
+            gasto_data.update(id=gasto_ref.id, fecha=fecha)
+            boton = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Reintentar", callback_data=f"cat:{categoria}")]])
+            await responder(
+                update,
+                "⏳ El almacén no confirmó a tiempo y puede que el gasto sí haya quedado guardado. "
+                "Toca *Reintentar*: si ya estaba, no se duplica.",
+                parse_mode="Markdown", reply_markup=boton
+            )
+            return HANDLE_GASTO_CATEGORIA
+    # Guardado (o confirmado en un reintento): un nuevo toque es otro gasto
+    gasto_data.pop("id", None)
+    gasto_data.pop("fecha", None)
+    cache_gastos.agregar(user_id, gasto_ref.id, monto, categoria, fecha)
+    invalidar_inline(user_id)
+
+    texto_confirmacion = f"💾 Gasto registrado en la categoría *{categoria}* por *${monto:,.0f}*{detalle_moneda(gasto)}"
+    reply_markup = None
+    if automatica:
+        texto_confirmacion = f"💾 *{descripcion}* registrado en *{categoria}* por *${monto:,.0f}*{detalle_moneda(gasto)}"
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("↩️ Deshacer / cambiar categoría", callback_data=f"cambiar_cat:{gasto_ref.id}")
+        ]])
+
+    await responder(update, texto_confirmacion, parse_mode="Markdown", reply_markup=reply_markup)
 
     # Verificar si hay presupuesto
-    presupuesto_doc = db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).get()
-
-    if not presupuesto_doc.exists:
+    try:
+        limite = await resiliencia.llamar("presupuesto", obtener_presupuesto, user_id, categoria)
+    except AlmacenNoDisponible:
+        if not en_bitacora:
+            raise
+        # El gasto ya quedó guardado; el aviso de presupuesto puede esperar al próximo
+        context.chat_data.pop("conversation", None)
+        return ConversationHandler.END
+    if limite is None:
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Sí, establecer límite", callback_data=f"establecer_presupuesto:{categoria}")],
             [InlineKeyboardButton("❌ No, gracias", callback_data="ignorar_presupuesto")]
@@ -699,16 +1285,438 @@ async def guardar_gasto_con_categoria(update: Update, context: ContextTypes.DEFA
             f"🔎 Veo que *{categoria}* no tiene un presupuesto mensual definido.\n"
             f"¿Deseas establecer un límite?"
         )
-        if update.message:
-            await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=keyboard)
-        elif update.callback_query:
-            await update.callback_query.message.reply_text(texto, parse_mode="Markdown", reply_markup=keyboard)
+        await responder(update, texto, parse_mode="Markdown", reply_markup=keyboard)
         return HANDLE_GASTO_CATEGORIA
      
     await verificar_presupuesto(update, user_id, categoria)  # ✅ Mostrar advertencia si excede presupuesto
     context.chat_data.pop("conversation", None)
     return ConversationHandler.END
 
+def deshacer_gasto(user_id: str, gasto_id: str):
+    # Se borra el gasto y se descuenta la asociación que lo categorizó mal
+    gasto_ref = db.collection("usuarios").document(user_id).collection("gastos").document(gasto_id)
+    doc = gasto_ref.get()
+    if not doc.exists:
+        return None
+    d = doc.to_dict()
+    lote = db.batch()
+    lote.delete(gasto_ref)
+    if d.get("descripcion"):
+        indice_descripciones.registrar(lote, user_id, d["descripcion"], d["categoria"], -1)
+    indice_diario.registrar(lote, user_id, d["categoria"], d["fecha"], -d["monto"])
+    lote.commit()
+    return d
+
+async def cambiar_categoria_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = str(query.from_user.id)
+    gasto_id = query.data.split(":", 1)[1]
+
+    if bitacora is not None and not await bitacora.esperar(gasto_id, resiliencia.plazo):
+        await respuestas.editar(update, "⏳ Ese gasto aún no llega al almacén. Inténtalo de nuevo en un momento.")
+        return ConversationHandler.END
+
+    # Los decrementos de los índices no son idempotentes: sin reintentos automáticos
+    try:
+        d = await resiliencia.llamar("deshacer_gasto", deshacer_gasto, user_id, gasto_id, idempotente=False)
+    except AlmacenNoDisponible:
+        indice_descripciones.olvidar(user_id)
+        indice_diario.invalidar(user_id)
+        raise
+    if d is None:
+        await respuestas.editar(update, "⚠️ Ese gasto ya no existe.")
+        return ConversationHandler.END
+    cache_gastos.eliminar(user_id, gasto_id)
+    invalidar_inline(user_id)
+
+    context.user_data["gasto"] = {
+        k: d[k] for k in ("monto", "descripcion", "moneda", "monto_original") if k in d
+    }
+    await respuestas.editar(update, f"↩️ Deshice el gasto de {formatear_pesos(d['monto'])} en {d['categoria']}.")
+    await responder(
+        update,
+        "Selecciona la categoría del gasto:",
+        reply_markup=await obtener_categorias_con_botones(user_id)
+    )
+    return HANDLE_GASTO_CATEGORIA
+
+# --- Gastos compartidos en grupos ---
+
+async def guardar_gasto_grupo(update: Update, user_id: str, monto, categoria: str, fecha, descripcion=""):
+    chat_id = update.effective_chat.id
+    # Reintentar es seguro: el id se decide aquí y el gasto se crea con create()
+    gasto_id = nuevo_gasto_id(db, chat_id)
+    await resiliencia.llamar(
+        "gasto_grupo", registrar_gasto_grupo, db, chat_id, gasto_id, user_id, monto, categoria, fecha, descripcion
+    )
+
+    mes = mes_grupo(fecha)
+    totales, limites = await resiliencia.llamar(
+        "resumen_grupo", lambda: (totales_mes_grupo(db, chat_id, mes), presupuestos_grupo(db, chat_id))
+    )
+    gastado = totales.get(categoria, 0)
+    limite = limites.get(categoria)
+
+    texto = (
+        f"💾 Gasto del grupo registrado en *{categoria}* por *{formatear_pesos(monto)}*\n"
+        f"• Gastado por el grupo este mes: {formatear_pesos(gastado)}"
+    )
+    if limite is None:
+        texto += f"\n\n🔎 El grupo no tiene presupuesto para *{categoria}*. Usa `/presupuesto_grupo {categoria} 500000`."
+    elif gastado > limite:
+        texto += (
+            f"\n\n⚠️ *Atención:* El grupo superó su presupuesto para *{categoria}*.\n"
+            f"• Límite: {formatear_pesos(limite)}\n"
+            f"• Exceso: {formatear_pesos(gastado - limite)}"
+        )
+    else:
+        texto += f"\n• Disponible: {formatear_pesos(limite - gastado)}"
+
+    await responder(update, texto, parse_mode="Markdown")
+
+async def resumen_grupo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_grupo(update):
+        await responder(update, "👥 Este comando solo funciona dentro de un grupo.")
+        return
+
+    chat_id = update.effective_chat.id
+    # El mes del grupo es el mismo con que se registran sus gastos
+    mes = mes_grupo(ahora())
+    totales, limites = await resiliencia.llamar(
+        "resumen_grupo", lambda: (totales_mes_grupo(db, chat_id, mes), presupuestos_grupo(db, chat_id))
+    )
+    if not totales and not limites:
+        await responder(update, "📭 El grupo no tiene gastos registrados este mes.")
+        return
+
+    mensaje = "👥 *Gastos del grupo este mes:*\n\n"
+    for cat in sorted(set(totales) | set(limites)):
+        gastado = totales.get(cat, 0)
+        limite = limites.get(cat)
+        if limite is None:
+            mensaje += f"• {cat}: {formatear_pesos(gastado)} (sin límite asignado)\n"
+        else:
+            mensaje += f"• {cat}: {formatear_pesos(gastado)} / {formatear_pesos(limite)}\n"
+    await responder(update, mensaje, parse_mode="Markdown")
+
+async def presupuesto_grupo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_grupo(update):
+        await responder(update, "👥 Este comando solo funciona dentro de un grupo.")
+        return
+
+    args = context.args or []
+    monto_texto = args[-1].replace(".", "").replace(",", "") if args else ""
+    if len(args) < 2 or not monto_texto.isdigit():
+        await responder(update, "❌ Uso: `/presupuesto_grupo comida 500.000`", parse_mode="Markdown")
+        return
+
+    categoria = " ".join(args[:-1]).strip().lower()
+    limite = int(monto_texto)
+    await resiliencia.llamar(
+        "presupuesto_grupo", guardar_presupuesto_grupo,
+        db, update.effective_chat.id, categoria, limite, str(update.effective_user.id)
+    )
+    await responder(
+        update,
+        f"✅ Listo. El presupuesto del grupo para *{categoria}* es de {formatear_pesos(limite)} al mes.",
+        parse_mode="Markdown"
+    )
+
+# --- Búsqueda: /buscar <texto> [desde] [hasta] [categoría] ---
+
+async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    args = context.args or []
+    tz = zona_usuario(user_id)
+    personalizadas, _ = await resiliencia.leer_con_respaldo(
+        ("categorias", user_id), "categorias", obtener_categorias_personalizadas, user_id
+    )
+    categorias = set(CATEGORIAS_VALIDAS) | set(personalizadas)
+
+    palabras, desde, hasta, categoria = [], None, None, None
+    for arg in args:
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", arg):
+            try:
+                fecha_arg = tz.localize(datetime.datetime.strptime(arg, "%Y-%m-%d"))
+            except ValueError:
+                continue
+            if desde is None:
+                desde = fecha_arg
+            else:
+                hasta = fecha_arg + timedelta(days=1)  # el día final se incluye
+        elif palabras and arg.lower() in categorias:
+            categoria = arg.lower()
+        else:
+            palabras.append(arg)
+
+    tokens = tokenizar(" ".join(palabras))
+    if not tokens:
+        await responder(
+            update,
+            "🔎 Uso: `/buscar <texto> [desde] [hasta] [categoría]`\n"
+            "Ej: `/buscar uber 2025-01-01 2025-03-31 transporte`",
+            parse_mode="Markdown"
+        )
+        return
+
+    # Los filtros quedan del lado del bot; el botón solo lleva la clave y el cursor
+    busquedas = context.user_data.setdefault("busquedas", {})
+    clave = secrets.token_hex(3)
+    busquedas[clave] = {"tokens": tokens, "desde": desde, "hasta": hasta, "categoria": categoria}
+    while len(busquedas) > 5:
+        busquedas.pop(next(iter(busquedas)))
+
+    await mostrar_pagina_busqueda(update, user_id, clave, busquedas[clave], None)
+
+async def paginar_busqueda(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, clave, epoch_us, gasto_id = query.data.split(":", 3)
+    busqueda = context.user_data.get("busquedas", {}).get(clave)
+    if busqueda is None:
+        await respuestas.editar(update, "⚠️ Esta búsqueda expiró. Vuelve a usar /buscar.")
+        return
+    await mostrar_pagina_busqueda(update, str(query.from_user.id), clave, busqueda, (int(epoch_us), gasto_id))
+
+async def mostrar_pagina_busqueda(update: Update, user_id: str, clave: str, busqueda: dict, cursor):
+    resultados, siguiente = await resiliencia.llamar(
+        "buscar", buscar_pagina, db, user_id, busqueda["tokens"],
+        busqueda["desde"], busqueda["hasta"], busqueda["categoria"], cursor
+    )
+
+    tz = zona_usuario(user_id)
+    texto = f"🔎 *Resultados para* _{' '.join(busqueda['tokens'])}_:\n\n"
+    if not resultados:
+        texto += "Sin coincidencias en esta página." if cursor else "📭 No encontré gastos con ese texto."
+    for _, d in resultados:
+        fecha_str = d["fecha"].astimezone(tz).strftime("%Y-%m-%d")
+        descripcion = f" — {d['descripcion']}" if d.get("descripcion") else ""
+        texto += f"• {fecha_str}: {formatear_pesos(d['monto'])}{detalle_moneda(d)} en {d['categoria']}{descripcion}\n"
+    if not siguiente:
+        texto += f"\n{AVISO_ARCHIVO}"
+
+    reply_markup = None
+    if siguiente:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+            "➡️ Más resultados", callback_data=f"bus:{clave}:{siguiente[0]}:{siguiente[1]}"
+        )]])
+
+    if cursor and update.callback_query:
+        await respuestas.editar(update, texto, parse_mode="Markdown", reply_markup=reply_markup)
+    else:
+        await responder(update, texto, parse_mode="Markdown", reply_markup=reply_markup)
+
+# --- Modo inline: @bot total, @bot comida ---
+
+async def resultados_inline(user_id: str):
+    now = datetime.datetime.now()
+    guardado = respuestas_inline.get(user_id)
+    if guardado and guardado[0] > now:
+        return guardado[1]
+
+    if len(respuestas_inline) > 5000:
+        for uid in [u for u, (expira, _) in respuestas_inline.items() if expira <= now]:
+            del respuestas_inline[uid]
+
+    inicio_mes, _ = limites_mes(user_id)
+    gastado, limites = await resiliencia.llamar("inline", lambda: (
+        gastos_recientes(user_id).por_categoria(desde=inicio_mes), obtener_presupuestos(user_id)
+    ))
+
+    total_mes = sum(gastado.values())
+    texto_total = f"💰 Total gastado este mes: {formatear_pesos(total_mes)}"
+    resultados = [("total", InlineQueryResultArticle(
+        id="total",
+        title=texto_total,
+        input_message_content=InputTextMessageContent(texto_total)
+    ))]
+    for cat in sorted(set(gastado) | set(limites)):
+        gasto_cat = gastado.get(cat, 0)
+        limite = limites.get(cat)
+        if limite is None:
+            descripcion = f"Gastado: {formatear_pesos(gasto_cat)} (sin límite)"
+        else:
+            descripcion = f"Disponible: {formatear_pesos(limite - gasto_cat)} de {formatear_pesos(limite)}"
+        texto = f"📋 {cat.capitalize()} este mes\n• Gastado: {formatear_pesos(gasto_cat)}"
+        if limite is not None:
+            texto += f"\n• Límite: {formatear_pesos(limite)}\n• Disponible: {formatear_pesos(limite - gasto_cat)}"
+        resultados.append((cat, InlineQueryResultArticle(
+            id=f"cat:{cat}"[:64],
+            title=cat.capitalize(),
+            description=descripcion,
+            input_message_content=InputTextMessageContent(texto)
+        )))
+
+    respuestas_inline[user_id] = (now + timedelta(seconds=INLINE_CACHE_SEGUNDOS), resultados)
+    return resultados
+
+async def consulta_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    consulta = update.inline_query.query.strip().lower()
+    user_id = str(update.inline_query.from_user.id)
+    resultados = await resultados_inline(user_id)
+
+    if consulta:
+        resultados = [r for clave, r in resultados if clave.startswith(consulta)]
+    else:
+        resultados = [r for _, r in resultados]
+
+    # is_personal: Telegram guarda la respuesta por usuario y no vuelve a
+    # preguntarnos la misma consulta hasta que pase cache_time
+    await update.inline_query.answer(
+        resultados[:50],
+        cache_time=INLINE_CACHE_SEGUNDOS,
+        is_personal=True
+    )
+
+# --- Gastos recurrentes ---
+
+async def recurrente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    args = context.args or []
+
+    if not args:
+        reglas = await resiliencia.llamar("recurrentes", reglas_usuario, db, user_id)
+        if not reglas:
+            await responder(
+                update,
+                "🔁 No tienes gastos recurrentes.\n"
+                "Crea uno con `/recurrente [monto] [categoría] [día] [descripción]`, "
+                "por ejemplo `/recurrente 1.200.000 hogar 5 arriendo`.",
+                parse_mode="Markdown"
+            )
+            return
+        mensaje = "🔁 *Tus gastos recurrentes:*\n\n"
+        botones = []
+        for regla_id, r in reglas:
+            descripcion = f" ({r['t']})" if r.get("t") else ""
+            monto = formatear_moneda(r["m"], r["mo"]) if r.get("mo") else formatear_pesos(r["m"])
+            mensaje += f"• Día {r['d']}: {monto} en {r['c']}{descripcion}\n"
+            botones.append([InlineKeyboardButton(
+                f"🗑️ Día {r['d']} · {r['c']}", callback_data=f"rec_borrar:{regla_id}"
+            )])
+        await responder(update, mensaje, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(botones))
+        return
+
+    # Moneda opcional tras el monto: /recurrente 15 usd ocio 5 streaming
+    moneda = tabla_cambio.moneda_de(args[1]) if len(args) > 1 else None
+    if moneda == MONEDA_BASE:
+        moneda = None
+    if moneda:
+        args = [args[0]] + args[2:]
+    monto_texto = args[0].replace(".", "").replace(",", "")
+    if len(args) < 3 or not monto_texto.isdigit() or not args[2].isdigit() or not 1 <= int(args[2]) <= 31:
+        await responder(
+            update,
+            "❌ Uso: `/recurrente [monto] [categoría] [día] [descripción]`\n"
+            "Ej: `/recurrente 1.200.000 hogar 5 arriendo`",
+            parse_mode="Markdown"
+        )
+        return
+
+    monto, categoria, dia = int(monto_texto), args[1].lower(), int(args[2])
+    if moneda:
+        monto = leer_decimal(args[0])
+    descripcion = " ".join(args[3:]).lower()
+    # add() crea un id nuevo en cada intento: sin reintentos automáticos
+    await resiliencia.llamar(
+        "guardar_recurrente", guardar_regla, db, user_id, monto, categoria, dia, descripcion, moneda,
+        idempotente=False
+    )
+    monto_str = formatear_moneda(monto, moneda) if moneda else formatear_pesos(monto)
+    await responder(
+        update,
+        f"✅ Registraré *{monto_str}* en *{categoria}* el día {dia} de cada mes.",
+        parse_mode="Markdown"
+    )
+
+async def borrar_recurrente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    regla_id = query.data.split(":", 1)[1]
+    if await resiliencia.llamar("borrar_recurrente", borrar_regla, db, str(query.from_user.id), regla_id):
+        await respuestas.editar(update, "🗑️ Gasto recurrente eliminado.")
+    else:
+        await respuestas.editar(update, "⚠️ No se encontró ese gasto recurrente.")
+
+def cargar_zonas(user_ids):
+    # Las zonas que faltan en memoria, en una sola lectura
+    faltan = [u for u in set(user_ids) if u not in zonas_usuario]
+    if not faltan:
+        return
+    leidas = {}
+    for doc in db.get_all([db.collection("usuarios").document(u) for u in faltan]):
+        if doc.exists:
+            leidas[doc.id] = (doc.to_dict() or {}).get("zona_horaria")
+    for user_id in faltan:
+        zona = leidas.get(user_id)
+        zonas_usuario[user_id] = zona if zona in pytz.all_timezones_set else ZONA_POR_DEFECTO
+
+async def materializar_recurrentes(context: ContextTypes.DEFAULT_TYPE, instante=None):
+    # Cada regla vence en la fecha local de su dueño. En este instante esa
+    # fecha es una de dos (de UTC-12 a UTC+14); como el trabajo corre cada
+    # 24 horas, cada fecha local de cada usuario se procesa una sola vez.
+    instante = instante or datetime.datetime.now(pytz.utc)
+    fechas = sorted({(instante + timedelta(hours=h)).date() for h in (-12, 14)})
+    candidatas = []
+    for fecha in fechas:
+        reglas = await resiliencia.llamar("reglas_del_dia", reglas_del_dia, db, fecha)
+        candidatas += [(fecha, regla) for regla in reglas]
+    if not candidatas:
+        return
+
+    await resiliencia.llamar("zonas", cargar_zonas, [regla.get("u") for _, regla in candidatas])
+    por_zona = {}
+    for fecha, regla in candidatas:
+        hoy = instante.astimezone(zona_usuario(regla.get("u")))
+        if hoy.date() == fecha:
+            por_zona.setdefault(hoy.tzinfo.zone, (hoy, []))[1].append(regla)
+
+    # Ids deterministas por regla y mes: reintentar no duplica gastos
+    hoy_usuario = {}
+    creados = []
+    for hoy, reglas in por_zona.values():
+        creados_zona = await resiliencia.llamar(
+            "materializar", materializar, db, reglas, hoy, indice_diario, tabla_cambio,
+            idempotente=False, plazo=60
+        )
+        hoy_usuario.update((c[0], hoy) for c in creados_zona)
+        creados += creados_zona
+    log.info("gastos recurrentes registrados", extra={"creados": len(creados), "zonas": len(por_zona)})
+
+    por_usuario = {}
+    for user_id, gasto_id, monto, categoria, descripcion in creados:
+        cache_gastos.agregar(user_id, gasto_id, monto, categoria, hoy_usuario[user_id])
+        invalidar_inline(user_id)
+        por_usuario.setdefault(user_id, []).append((monto, categoria, descripcion))
+
+    # Una sola notificación por usuario, con todos sus recurrentes y los excesos
+    for user_id, gastos in por_usuario.items():
+        inicio_mes, _ = limites_mes(now=hoy_usuario[user_id])
+        mensaje = "🔁 *Gastos recurrentes registrados hoy:*\n\n"
+        for monto, categoria, descripcion in gastos:
+            detalle = f" ({descripcion})" if descripcion else ""
+            mensaje += f"• {formatear_pesos(monto)} en {categoria}{detalle}\n"
+
+        try:
+            limites = await resiliencia.llamar("presupuestos", lambda: {
+                doc.id: doc.to_dict().get("limite", 0)
+                for doc in db.collection("usuarios").document(user_id).collection("presupuestos").stream()
+            })
+            gastos_usuario = await resiliencia.llamar("gastos_recientes", gastos_recientes, user_id)
+            excesos = []
+            for categoria in sorted({cat for _, cat, _ in gastos}):
+                limite = limites.get(categoria)
+                gastado = gastos_usuario.total(desde=inicio_mes, categoria=categoria)
+                if limite is not None and gastado > limite:
+                    excesos.append(f"• {categoria}: {formatear_pesos(gastado)} de {formatear_pesos(limite)}")
+            if excesos:
+                mensaje += "\n⚠️ *Superaste tu presupuesto en:*\n" + "\n".join(excesos)
+
+            await canales.bot(context).send_message(chat_id=int(user_id), text=mensaje, parse_mode="Markdown")
+        except Exception as e:
+            log.warning("no se pudo notificar recurrentes", extra={"user_id": user_id, "error": repr(e)})
+
 async def iniciar_establecer_presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -718,7 +1726,8 @@ async def iniciar_establecer_presupuesto(update: Update, context: ContextTypes.D
 
     context.chat_data["conversation"] = "gasto"
     
-    await query.message.reply_text(
+    await responder(
+        update,
         f"✍️ ¿Cuál es el *límite mensual* para la categoría *{categoria}*?\n\n"
         f"Por ejemplo: `250.000`",
         parse_mode="Markdown"
@@ -732,46 +1741,137 @@ async def iniciar_establecer_presupuesto(update: Update, context: ContextTypes.D
 async def ignorar_presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("✅ Entendido. Puedes establecer un presupuesto en cualquier momento con /presupuesto.")
+    terminar_conversacion(context)
+    await respuestas.editar(update, "✅ Entendido. Puedes establecer un presupuesto en cualquier momento con /presupuesto.")
     return ConversationHandler.END
 
+# --- Fin de conversaciones y estado en memoria ---
 
-async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    docs = db.collection("usuarios").document(user_id).collection("gastos").stream()
+def terminar_conversacion(context: ContextTypes.DEFAULT_TYPE):
+    # Sin esto `conversation` queda en chat_data y handle_message ignora al chat
+    context.chat_data.pop("conversation", None)
+    for clave in ("gasto", "categoria_presupuesto", "nuevo_limite"):
+        context.user_data.pop(clave, None)
+
+def salir_de_flujo(context: ContextTypes.DEFAULT_TYPE, flujo):
+    # El flujo que termina, expira o es reemplazado no deja su marca: si otro
+    # flujo ya puso la suya (presupuesto tras gasto) se respeta
+    if context.chat_data.get("conversation") == flujo:
+        context.chat_data.pop("conversation", None)
+
+async def conversacion_expirada(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    terminar_conversacion(context)
+    if isinstance(update, Update) and (update.message or update.callback_query):
+        await responder(update, "⌛ La operación se canceló por inactividad. Puedes empezar de nuevo cuando quieras.")
+
+def reporte_memoria(app):
+    reporte = ciclo_estado.reporte(app)
+    reporte.update({
+        "rss_mb": round(rss_mb(), 1),
+        "cache_gastos": cache_gastos.estadisticas(),
+        "respuestas_inline": len(respuestas_inline),
+        "zonas_usuario": len(zonas_usuario),
+        "pronosticos": len(pronosticos),
+        "avisos_pronostico": len(avisos_pronostico),
+        "indice_descripciones": indice_descripciones.estadisticas(),
+        "indice_diario_anios": len(indice_diario),
+        "registro": registro.estado(),
+        "respuestas": respuestas.estado(),
+        "limitador": limitador.estadisticas(),
+        "conexiones": canales.estadisticas(),
+        "respaldos_resiliencia": resiliencia.estado()["respaldos"],
+    })
+    if coherencia:
+        reporte["coherencia"] = coherencia.estadisticas()
+    if bitacora:
+        reporte["bitacora"] = bitacora.estado()
+    return reporte
+
+async def barrer_estado(context: ContextTypes.DEFAULT_TYPE):
+    usuarios, chats = ciclo_estado.barrer(context.application)
+    now = datetime.datetime.now()
+    for uid in [u for u, (expira, _) in respuestas_inline.items() if expira <= now]:
+        del respuestas_inline[uid]
+    # Pronósticos de días anteriores y avisos de meses anteriores, con la
+    # zona ya conocida de cada usuario (sin leer el almacén)
+    def hoy_de(user_id):
+        return datetime.datetime.now(pytz.timezone(zonas_usuario.get(user_id, ZONA_POR_DEFECTO)))
+    for uid in [u for u, (fecha, _) in list(pronosticos.items()) if fecha != hoy_de(u).date()]:
+        pronosticos.pop(uid, None)
+    for uid in [u for u, (mes, _) in list(avisos_pronostico.items()) if mes != hoy_de(u).strftime("%Y-%m")]:
+        avisos_pronostico.pop(uid, None)
+    limitador.barrer()
+    log.info(
+        "estado descartado",
+        extra={"usuarios": usuarios, "chats": chats, "memoria": reporte_memoria(context.application)}
+    )
+
+async def memoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(str(update.effective_user.id)):
+        await responder(update, "❌ Comando no reconocido. Usa los botones o escribe /menu para ver opciones.")
+        return
+    reporte = reporte_memoria(context.application)
+    await responder(update, "🧠 Memoria:\n" + json.dumps(reporte, indent=1, ensure_ascii=False))
+
+async def lentos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(str(update.effective_user.id)):
+        await responder(update, "❌ Comando no reconocido. Usa los botones o escribe /menu para ver opciones.")
+        return
+    if not perfilador.activo:
+        await responder(update, "🐢 El perfilado está desactivado (PERFIL_FRACCION / PERFIL_LENTO_MS).")
+        return
+
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    peores = perfilador.mas_lentos(n)
+    mensaje = f"🐢 Updates más lentos (de los últimos {len(perfilador.recientes)}):\n"
+    for i, (ms, handler, llamadas, ms_almacen, archivo) in enumerate(peores, 1):
+        mensaje += f"\n{i}. {ms:.0f} ms · {handler} · {llamadas} llamadas al almacén ({ms_almacen:.0f} ms)"
+        if archivo:
+            mensaje += f"\n   {archivo}"
+
+    # Las pilas más frecuentes del más lento que quedó guardado con perfil
+    for _, _, _, _, archivo in peores:
+        if not archivo:
+            continue
+        captura = await asyncio.to_thread(perfilador.leer_captura, archivo)
+        if captura["perfil"]:
+            mensaje += f"\n\nPilas más frecuentes en {archivo}:"
+            for entrada in captura["perfil"][:3]:
+                hoja = " ← ".join(reversed(entrada["pila"].split(";")[-3:]))
+                mensaje += f"\n• {entrada['muestras']}× {hoja}"
+            break
+
+    mensaje += "\n\n" + json.dumps(perfilador.estado(), ensure_ascii=False)
+    await responder(update, mensaje)
+
+def resumen_por_categoria(user_id: str):
     resumen = {}
-    for doc in docs:
-        d = doc.to_dict()
+    for d in leer_gastos(user_id):
         resumen[d["categoria"]] = resumen.get(d["categoria"], 0) + d["monto"]
+    return resumen
+
+@limitador.limitar
+async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    resumen, antiguedad = await resiliencia.leer_con_respaldo(
+        ("resumen", user_id), "resumen", resumen_por_categoria, user_id, plazo=15
+    )
     if not resumen:
         await responder(update, "📭 No tienes gastos registrados.")
         return
     mensaje = "🧾 *Resumen de gastos:*\n\n"
     for cat, total in resumen.items():
         mensaje += f"• {cat}: ${total:,.0f}".replace(",", ".") + "\n"
-    await responder(update, mensaje, parse_mode="Markdown")
+    await responder(update, mensaje + aviso_respaldo(antiguedad), parse_mode="Markdown")
 
+@limitador.limitar
 async def comparar_categorias(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    tz = pytz.timezone("America/Bogota")
-    now = datetime.datetime.now(tz)
-    inicio_mes_actual = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    inicio_mes_anterior = (inicio_mes_actual - datetime.timedelta(days=1)).replace(day=1)
-
-    gastos_actual = db.collection("usuarios").document(user_id).collection("gastos") \
-        .where("fecha", ">=", inicio_mes_actual).stream()
-    gastos_anterior = db.collection("usuarios").document(user_id).collection("gastos") \
-        .where("fecha", ">=", inicio_mes_anterior).where("fecha", "<", inicio_mes_actual).stream()
+    inicio_mes_actual, inicio_mes_anterior = limites_mes(user_id)
 
-    def acumular_por_categoria(stream):
-        resumen = {}
-        for doc in stream:
-            d = doc.to_dict()
-            resumen[d.get("categoria", "otros")] = resumen.get(d.get("categoria", "otros"), 0) + d.get("monto", 0)
-        return resumen
-
-    actual = acumular_por_categoria(gastos_actual)
-    anterior = acumular_por_categoria(gastos_anterior)
+    gastos_usuario = await resiliencia.llamar("gastos_recientes", gastos_recientes, user_id)
+    actual = gastos_usuario.por_categoria(desde=inicio_mes_actual)
+    anterior = gastos_usuario.por_categoria(desde=inicio_mes_anterior, hasta=inicio_mes_actual)
 
     categorias = set(actual.keys()).union(anterior.keys())
     mensaje = "\ud83d\udcc8 *Comparativa mensual por categoría:*\n\n"
@@ -788,66 +1888,108 @@ async def comparar_categorias(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         mensaje += f"• {cat}: ${gasto_anterior:,.0f} → ${gasto_actual:,.0f} ({variacion})\n".replace(",", ".")
 
-    await update.message.reply_text(mensaje, parse_mode="Markdown")
+    await responder(update, mensaje, parse_mode="Markdown")
+
+# --- Totales por rango sobre el índice diario ---
+
+def variacion_str(actual, anterior):
+    if anterior <= 0:
+        return "🔹 sin dato anterior"
+    cambio = (actual - anterior) / anterior * 100
+    return f"{'🔺' if cambio > 0 else '🔻'} {abs(cambio):.1f}%"
+
+async def comparar_periodos(update: Update, user_id: str, desde, hasta):
+    # desde incluido, hasta excluido; se compara con el periodo anterior de igual duración
+    dias = (hasta - desde).days
+    anterior_desde = desde - timedelta(days=dias)
+    actual, anterior = await resiliencia.llamar("rango", lambda: (
+        indice_diario.por_categoria(user_id, desde, hasta),
+        indice_diario.por_categoria(user_id, anterior_desde, desde)
+    ))
+
+    fin = hasta - timedelta(days=1)
+    mensaje = f"📅 *Del {desde:%Y-%m-%d} al {fin:%Y-%m-%d}* ({dias} días)\n\n"
+    if not actual and not anterior:
+        await responder(update, mensaje + "📭 No hay gastos en ese periodo ni en el anterior.", parse_mode="Markdown")
+        return
+    for cat in sorted(set(actual) | set(anterior), key=lambda c: -actual.get(c, 0)):
+        mensaje += f"• {cat}: {formatear_pesos(actual.get(cat, 0))} ({variacion_str(actual.get(cat, 0), anterior.get(cat, 0))})\n"
+    total_actual, total_anterior = sum(actual.values()), sum(anterior.values())
+    mensaje += (
+        f"\n💰 *Total:* {formatear_pesos(total_actual)}\n"
+        f"Periodo anterior ({anterior_desde:%Y-%m-%d} a {desde - timedelta(days=1):%Y-%m-%d}): "
+        f"{formatear_pesos(total_anterior)} ({variacion_str(total_actual, total_anterior)})"
+    )
+    await responder(update, mensaje, parse_mode="Markdown")
+
+async def rango(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    args = context.args or []
+    try:
+        desde, fin = (datetime.date.fromisoformat(a) for a in args)
+    except ValueError:
+        desde = fin = None
+    if desde is None or fin < desde:
+        await responder(
+            update,
+            "📅 Uso: `/rango AAAA-MM-DD AAAA-MM-DD`\nEj: `/rango 2025-01-15 2025-03-10` (ambos días incluidos)",
+            parse_mode="Markdown"
+        )
+        return
+    await comparar_periodos(update, user_id, desde, fin + timedelta(days=1))
 
+@limitador.limitar
 async def comparar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    now = datetime.datetime.now(pytz.timezone("America/Bogota"))
-    inicio_mes = now.replace(day=1)
-    inicio_mes_anterior = (inicio_mes - datetime.timedelta(days=1)).replace(day=1)
-    docs_actual = db.collection("usuarios").document(user_id).collection("gastos") \
-        .where("fecha", ">=", inicio_mes).stream()
-    docs_anterior = db.collection("usuarios").document(user_id).collection("gastos") \
-        .where("fecha", ">=", inicio_mes_anterior).where("fecha", "<", inicio_mes).stream()
-    suma_actual = sum(doc.to_dict()["monto"] for doc in docs_actual)
-    suma_anterior = sum(doc.to_dict()["monto"] for doc in docs_anterior)
+    if context.args and context.args[0].isdigit() and int(context.args[0]) > 0:
+        # /comparar 30: últimos N días (incluido hoy) contra los N anteriores
+        hasta = ahora(user_id).date() + timedelta(days=1)
+        await comparar_periodos(update, user_id, hasta - timedelta(days=int(context.args[0])), hasta)
+        return
+    inicio_mes, inicio_mes_anterior = limites_mes(user_id)
+    gastos_usuario = await resiliencia.llamar("gastos_recientes", gastos_recientes, user_id)
+    suma_actual = gastos_usuario.total(desde=inicio_mes)
+    suma_anterior = gastos_usuario.total(desde=inicio_mes_anterior, hasta=inicio_mes)
     variacion = ((suma_actual - suma_anterior) / suma_anterior * 100) if suma_anterior > 0 else 0
     signo = "🔺" if variacion > 0 else "🔻"
     actual_str = f"${suma_actual:,.0f}".replace(",", ".")
     anterior_str = f"${suma_anterior:,.0f}".replace(",", ".")
     await responder(update, f"📊 Gasto mensual:\nEste mes: {actual_str}\nMes anterior: {anterior_str}\nVariación: {signo} {abs(round(variacion, 1))}%")
     
+@limitador.limitar
 async def total(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    docs = db.collection("usuarios").document(user_id).collection("gastos").stream()
-    total_gasto = sum(doc.to_dict()["monto"] for doc in docs)
-    await responder(update, f"💰 Total gastado: ${total_gasto:,.0f}".replace(",", "."))
+    inicio_mes, _ = limites_mes(user_id)
+    total_gasto, antiguedad = await resiliencia.leer_con_respaldo(
+        ("total", user_id), "total", lambda: gastos_recientes(user_id).total(desde=inicio_mes)
+    )
+    await responder(update, f"💰 Total gastado este mes: ${total_gasto:,.0f}".replace(",", ".") + aviso_respaldo(antiguedad))
 
 async def ultimo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    gastos = db.collection("usuarios").document(user_id).collection("gastos") \
-        .order_by("fecha", direction=firestore.Query.DESCENDING).limit(1).stream()
-    for g in gastos:
-        d = g.to_dict()
-        fecha_val = d["fecha"]
-        if isinstance(fecha_val, str):
-            fecha_val = parser.parse(fecha_val)  # convierte string a datetime
-
-        fecha_str = fecha_val.strftime("%Y-%m-%d %H:%M")
-        monto_formateado = formatear_pesos(d["monto"])
-        await responder(update, f"📌 Último gasto:\n{monto_formateado} en {d['categoria']} el {fecha_str}")
+    gasto = await resiliencia.llamar("ultimo_gasto", obtener_ultimo_gasto, user_id)
+    if gasto is None:
+        await responder(update, "📭 Aún no has registrado gastos.")
         return
-    await responder(update, "📭 Aún no has registrado gastos.")
+    _, monto, categoria, fecha_val = gasto
+    fecha_str = fecha_val.strftime("%Y-%m-%d %H:%M")
+    monto_formateado = formatear_pesos(monto)
+    await responder(update, f"📌 Último gasto:\n{monto_formateado} en {categoria} el {fecha_str}")
 
 async def eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    gastos = list(db.collection("usuarios").document(user_id).collection("gastos")
-        .order_by("fecha", direction=firestore.Query.DESCENDING).limit(1).stream())
-    if not gastos:
+    gasto = await resiliencia.llamar("ultimo_gasto", obtener_ultimo_gasto, user_id)
+    if gasto is None:
         await responder(update, "📭 No hay gastos para eliminar.")
         return
-    gasto = gastos[0]
-    d = gasto.to_dict()
-    context.user_data["ultimo_id"] = gasto.id
-    fecha_val = d["fecha"]
-    if isinstance(fecha_val, str):
-        fecha_val = parser.parse(fecha_val)
+    gasto_id, monto, categoria, fecha_val = gasto
+    context.user_data["ultimo_id"] = gasto_id
 
     fecha_str = fecha_val.strftime("%Y-%m-%d %H:%M")
     
-    monto_formateado = formatear_pesos(d["monto"])
+    monto_formateado = formatear_pesos(monto)
 
-    msg = f"❗ ¿Deseas eliminar el último gasto?\n\n💸 {monto_formateado} en {d['categoria']} el {fecha_str}"
+    msg = f"❗ ¿Deseas eliminar el último gasto?\n\n💸 {monto_formateado} en {categoria} el {fecha_str}"
 
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Sí", callback_data="confirmar_eliminar")],
@@ -856,6 +1998,21 @@ async def eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await responder(update, msg, reply_markup=keyboard)
 
 
+def borrar_gasto(user_id: str, gasto_id: str):
+    gasto_ref = db.collection("usuarios").document(user_id).collection("gastos").document(gasto_id)
+    doc = gasto_ref.get()
+    if not doc.exists:
+        return False
+    d = doc.to_dict()
+    fecha_val = d["fecha"]
+    if isinstance(fecha_val, str):
+        fecha_val = parser.parse(fecha_val)
+    lote = db.batch()
+    lote.delete(gasto_ref)
+    indice_diario.registrar(lote, user_id, d["categoria"], fecha_val, -d["monto"])
+    lote.commit()
+    return True
+
 async def callback_confirmar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -863,21 +2020,221 @@ async def callback_confirmar(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if query.data == "confirmar_eliminar":
         gasto_id = context.user_data.get("ultimo_id")
         if gasto_id:
-            db.collection("usuarios").document(user_id).collection("gastos").document(gasto_id).delete()
-            await query.edit_message_text("✅ Gasto eliminado correctamente.")
+            # Borrarlo antes de que el volcador lo lleve a Firestore no encontraría
+            # nada, y el volcado lo haría reaparecer
+            if bitacora is not None and not await bitacora.esperar(gasto_id, resiliencia.plazo):
+                await respuestas.editar(update, "⏳ Ese gasto aún no llega al almacén. Inténtalo de nuevo en un momento.")
+                return
+            try:
+                borrado = await resiliencia.llamar("eliminar_gasto", borrar_gasto, user_id, gasto_id, idempotente=False)
+            except AlmacenNoDisponible:
+                indice_diario.invalidar(user_id)
+                raise
+            cache_gastos.eliminar(user_id, gasto_id)
+            invalidar_inline(user_id)
             context.user_data.pop("ultimo_id", None)
+            if borrado:
+                await respuestas.editar(update, "✅ Gasto eliminado correctamente.")
+            else:
+                await respuestas.editar(update, "⚠️ No se encontró el gasto a eliminar.")
         else:
-            await query.edit_message_text("⚠️ No se encontró el gasto a eliminar.")
+            await respuestas.editar(update, "⚠️ No se encontró el gasto a eliminar.")
     elif query.data == "cancelar_eliminar":
-        await query.edit_message_text("❌ Eliminación cancelada.")
+        await respuestas.editar(update, "❌ Eliminación cancelada.")
         context.user_data.pop("ultimo_id", None)
 
+# --- Historial: /historial con selección múltiple y borrado en lote ---
+
+async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    context.user_data["historial"] = {"pagina": [], "siguiente": None, "seleccion": {}}
+    await cargar_pagina_historial(update, context, user_id, None)
+
+async def cargar_pagina_historial(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str, cursor, aviso=""):
+    gastos, siguiente = await resiliencia.llamar("historial", pagina_historial, db, user_id, cursor)
+    estado = context.user_data.setdefault("historial", {"seleccion": {}})
+    estado["pagina"] = [
+        (gasto_id, {k: d.get(k) for k in ("monto", "categoria", "descripcion", "fecha")})
+        for gasto_id, d in gastos
+    ]
+    estado["siguiente"] = siguiente
+    estado["primera"] = cursor is None
+    await mostrar_historial(update, user_id, estado, aviso)
+
+async def mostrar_historial(update: Update, user_id: str, estado: dict, aviso=""):
+    tz = zona_usuario(user_id)
+    seleccion = estado["seleccion"]
+
+    if not estado["pagina"]:
+        texto = "📭 No hay gastos registrados." if estado["primera"] else "📭 No hay gastos más antiguos."
+    else:
+        texto = "🗂️ *Historial de gastos*\nToca un gasto para seleccionarlo."
+    if not estado["siguiente"]:
+        texto += f"\n\n{AVISO_ARCHIVO}"
+    if aviso:
+        texto = f"{aviso}\n\n{texto}"
+    if seleccion:
+        total_sel = sum(g["monto"] for g in seleccion.values())
+        texto += f"\n\n☑️ Seleccionados: {len(seleccion)} ({formatear_pesos(total_sel)})"
+
+    filas = []
+    for gasto_id, d in estado["pagina"]:
+        marca = "☑️" if gasto_id in seleccion else "⬜"
+        etiqueta = f"{marca} {d['fecha'].astimezone(tz):%m-%d} {formatear_pesos(d['monto'])} {d['categoria']}"
+        if d.get("descripcion"):
+            etiqueta += f" · {d['descripcion'][:20]}"
+        filas.append([InlineKeyboardButton(etiqueta, callback_data=f"his:s:{gasto_id}")])
+
+    navegacion = []
+    if not estado["primera"]:
+        navegacion.append(InlineKeyboardButton("⏮️ Recientes", callback_data="his:p"))
+    if estado["siguiente"]:
+        epoch_us, gasto_id = estado["siguiente"]
+        navegacion.append(InlineKeyboardButton("Más antiguos ▶️", callback_data=f"his:p:{epoch_us}:{gasto_id}"))
+    if navegacion:
+        filas.append(navegacion)
+    if seleccion:
+        filas.append([InlineKeyboardButton(f"🗑️ Eliminar ({len(seleccion)})", callback_data="his:del")])
+
+    reply_markup = InlineKeyboardMarkup(filas) if filas else None
+    if update.callback_query:
+        await respuestas.editar(update, texto, parse_mode="Markdown", reply_markup=reply_markup)
+    else:
+        await responder(update, texto, parse_mode="Markdown", reply_markup=reply_markup)
+
+async def callback_historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = str(query.from_user.id)
+    partes = query.data.split(":", 3)
+    accion = partes[1]
+
+    estado = context.user_data.get("historial")
+    if estado is None:
+        await respuestas.editar(update, "⚠️ Este historial expiró. Vuelve a usar /historial.")
+        return
+
+    if accion == "p":
+        cursor = (int(partes[2]), partes[3]) if len(partes) == 4 else None
+        await cargar_pagina_historial(update, context, user_id, cursor)
+
+    elif accion == "s":
+        # Alternar la selección no consulta Firestore: se redibuja la página guardada
+        gasto_id = partes[2]
+        if gasto_id in estado["seleccion"]:
+            del estado["seleccion"][gasto_id]
+        else:
+            datos = dict(estado["pagina"]).get(gasto_id)
+            if datos is not None:
+                estado["seleccion"][gasto_id] = datos
+        await mostrar_historial(update, user_id, estado)
+
+    elif accion == "del":
+        seleccion = estado["seleccion"]
+        total_sel = sum(g["monto"] for g in seleccion.values())
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Sí, eliminar", callback_data="his:ok")],
+            [InlineKeyboardButton("❌ No", callback_data="his:volver")]
+        ])
+        await respuestas.editar(
+            update,
+            f"❗ ¿Eliminar {len(seleccion)} gastos por {formatear_pesos(total_sel)}?",
+            reply_markup=keyboard
+        )
+
+    elif accion == "volver":
+        await mostrar_historial(update, user_id, estado)
+
+    elif accion == "ok":
+        seleccion = estado["seleccion"]
+        if not seleccion:
+            await mostrar_historial(update, user_id, estado)
+            return
+        try:
+            eliminados = await resiliencia.llamar(
+                "eliminar_gastos", eliminar_gastos, db, user_id, seleccion, indice_descripciones, indice_diario,
+                idempotente=False, plazo=30
+            )
+        except AlmacenNoDisponible:
+            # Parte de los lotes pudo quedar sin escribir: los índices se releen
+            indice_descripciones.olvidar(user_id)
+            indice_diario.invalidar(user_id)
+            raise
+        # Los totales derivados se ajustan una sola vez por borrado
+        cache_gastos.eliminar_varios(user_id, eliminados)
+        invalidar_inline(user_id)
+        total_sel = sum(g["monto"] for g in seleccion.values())
+        estado["seleccion"] = {}
+        aviso = f"✅ Eliminé {len(eliminados)} gastos por {formatear_pesos(total_sel)}."
+        await cargar_pagina_historial(update, context, user_id, None, aviso)
+
+# --- Envíos programados repartidos por zona horaria y minuto ---
+#
+# Cada usuario cae en un bucket (zona, minuto): su zona horaria y un minuto
+# fijo dentro de MINUTOS_VENTANA_ENVIO derivado de su id. Cada bucket tiene su
+# propio job que solo procesa a sus usuarios a la hora local de envío, así la
+# carga sobre Firestore y Telegram se reparte a lo largo del día.
+
+indice_envios = {}
+bucket_de_usuario = {}
+
+def minuto_envio(user_id: str):
+    return zlib.crc32(user_id.encode()) % MINUTOS_VENTANA_ENVIO
+
+def programar_bucket(job_queue, clave):
+    zona, minuto = clave
+    tz = pytz.timezone(zona)
+    job_queue.run_daily(
+        enviar_resumen_automatico,
+        time=time(hour=11, minute=minuto, tzinfo=tz),
+        days=(6,),  # Solo domingos
+        data=clave,
+        name=f"resumen:{zona}:{minuto}"
+    )
+    job_queue.run_monthly(
+        enviar_reporte_mensual,
+        when=time(hour=10, minute=minuto, tzinfo=tz),
+        day=1,
+        data=clave,
+        name=f"mensual:{zona}:{minuto}"
+    )
+
+def registrar_envio(job_queue, user_id: str, zona: str):
+    zonas_usuario[user_id] = zona
+    anterior = bucket_de_usuario.get(user_id)
+    if anterior is not None:
+        indice_envios[anterior].discard(user_id)
+
+    clave = (zona, minuto_envio(user_id))
+    if clave not in indice_envios:
+        indice_envios[clave] = set()
+        programar_bucket(job_queue, clave)
+    indice_envios[clave].add(user_id)
+    bucket_de_usuario[user_id] = clave
+
+def cargar_indice_envios(job_queue):
+    usuarios = db.collection("usuarios").select(["zona_horaria"]).stream()
+    for usuario in usuarios:
+        zona = (usuario.to_dict() or {}).get("zona_horaria")
+        registrar_envio(job_queue, usuario.id, zona if zona in pytz.all_timezones_set else ZONA_POR_DEFECTO)
+    log.info("índice de envíos cargado", extra={"usuarios": len(bucket_de_usuario), "buckets": len(indice_envios)})
+
+async def usuarios_del_bucket(clave):
+    user_ids = list(indice_envios.get(clave, ()))
+    if not user_ids:
+        return []
+    refs = [db.collection("usuarios").document(u) for u in user_ids]
+    docs = await resiliencia.llamar("usuarios_bucket", lambda: list(db.get_all(refs)), plazo=30)
+    return [doc for doc in docs if doc.exists]
+
 async def enviar_resumen_automatico(context: ContextTypes.DEFAULT_TYPE):   
-    print("⌛ Ejecutando resumen automático...")
+    zona, minuto = context.job.data
+    log.info("resumen automático", extra={"zona": zona, "minuto": minuto})
 
-    application = context.application
-    usuarios_ref = await asyncio.to_thread(lambda: list(db.collection("usuarios").stream()))
-    now = datetime.datetime.now(pytz.timezone("America/Bogota"))
+    bot_envios = canales.bot(context)
+    usuarios_ref = await usuarios_del_bucket(context.job.data)
+    tz = pytz.timezone(zona)
+    now = datetime.datetime.now(tz)
 
     for usuario in usuarios_ref:
         user_id = usuario.id
@@ -885,37 +2242,35 @@ async def enviar_resumen_automatico(context: ContextTypes.DEFAULT_TYPE):
         fecha_inicio = datos_usuario.get("fecha_inicio")
 
         if not fecha_inicio:
-            print(f"⚠️ Usuario {user_id} no tiene fecha de inicio registrada.")
+            log.warning("usuario sin fecha de inicio", extra={"user_id": user_id})
             continue
 
         # Convertir a datetime si es timestamp
         if isinstance(fecha_inicio, float):
-            fecha_inicio = datetime.datetime.fromtimestamp(fecha_inicio, tz=pytz.timezone("America/Bogota"))
+            fecha_inicio = datetime.datetime.fromtimestamp(fecha_inicio, tz=tz)
         elif isinstance(fecha_inicio, datetime.datetime):
-            fecha_inicio = fecha_inicio.astimezone(pytz.timezone("America/Bogota"))
+            fecha_inicio = fecha_inicio.astimezone(tz)
         else:
-            print(f"⚠️ Formato de fecha inválido para {user_id}")
+            log.warning("fecha de inicio inválida", extra={"user_id": user_id})
             continue
 
         # Ejecutar solo el día 1 de cada trimestre contado desde la fecha de inicio
         if now.day == 1:
             meses_transcurridos = (now.year - fecha_inicio.year) * 12 + (now.month - fecha_inicio.month)
             if meses_transcurridos % 3 == 0:
-                await enviar_reporte_trimestral(user_id, now, application.bot)
+                await enviar_reporte_trimestral(user_id, now, bot_envios)
 
         # Obtener gastos
         try:
-            docs = await asyncio.to_thread(
-                lambda: list(db.collection("usuarios").document(user_id).collection("gastos").stream())
-            )
+            docs = await resiliencia.llamar("leer_gastos", lambda: list(leer_gastos(user_id)), plazo=30)
         except Exception as e:
-            print(f"❌ Error al obtener gastos de {user_id}: {e}")
+            log.error("no se pudieron obtener gastos", extra={"user_id": user_id, "error": repr(e)})
             continue
 
         # Obtener límites desde /presupuestos/{categoria}
         try:
-            limites_docs = await asyncio.to_thread(
-                lambda: list(db.collection("usuarios").document(user_id).collection("presupuestos").stream())
+            limites_docs = await resiliencia.llamar(
+                "presupuestos", lambda: list(db.collection("usuarios").document(user_id).collection("presupuestos").stream())
             )
             limites = {}
             for doc in limites_docs:
@@ -925,13 +2280,12 @@ async def enviar_resumen_automatico(context: ContextTypes.DEFAULT_TYPE):
                 if isinstance(limite, (int, float)):
                     limites[categoria] = limite
         except Exception as e:
-            print(f"⚠️ No se pudieron obtener límites para {user_id}: {e}")
+            log.warning("no se pudieron obtener límites", extra={"user_id": user_id, "error": repr(e)})
             limites = {}
 
         # Calcular gastos por categoría
         resumen = {}
-        for doc in docs:
-            d = doc.to_dict()
+        for d in docs:
             categoria = d.get("categoria")
             monto = d.get("monto", 0)
             if categoria and isinstance(monto, (int, float)):
@@ -960,22 +2314,25 @@ async def enviar_resumen_automatico(context: ContextTypes.DEFAULT_TYPE):
 
         # Enviar mensaje
         try:
-            await application.bot.send_message(
+            await bot_envios.send_message(
                 chat_id=int(user_id),
                 text=mensaje,
                 parse_mode="Markdown"
             )
         except Exception as e:
-            print(f"❌ No se pudo enviar resumen a {user_id}: {type(e).__name__} - {e}")
+            log.warning("no se pudo enviar resumen", extra={"user_id": user_id, "error": repr(e)})
 
 
+@limitador.limitar
 async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    gastos = db.collection("usuarios").document(user_id).collection("gastos").stream()
-    resumen = {}
-    for doc in gastos:
-        d = doc.to_dict()
-        resumen[d["categoria"]] = resumen.get(d["categoria"], 0) + d["monto"]
+    tipo = context.args[0].lower() if context.args else "pastel"
+
+    if tipo == "tendencia":
+        await grafico_tendencia(update, user_id)
+        return
+
+    resumen = await resiliencia.llamar("grafico", resumen_por_categoria, user_id, plazo=15)
     if not resumen:
         await responder(update, "📭 No tienes datos suficientes para generar el gráfico.")
         return
@@ -983,17 +2340,108 @@ async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     categorias = list(resumen.keys())
     valores = list(resumen.values())
 
-    plt.figure(figsize=(6, 6))
-    plt.pie(valores, labels=categorias, autopct="%1.1f%%", startangle=90)
-    plt.title("Distribución de gastos por categoría")
-    plt.tight_layout()
+    # Dibujar también sale del event loop
+    if tipo == "barras":
+        buf = await asyncio.to_thread(renderizar, "barras", categorias, valores, "Gastos por categoría")
+    else:
+        buf = await asyncio.to_thread(
+            renderizar, "pastel", categorias, valores, "Distribución de gastos por categoría"
+        )
+
+    await responder_foto(update, buf)
 
-    buf = BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
+def gasto_por_mes(user_id: str, desde, tz):
+    por_mes = {}
+    for d in leer_gastos(user_id, desde=desde):
+        fecha_val = d["fecha"]
+        if isinstance(fecha_val, str):
+            fecha_val = parser.parse(fecha_val)
+        mes = fecha_val.astimezone(tz).strftime("%Y-%m")
+        por_mes[mes] = por_mes.get(mes, 0) + d["monto"]
+    return por_mes
+
+async def grafico_tendencia(update: Update, user_id: str, meses: int = 6):
+    tz = zona_usuario(user_id)
+    inicio, _ = limites_mes(user_id)
+    for _ in range(meses - 1):
+        _, inicio = limites_mes(now=inicio)
+
+    por_mes = await resiliencia.llamar("grafico_tendencia", gasto_por_mes, user_id, inicio, tz, plazo=15)
+    if not por_mes:
+        await responder(update, "📭 No tienes datos suficientes para generar el gráfico.")
+        return
 
+    etiquetas = sorted(por_mes)
+    buf = await asyncio.to_thread(
+        renderizar, "tendencia", etiquetas, [por_mes[m] for m in etiquetas], "Gasto mensual"
+    )
     await responder_foto(update, buf)
 
+def rango_periodo(periodo: str, user_id: str):
+    inicio_mes, inicio_mes_anterior = limites_mes(user_id)
+    if periodo == "mes":
+        return inicio_mes, None
+    if periodo == "anterior":
+        return inicio_mes_anterior, inicio_mes
+    if periodo == "todo":
+        return None, None
+
+    tz = zona_usuario(user_id)
+    try:
+        if re.fullmatch(r"\d{4}-\d{2}", periodo):
+            desde = tz.localize(datetime.datetime.strptime(periodo, "%Y-%m"))
+            return desde, tz.localize((desde.replace(tzinfo=None) + timedelta(days=32)).replace(day=1))
+        if re.fullmatch(r"\d{4}", periodo):
+            anio = int(periodo)
+            return tz.localize(datetime.datetime(anio, 1, 1)), tz.localize(datetime.datetime(anio + 1, 1, 1))
+    except ValueError:
+        pass
+    return None
+
+async def exportar_gastos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    args = [a.lower() for a in (context.args or [])]
+    periodo = args[0] if args else "mes"
+    formato = args[1] if len(args) > 1 else "csv"
+    if periodo in FORMATOS and len(args) == 1:
+        periodo, formato = "mes", periodo
+
+    rango = rango_periodo(periodo, user_id)
+    if rango is None or formato not in FORMATOS:
+        await responder(
+            update,
+            "❌ Uso: `/exportar [periodo] [formato]`\n"
+            "• periodo: `mes`, `anterior`, `todo`, `2025` o `2025-03`\n"
+            "• formato: `csv`, `xlsx` o `parquet`",
+            parse_mode="Markdown"
+        )
+        return
+
+    desde, hasta = rango
+    nombre = f"gastos_{periodo}.{formato}"
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, nombre)
+        try:
+            filas = await resiliencia.llamar(
+                "exportar", exportar_usuario, db, user_id, ruta, formato, desde, hasta,
+                idempotente=False, plazo=300
+            )
+        except ImportError as e:
+            log.error("formato de exportación no disponible", extra={"formato": formato, "error": str(e)})
+            await responder(update, f"⚠️ El formato {formato} no está disponible en este momento.")
+            return
+
+        if not filas:
+            await responder(update, "📭 No tienes gastos en ese periodo.")
+            return
+
+        await respuestas.enviar_pendientes(update)
+        with open(ruta, "rb") as archivo:
+            if update.message:
+                await update.message.reply_document(archivo, filename=nombre, caption=f"📤 {filas} gastos exportados")
+            elif update.callback_query:
+                await update.callback_query.message.reply_document(archivo, filename=nombre, caption=f"📤 {filas} gastos exportados")
+
 def detectar_aumento_inusual(actual, anterior):
     alertas = []
     for cat in actual:
@@ -1007,19 +2455,14 @@ def detectar_aumento_inusual(actual, anterior):
     return alertas
 
 def detectar_excesos_frecuentes(user_id: str, now: datetime.datetime, meses: int = 3):
-    tz = pytz.timezone("America/Bogota")
     categoria_excesos = {}
 
     for i in range(1, meses + 1):
         inicio = (now.replace(day=1) - timedelta(days=30 * i)).replace(day=1)
         fin = (inicio + timedelta(days=32)).replace(day=1)
 
-        gastos = db.collection("usuarios").document(user_id).collection("gastos") \
-            .where("fecha", ">=", inicio).where("fecha", "<", fin).stream()
-
         gastos_por_categoria = {}
-        for doc in gastos:
-            d = doc.to_dict()
+        for d in leer_gastos(user_id, inicio, fin):
             cat = d.get("categoria")
             monto = d.get("monto", 0)
             if cat:
@@ -1038,89 +2481,81 @@ def detectar_excesos_frecuentes(user_id: str, now: datetime.datetime, meses: int
     # Devolver solo las categorías con al menos 2 excesos
     return [cat for cat, veces in categoria_excesos.items() if veces >= 2]
 
+def armar_reporte_mensual(user_id: str, now):
+    inicio_mes_actual, inicio_mes_anterior = limites_mes(now=now)
+    fin_mes_anterior = inicio_mes_actual
+
+    resumen_actual = {}
+    resumen_anterior = {}
+
+    for d in leer_gastos(user_id, inicio_mes_actual, now):
+        resumen_actual[d["categoria"]] = resumen_actual.get(d["categoria"], 0) + d.get("monto", 0)
+    for d in leer_gastos(user_id, inicio_mes_anterior, fin_mes_anterior):
+        resumen_anterior[d["categoria"]] = resumen_anterior.get(d["categoria"], 0) + d.get("monto", 0)
+
+    alertas = detectar_aumento_inusual(resumen_actual, resumen_anterior)
+    excesos_frecuentes = detectar_excesos_frecuentes(user_id, now)
+
+    # Mostrar mensaje solo si hay algo relevante que notificar
+    if not (alertas or excesos_frecuentes):
+        return None
+    mensaje = f"📈 *Resumen de gastos del {inicio_mes_actual.strftime('%d/%m')} al {now.strftime('%d/%m')}*\n\n"
+
+    if alertas:
+        mensaje += "🚨 Detectamos aumentos inusuales en estas categorías:\n"
+        for alerta in alertas:
+            mensaje += f"• {alerta}\n"
+
+    if excesos_frecuentes:
+        mensaje += "\n🔁 *Excesos frecuentes detectados en los últimos 3 meses:*\n"
+        for cat in excesos_frecuentes:
+            mensaje += f"• {cat.capitalize()}\n"
+    return mensaje
+
 async def enviar_reporte_mensual(context: ContextTypes.DEFAULT_TYPE):
-    print("📆 Ejecutando reporte mensual")
+    zona, minuto = context.job.data
+    log.info("reporte mensual", extra={"zona": zona, "minuto": minuto})
 
-    application = context.application
-    now = datetime.datetime.now(pytz.timezone("America/Bogota"))
+    bot_envios = canales.bot(context)
+    now = datetime.datetime.now(pytz.timezone(zona))
 
-    usuarios_ref = await asyncio.to_thread(lambda: list(db.collection("usuarios").stream()))
+    usuarios_ref = await usuarios_del_bucket(context.job.data)
 
     for usuario in usuarios_ref:
         user_id = usuario.id
 
         try:
-            inicio_mes_actual = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            inicio_mes_anterior = (inicio_mes_actual - timedelta(days=1)).replace(day=1)
-            fin_mes_anterior = inicio_mes_actual
-
-            gastos_actuales = db.collection("usuarios").document(user_id).collection("gastos") \
-                .where("fecha", ">=", inicio_mes_actual).where("fecha", "<", now).stream()
-            gastos_anteriores = db.collection("usuarios").document(user_id).collection("gastos") \
-                .where("fecha", ">=", inicio_mes_anterior).where("fecha", "<", fin_mes_anterior).stream()
-
-            resumen_actual = {}
-            resumen_anterior = {}
-
-            for doc in gastos_actuales:
-                d = doc.to_dict()
-                resumen_actual[d["categoria"]] = resumen_actual.get(d["categoria"], 0) + d.get("monto", 0)
-            for doc in gastos_anteriores:
-                d = doc.to_dict()
-                resumen_anterior[d["categoria"]] = resumen_anterior.get(d["categoria"], 0) + d.get("monto", 0)
-
-            alertas = detectar_aumento_inusual(resumen_actual, resumen_anterior)
-            excesos_frecuentes = detectar_excesos_frecuentes(user_id, now)
-
-            # Mostrar mensaje solo si hay algo relevante que notificar
-            if alertas or excesos_frecuentes:
-                mensaje = f"📈 *Resumen de gastos del {inicio_mes_actual.strftime('%d/%m')} al {now.strftime('%d/%m')}*\n\n"
-
-                if alertas:
-                    mensaje += "🚨 Detectamos aumentos inusuales en estas categorías:\n"
-                    for alerta in alertas:
-                        mensaje += f"• {alerta}\n"
-
-                if excesos_frecuentes:
-                    mensaje += "\n🔁 *Excesos frecuentes detectados en los últimos 3 meses:*\n"
-                    for cat in excesos_frecuentes:
-                        mensaje += f"• {cat.capitalize()}\n"
-
-                await application.bot.send_message(
+            # Las lecturas de Firestore van en el pool del almacén, no en el event loop
+            mensaje = await resiliencia.llamar("reporte_mensual", armar_reporte_mensual, user_id, now, plazo=60)
+            if mensaje:
+                await bot_envios.send_message(
                     chat_id=int(user_id),
                     text=mensaje,
                     parse_mode="Markdown"
                 )
 
         except Exception as e:
-            print(f"❌ Error al generar reporte mensual para {user_id}: {e}")
+            log.exception("error al generar reporte mensual", extra={"user_id": user_id})
 
 
-async def enviar_reporte_trimestral(user_id, now, bot): 
-    if now.month % 3 != 0 or now.day != 1:
-        return
-
+def armar_reporte_trimestral(user_id, now):
     usuario_doc = db.collection("usuarios").document(user_id).get()
     if not usuario_doc.exists:
-        return
+        return None
 
     fecha_inicio = usuario_doc.to_dict().get("fecha_inicio")
     if not fecha_inicio:
-        return
+        return None
 
     meses_transcurridos = (now.year - fecha_inicio.year) * 12 + (now.month - fecha_inicio.month)
     if meses_transcurridos % 3 != 0:
-        return
+        return None
 
     categoria_gastos = {}
     for i in range(3, 0, -1):
         inicio = (now.replace(day=1) - timedelta(days=30 * i)).replace(day=1)
         fin = (inicio + timedelta(days=32)).replace(day=1)
-        gastos = db.collection("usuarios").document(user_id).collection("gastos") \
-            .where("fecha", ">=", inicio).where("fecha", "<", fin).stream()
-
-        for g in gastos:
-            d = g.to_dict()
+        for d in leer_gastos(user_id, inicio, fin):
             cat = d.get("categoria")
             if cat:
                 categoria_gastos.setdefault(cat, []).append(d.get("monto", 0))
@@ -1132,7 +2567,16 @@ async def enviar_reporte_trimestral(user_id, now, bot):
             if alerta:
                 mensaje += f"• {alerta}\n"
 
-    if mensaje.strip() != "📊 *Revisión trimestral de hábitos de gasto*":
+    if mensaje.strip() == "📊 *Revisión trimestral de hábitos de gasto*":
+        return None
+    return mensaje
+
+async def enviar_reporte_trimestral(user_id, now, bot): 
+    if now.month % 3 != 0 or now.day != 1:
+        return
+
+    mensaje = await resiliencia.llamar("reporte_trimestral", armar_reporte_trimestral, user_id, now, plazo=60)
+    if mensaje:
         await bot.send_message(
             chat_id=int(user_id),
             text=mensaje,
@@ -1145,178 +2589,234 @@ async def comando_desconocido(update: Update, context: ContextTypes.DEFAULT_TYPE
     await responder(update, "❌ Comando no reconocido. Usa los botones o escribe /menu para ver opciones.")
     await mostrar_menu(update, context)
 
-# --- Main ---
-def main():
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Conversación para establecer presupuesto
-    conv_presupuesto = ConversationHandler(
-        entry_points=[
-                CommandHandler("presupuesto", presupuesto),
-                MessageHandler(filters.TEXT & filters.Regex("^💼 Presupuesto$"), presupuesto),
-                CallbackQueryHandler(presupuesto, pattern="^menu:presupuesto$")
-        ],
-        states={
-            ESCOGER_CATEGORIA: [
-                CallbackQueryHandler(escoger_categoria, pattern=r"^cat:.*"),
-                CallbackQueryHandler(seleccionar_categoria_presupuesto, pattern=r"^catref:personalizada$"), 
-                CallbackQueryHandler(cancelar_presupuesto, pattern="^cancelar_presupuesto$")
-            ],
-            ESPECIFICAR_CATEGORIA_PERSONALIZADA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_categoria_personalizada_presupuesto)
-            ],
-            ESPECIFICAR_LIMITE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, especificar_limite),
-                CallbackQueryHandler(reintentar_especificar_limite, pattern="^reintentar_limite$"),
-                CallbackQueryHandler(cancelar_presupuesto, pattern="^cancelar_presupuesto$")
-            ],
-            PREGUNTAR_ACCION_POST_PRESUPUESTO: [
-                CallbackQueryHandler(manejar_accion_post_presupuesto),
-                CallbackQueryHandler(iniciar_establecer_presupuesto, pattern=r"^establecer_presupuesto:.+"),
-                CallbackQueryHandler(ignorar_presupuesto, pattern=r"^ignorar_presupuesto$")
-            ],
-            CONFIRMAR_SOBREESCRITURA: [
-                CallbackQueryHandler(confirmar_reemplazo, pattern="^confirmar_reemplazo$"),
-                CallbackQueryHandler(cancelar_reemplazo, pattern="^cancelar_reemplazo$")
-            ],
-            ESPERANDO_CATEGORIA_CONSULTA: [
-                CallbackQueryHandler(responder_consulta_presupuesto, pattern=r"^consulta_categoria:.+")
-            ]    
-        },
-        fallbacks=[CommandHandler("menu", mostrar_menu),
-                   CommandHandler("ultimo", ultimo),
-                   CommandHandler("total", total),
-                   CommandHandler("resumen", resumen),
-                   CommandHandler("grafico", grafico),
-                   CommandHandler("comparar", comparar),
-                   CommandHandler("eliminar", eliminar),
-                   CommandHandler("cancelar", cancelar_presupuesto), 
-                   MessageHandler(filters.COMMAND, cancelar_presupuesto),
-                   CallbackQueryHandler(cancelar_presupuesto, pattern=r"^cancelar_presupuesto$") ],
-        per_chat=True
+async def manejar_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(context.error, AlmacenNoDisponible):
+        log.warning("almacén no disponible", extra={"error": str(context.error)})
+        if isinstance(update, Update) and (update.message or update.callback_query):
+            try:
+                await responder(update, "⚠️ El almacén de datos no responde. Inténtalo de nuevo en un momento.")
+            except Exception as e:
+                log.warning("no se pudo avisar al usuario", extra={"error": repr(e)})
+        return
+    log.error("error no manejado", exc_info=context.error)
+
+async def reportar_resiliencia(context: ContextTypes.DEFAULT_TYPE):
+    extra = {"estado": resiliencia.estado(), "registro": registro.estado()}
+    if bitacora:
+        extra["bitacora"] = bitacora.estado()
+    log.info("resiliencia", extra=extra)
+
+# --- Tablas de despacho ---
+
+# Comandos que se atienden sin salir de un flujo de presupuesto o de gasto
+COMANDOS_EN_FLUJO = {"menu", "ultimo", "total", "resumen", "grafico", "comparar", "eliminar"}
+
+def construir_despachador():
+    despachador = Despachador(
+        texto=handle_message,
+        flujo_texto="gasto",
+        comando_desconocido=comando_desconocido,
+        respaldo_callback=callback_confirmar,  # confirmar/cancelar eliminación y cualquier botón viejo
+        inline=consulta_inline,
+        plazo=CONVERSACION_TIMEOUT,
+        al_expirar=conversacion_expirada,
+        al_salir=salir_de_flujo
     )
 
-    gasto_categoria_handler = ConversationHandler(
-        entry_points=[
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message) # <- Aquí sí se activa bien el flujo
-
-        ],
-        states={
-            HANDLE_GASTO_CATEGORIA: [
-                CallbackQueryHandler(seleccionar_categoria_ref, pattern=r"^catref:.*"),
-                CallbackQueryHandler(seleccionar_categoria_ref, pattern=r"^cat:.*"),CallbackQueryHandler(iniciar_establecer_presupuesto, pattern=r"^establecer_presupuesto:.+"), 
-                CallbackQueryHandler(ignorar_presupuesto, pattern=r"^ignorar_presupuesto$"), 
-            ],
-            HANDLE_GASTO_PERSONALIZADA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_categoria_personalizada)
-            ],
-            ESPECIFICAR_LIMITE_GASTO: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, especificar_limite),
-                CallbackQueryHandler(reintentar_especificar_limite, pattern="^reintentar_limite$"),
-                CallbackQueryHandler(cancelar_presupuesto, pattern="^cancelar_presupuesto$")
-            ],
-            ESPECIFICAR_LIMITE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, especificar_limite),
-                CallbackQueryHandler(reintentar_especificar_limite, pattern="^reintentar_limite$"),
-                CallbackQueryHandler(cancelar_presupuesto, pattern="^cancelar_presupuesto$")
-            ],
-            PREGUNTAR_ACCION_POST_PRESUPUESTO_GASTO: [
-                CallbackQueryHandler(manejar_accion_post_presupuesto),
-                CallbackQueryHandler(ignorar_presupuesto, pattern=r"^ignorar_presupuesto$"),
-                CallbackQueryHandler(iniciar_establecer_presupuesto, pattern=r"^establecer_presupuesto:.+"),
-                CallbackQueryHandler(ignorar_presupuesto, pattern=r"^ignorar_presupuesto$")
-            ],
-            PREGUNTAR_ACCION_POST_PRESUPUESTO: [
-                CallbackQueryHandler(manejar_accion_post_presupuesto),
-                CallbackQueryHandler(ignorar_presupuesto, pattern=r"^ignorar_presupuesto$"),
-                CallbackQueryHandler(iniciar_establecer_presupuesto, pattern=r"^establecer_presupuesto:.+"),
-            ],
-            ESCOGER_CATEGORIA: [                      # <== AGREGA ESTE BLOQUE
-                CallbackQueryHandler(escoger_categoria, pattern=r"^cat:.*"),
-                CallbackQueryHandler(seleccionar_categoria_presupuesto, pattern=r"^catref:personalizada$"),
-                CallbackQueryHandler(cancelar_presupuesto, pattern="^cancelar_presupuesto$")
-            ],
-            CONFIRMAR_SOBREESCRITURA: [
-                CallbackQueryHandler(confirmar_reemplazo, pattern="^confirmar_reemplazo$"),
-                CallbackQueryHandler(cancelar_reemplazo, pattern="^cancelar_reemplazo$")
-            ],
-        },
-        fallbacks=[CommandHandler("menu", mostrar_menu),
-                   CommandHandler("ultimo", ultimo),
-                   CommandHandler("total", total),
-                   CommandHandler("resumen", resumen),
-                   CommandHandler("grafico", grafico),
-                   CommandHandler("comparar", comparar),
-                   CommandHandler("eliminar", eliminar),
-                   CommandHandler("cancelar", cancelar_presupuesto),
-                   MessageHandler(filters.COMMAND, cancelar_presupuesto)],
-        map_to_parent={}
+    despachador.agregar_comandos({
+        "start": start,
+        "menu": mostrar_menu,
+        "resumen": resumen,
+        "total": total,
+        "ultimo": ultimo,
+        "eliminar": eliminar,
+        "grafico": grafico,
+        "comparar": comparar,
+        "comparar_detalle": comparar_categorias,
+        "exportar": exportar_gastos,
+        "grupo": resumen_grupo,
+        "recurrente": recurrente,
+        "zona": cambiar_zona,
+        "tasa": tasas,
+        "buscar": buscar,
+        "rango": rango,
+        "memoria": memoria,
+        "lentos": lentos,
+        "historial": historial,
+        "presupuesto_grupo": presupuesto_grupo,
+    })
+    despachador.agregar_comandos({"presupuesto": presupuesto}, flujo="presupuesto")
+    despachador.agregar_comandos({"consultar": consulta_presupuesto}, flujo="consulta")
+
+    # Teclado de respuesta (obtener_teclado_principal)
+    despachador.agregar_botones({
+        "📋 Menú": mostrar_menu,
+        "📝 Registrar gasto": pedir_gasto,
+        "📊 Resumen": resumen,
+        "📈 Comparar": comparar,
+        "💰 Total": total,
+        "📌 Último": ultimo,
+        "🗑️ Eliminar": eliminar,
+        "📉 Gráfico": grafico,
+    })
+    despachador.agregar_botones({"💼 Presupuesto": presupuesto}, flujo="presupuesto")
+
+    despachador.agregar_callbacks({
+        "menu": manejar_menu_inline,
+        "bus": paginar_busqueda,
+        "his": callback_historial,
+        "rec_borrar": borrar_recurrente,
+        "confirmar_eliminar": callback_confirmar,
+        "cancelar_eliminar": callback_confirmar,
+    })
+    despachador.agregar_callbacks({"menu:presupuesto": presupuesto}, flujo="presupuesto")
+    despachador.agregar_callbacks({
+        "cambiar_cat": cambiar_categoria_gasto,
+        "establecer_presupuesto": iniciar_establecer_presupuesto,
+    }, flujo="gasto")
+
+    despachador.agregar_flujo(
+        "presupuesto", cancelar=cancelar_presupuesto, pasan=COMANDOS_EN_FLUJO,
+        callbacks={"cancelar_presupuesto": cancelar_presupuesto}
     )
+    despachador.agregar_flujo("gasto", cancelar=cancelar_presupuesto, pasan=COMANDOS_EN_FLUJO)
+    despachador.agregar_flujo("consulta", cancelar=cancelar_presupuesto)
+
+    # Estados de los flujos: lo que cada uno espera; el resto va a las tablas generales
+    despachador.agregar_estado(ESCOGER_CATEGORIA, callbacks={
+        "cat": escoger_categoria,
+        "catref:personalizada": seleccionar_categoria_presupuesto,
+        "cancelar_presupuesto": cancelar_presupuesto,
+    })
+    despachador.agregar_estado(ESPECIFICAR_CATEGORIA_PERSONALIZADA, texto=guardar_categoria_personalizada_presupuesto)
+    for estado in (ESPECIFICAR_LIMITE, ESPECIFICAR_LIMITE_GASTO):
+        despachador.agregar_estado(estado, texto=especificar_limite, callbacks={
+            "reintentar_limite": reintentar_especificar_limite,
+            "cancelar_presupuesto": cancelar_presupuesto,
+        })
+    for estado in (PREGUNTAR_ACCION_POST_PRESUPUESTO, PREGUNTAR_ACCION_POST_PRESUPUESTO_GASTO):
+        despachador.agregar_estado(estado, callbacks={
+            "otro_presupuesto": manejar_accion_post_presupuesto,
+            "registrar_gasto": manejar_accion_post_presupuesto,
+            "salir": manejar_accion_post_presupuesto,
+            "ignorar_presupuesto": ignorar_presupuesto,
+        })
+    despachador.agregar_estado(CONFIRMAR_SOBREESCRITURA, callbacks={
+        "confirmar_reemplazo": confirmar_reemplazo,
+        "cancelar_reemplazo": cancelar_reemplazo,
+    })
+    despachador.agregar_estado(ESPERANDO_CATEGORIA_CONSULTA, callbacks={
+        "consulta_categoria": responder_consulta_presupuesto,
+    })
+    despachador.agregar_estado(HANDLE_GASTO_CATEGORIA, callbacks={
+        "cat": seleccionar_categoria_ref,
+        "catref": seleccionar_categoria_ref,
+        "ignorar_presupuesto": ignorar_presupuesto,
+    })
+    despachador.agregar_estado(HANDLE_GASTO_PERSONALIZADA, texto=handle_categoria_personalizada)
+    return despachador
+
+# --- Main ---
+def construir_app(request=None, get_updates_request=None, request_masivo=None):
+    builder = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    # Respuestas interactivas con prioridad; los envíos programados salen por su propio Bot y pool
+    builder = builder.request(canales.interactiva(request))
+    canales.crear_bot_masivo(TELEGRAM_BOT_TOKEN, TELEGRAM_BASE_URL, request_masivo or request)
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    if perfilador.activo:
+        # Mismo orden de siempre (un update a la vez), pero cronometrado
+        builder = builder.concurrent_updates(ProcesadorPerfilado(perfilador))
+        resiliencia.observador = perfilador.observar_llamada
+    app = builder.build()
+
+    # Última actividad de cada usuario y chat, antes que cualquier otro handler
+    app.add_handler(TypeHandler(Update, ciclo_estado.registrar), group=-4)
+    # La zona horaria del usuario, leída fuera del event loop antes de los handlers
+    app.add_handler(TypeHandler(Update, precargar_zona), group=-1)
+    app.add_handler(construir_despachador())
+
+    # Contexto del registro (usuario, handler, duración) para cada update
+    app.add_handler(TypeHandler(Update, registro.iniciar_update), group=-2)
+    app.add_handler(TypeHandler(Update, registro.terminar_update), group=99)
+    # Lo que cada update responde se junta y sale al final en el mínimo de llamadas
+    app.add_handler(TypeHandler(Update, respuestas.iniciar_update), group=-3)
+    app.add_handler(TypeHandler(Update, respuestas.vaciar), group=98)
+    # Nombre del handler que atiende cada update, para el registro y el perfilador
+    perfilador.instrumentar(app)
+
+    # Inicia el scheduler (trabaja con asyncio); los resúmenes y reportes se
+    # programan por bucket al cargar el índice de envíos
+    async def startup(app):
+        await app.bot.delete_webhook(drop_pending_updates=True)
+        await asyncio.to_thread(cargar_indice_envios, app.job_queue)
+        await canales.masivo.initialize()
+        if bitacora:
+            # Vuelca lo que quedó pendiente de la ejecución anterior
+            bitacora.iniciar()
+        if coherencia:
+            # Un cambio que llega por los listeners (otra réplica, la consola)
+            # descarta las respuestas inline y los reportes armados con lo viejo
+            loop = asyncio.get_running_loop()
+            coherencia.al_cambiar = lambda user_id: loop.call_soon_threadsafe(invalidar_inline, user_id)
+        log.info("webhook eliminado, bot iniciado")
 
-    consultar_presupuesto_handler = ConversationHandler(
-        entry_points=[CommandHandler("consultar", consulta_presupuesto)],
-        states={
-            ESPERANDO_CATEGORIA_CONSULTA: [
-                CallbackQueryHandler(responder_consulta_presupuesto, pattern=r"^consulta_categoria:.+")
-            ],
-        },
-        fallbacks=[CommandHandler("cancelar", cancelar_presupuesto)],
-        per_chat=True
+    app.job_queue.run_daily(
+        materializar_recurrentes,
+        time=time(hour=7, minute=0, tzinfo=pytz.timezone(ZONA_POR_DEFECTO))
     )
 
-    app.add_handler(conv_presupuesto)
-    app.add_handler(consultar_presupuesto_handler)
-    app.add_handler(gasto_categoria_handler)
+    # Después de materializar los recurrentes del día
+    app.job_queue.run_daily(
+        pronosticar_presupuestos,
+        time=time(hour=7, minute=30, tzinfo=pytz.timezone(ZONA_POR_DEFECTO))
+    )
 
+    async def compactar_archivo(context: ContextTypes.DEFAULT_TYPE):
+        archivados = await asyncio.to_thread(compactar, db, MESES_ARCHIVO)
+        log.info("compactación", extra={"archivados": archivados})
 
-    # Agrega handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("menu", mostrar_menu))
-    app.add_handler(CommandHandler("resumen", resumen))
-    app.add_handler(CommandHandler("total", total))
-    app.add_handler(CommandHandler("ultimo", ultimo))
-    app.add_handler(CommandHandler("eliminar", eliminar))
-    app.add_handler(CommandHandler("grafico", grafico))
-    app.add_handler(CommandHandler("comparar", comparar))
-    app.add_handler(CommandHandler("comparar_detalle", comparar_categorias))
+    app.job_queue.run_daily(
+        compactar_archivo,
+        time=time(hour=3, minute=0, tzinfo=pytz.timezone(ZONA_POR_DEFECTO))
+    )
 
-    
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📋 Menú$"), mostrar_menu))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📝 Registrar gasto$"), handle_message))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📊 Resumen$"), resumen))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📈 Comparar$"), comparar))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^💰 Total$"), total))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📌 Último$"), ultimo))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🗑️ Eliminar$"), eliminar))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📉 Gráfico$"), grafico))
-    app.add_handler(MessageHandler(filters.COMMAND, comando_desconocido))  
+    # Estado del interruptor y contadores de reintentos para monitoreo
+    app.job_queue.run_repeating(
+        reportar_resiliencia, interval=int(os.getenv("RESILIENCIA_REPORTE_S", "300")), first=60
+    )
+    app.add_error_handler(manejar_error)
 
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.job_queue.run_repeating(
+        barrer_estado, interval=int(os.getenv("ESTADO_BARRIDO_MIN", "10")) * 60, first=600
+    )
 
-    app.add_handler(CallbackQueryHandler(iniciar_establecer_presupuesto, pattern=r"^establecer_presupuesto:.+"))
+    if coherencia:
+        async def barrer_listeners(context: ContextTypes.DEFAULT_TYPE):
+            desconectados = await asyncio.to_thread(coherencia.barrer)
+            if desconectados:
+                log.info("listeners cerrados", extra={"usuarios": desconectados})
 
-    app.add_handler(CallbackQueryHandler(manejar_menu_inline, pattern=r"^menu:"))
-    app.add_handler(CallbackQueryHandler(callback_confirmar))# <= al final como respaldo
+        app.job_queue.run_repeating(barrer_listeners, interval=300, first=300)
 
-    # Inicia el scheduler (trabaja con asyncio)
-    app.job_queue.run_daily(
-        enviar_resumen_automatico,
-        time=time(hour=11, minute=0, tzinfo=pytz.timezone("America/Bogota")),
-        days=(6,)  # Solo domingos
-    )
+    async def cerrar(app):
+        if coherencia:
+            coherencia.cerrar()
+        if bitacora:
+            await bitacora.cerrar()
+        await canales.masivo.shutdown()
+        resiliencia.cerrar()
 
-    app.job_queue.run_monthly(
-        enviar_reporte_mensual,
-        when=time(hour=10, minute=0, tzinfo=pytz.timezone("America/Bogota")),
-        day=1
-    )
-    
-    async def startup(app):
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        print("🤖 Webhook eliminado. Bot iniciado.")
+    app.post_shutdown = cerrar
 
     app.post_init = startup
-    print("🤖 Bot y programador iniciados.")
+    return app
+
+def main():
+    app = construir_app()
+    log.info("bot y programador iniciados")
     app.run_polling()
 
 if __name__ == "__main__":
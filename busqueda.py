@@ -0,0 +1,84 @@
+import datetime
+import unicodedata
+
+import pytz
+from google.cloud import firestore
+
+# --- Búsqueda de gastos ---
+#
+# Cada gasto guarda en `tokens` las palabras normalizadas de su descripción y
+# su categoría. Firestore indexa ese arreglo, de modo que
+# where("tokens", "array_contains", ...) funciona como un índice invertido
+# por usuario. Cada página es una consulta acotada (limit) que continúa
+# desde el cursor (fecha en microsegundos, id) del último gasto mostrado.
+
+TAM_PAGINA = 8
+
+
+def normalizar_token(palabra):
+    sin_tildes = unicodedata.normalize("NFKD", palabra.lower())
+    return "".join(c for c in sin_tildes if c.isalnum())
+
+
+def tokenizar(*textos):
+    tokens = set()
+    for texto in textos:
+        for palabra in (texto or "").split():
+            token = normalizar_token(palabra)
+            if len(token) >= 2:
+                tokens.add(token)
+    return sorted(tokens)
+
+
+# --- Cursores (fecha en microsegundos, id) ---
+#
+# Caben en callback_data y reproducen exactamente el orden
+# fecha DESC, __name__ DESC con el que se pagina.
+
+EPOCA = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def cursor_de(doc):
+    transcurrido = doc.to_dict()["fecha"] - EPOCA
+    return (transcurrido // datetime.timedelta(microseconds=1), doc.id)
+
+
+def aplicar_cursor(consulta, gastos_ref, cursor):
+    epoch_us, gasto_id = cursor
+    return consulta.start_after({
+        "fecha": EPOCA + datetime.timedelta(microseconds=epoch_us),
+        "__name__": gastos_ref.document(gasto_id)
+    })
+
+
+def ordenar_recientes(consulta):
+    return consulta.order_by("fecha", direction=firestore.Query.DESCENDING) \
+        .order_by("__name__", direction=firestore.Query.DESCENDING)
+
+
+def buscar_pagina(db, user_id, tokens, desde=None, hasta=None, categoria=None, cursor=None, tam_pagina=TAM_PAGINA):
+    gastos_ref = db.collection("usuarios").document(user_id).collection("gastos")
+    # Firestore admite un solo array_contains: se consulta por el token más
+    # largo (el más selectivo en la práctica) y el resto se filtra aquí
+    principal = max(tokens, key=len)
+    consulta = gastos_ref.where("tokens", "array_contains", principal)
+    if categoria:
+        consulta = consulta.where("categoria", "==", categoria)
+    if desde is not None:
+        consulta = consulta.where("fecha", ">=", desde)
+    if hasta is not None:
+        consulta = consulta.where("fecha", "<", hasta)
+    consulta = ordenar_recientes(consulta)
+
+    if cursor is not None:
+        consulta = aplicar_cursor(consulta, gastos_ref, cursor)
+
+    docs = list(consulta.limit(tam_pagina).stream())
+    resultados = []
+    for doc in docs:
+        d = doc.to_dict()
+        if all(t in d.get("tokens", []) for t in tokens):
+            resultados.append((doc.id, d))
+
+    siguiente = cursor_de(docs[-1]) if len(docs) == tam_pagina else None
+    return resultados, siguiente
@@ -0,0 +1,262 @@
+import sys
+import threading
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# --- Cache en memoria de gastos recientes por usuario ---
+#
+# Cada usuario activo guarda sus gastos del mes actual y del anterior en
+# columnas paralelas (monto, fecha en segundos epoch, índice de categoría)
+# ordenadas por fecha. Las categorías se internan una sola vez para todo el
+# proceso. Los usuarios se expulsan por LRU cuando se supera el presupuesto
+# de memoria.
+#
+# La carga desde Firestore corre fuera del lock (en un hilo de resiliencia)
+# mientras el event loop sigue registrando y borrando gastos. Lo que llega
+# durante una carga se anota en ella y se aplica a la foto leída antes de
+# guardarla; un invalidar() a mitad de carga la descarta.
+
+_categorias = []
+_indice_categorias = {}
+
+
+def internar_categoria(categoria):
+    indice = _indice_categorias.get(categoria)
+    if indice is None:
+        indice = len(_categorias)
+        _categorias.append(categoria)
+        _indice_categorias[categoria] = indice
+    return indice
+
+
+def nombre_categoria(indice):
+    return _categorias[indice]
+
+
+def a_epoch(fecha):
+    if isinstance(fecha, datetime.datetime):
+        return int(fecha.timestamp())
+    return int(fecha)
+
+
+class GastosUsuario:
+    __slots__ = ("desde", "ids", "montos", "fechas", "categorias")
+
+    def __init__(self, desde):
+        self.desde = desde
+        self.ids = []
+        self.montos = array("q")
+        self.fechas = array("q")
+        self.categorias = array("I")
+
+    def insertar(self, gasto_id, monto, categoria, fecha):
+        fecha = a_epoch(fecha)
+        pos = bisect_right(self.fechas, fecha)
+        self.ids.insert(pos, gasto_id)
+        self.montos.insert(pos, int(monto))
+        self.fechas.insert(pos, fecha)
+        self.categorias.insert(pos, internar_categoria(categoria))
+
+    def quitar(self, gasto_id):
+        try:
+            pos = self.ids.index(gasto_id)
+        except ValueError:
+            return False
+        del self.ids[pos]
+        del self.montos[pos]
+        del self.fechas[pos]
+        del self.categorias[pos]
+        return True
+
+    def _rango(self, desde=None, hasta=None):
+        inicio = 0 if desde is None else bisect_left(self.fechas, a_epoch(desde))
+        fin = len(self.fechas) if hasta is None else bisect_left(self.fechas, a_epoch(hasta))
+        return inicio, fin
+
+    def total(self, desde=None, hasta=None, categoria=None):
+        inicio, fin = self._rango(desde, hasta)
+        if categoria is None:
+            return sum(self.montos[inicio:fin])
+        indice = _indice_categorias.get(categoria)
+        if indice is None:
+            return 0
+        return sum(
+            self.montos[i] for i in range(inicio, fin) if self.categorias[i] == indice
+        )
+
+    def por_categoria(self, desde=None, hasta=None):
+        inicio, fin = self._rango(desde, hasta)
+        resumen = {}
+        for i in range(inicio, fin):
+            cat = _categorias[self.categorias[i]]
+            resumen[cat] = resumen.get(cat, 0) + self.montos[i]
+        return resumen
+
+    def ultimo(self):
+        if not self.ids:
+            return None
+        return self.ids[-1], self.montos[-1], _categorias[self.categorias[-1]], self.fechas[-1]
+
+    def tamano_bytes(self):
+        return (
+            sys.getsizeof(self.ids)
+            + sum(sys.getsizeof(i) for i in self.ids)
+            + sys.getsizeof(self.montos)
+            + sys.getsizeof(self.fechas)
+            + sys.getsizeof(self.categorias)
+        )
+
+
+class _Carga:
+    __slots__ = ("cambios", "invalidada")
+
+    def __init__(self):
+        self.cambios = []  # ("agregar", id, monto, categoria, fecha) o ("quitar", ids)
+        self.invalidada = False
+
+
+class CacheGastos:
+    # cargador(user_id, desde) -> iterable de (id, monto, categoria, fecha)
+    def __init__(self, cargador, limite_bytes):
+        self.cargador = cargador
+        self.limite_bytes = limite_bytes
+        self._usuarios = OrderedDict()
+        self._tamanos = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._en_curso = {}  # user_id -> [_Carga] de las cargas que aún no terminan
+        self.cargas = 0
+        self.expulsiones = 0
+        self.lecturas_de_paso = 0
+
+    def obtener(self, user_id, desde):
+        with self._lock:
+            entrada = self._usuarios.get(user_id)
+            if entrada is not None and entrada.desde <= a_epoch(desde):
+                self._usuarios.move_to_end(user_id)
+                return entrada
+            carga = _Carga()
+            self._en_curso.setdefault(user_id, []).append(carga)
+
+        try:
+            entrada = self._cargar(user_id, desde)
+        finally:
+            with self._lock:
+                en_curso = self._en_curso[user_id]
+                en_curso[:] = [c for c in en_curso if c is not carga]
+                if not en_curso:
+                    del self._en_curso[user_id]
+        with self._lock:
+            self.cargas += 1
+            for cambio in carga.cambios:
+                if cambio[0] == "agregar":
+                    _, gasto_id, monto, categoria, fecha = cambio
+                    if a_epoch(fecha) >= entrada.desde and gasto_id not in entrada.ids:
+                        entrada.insertar(gasto_id, monto, categoria, fecha)
+                else:
+                    for gasto_id in cambio[1]:
+                        entrada.quitar(gasto_id)
+            if not carga.invalidada:
+                self._guardar(user_id, entrada)
+        return entrada
+
+    def leer(self, user_id, desde):
+        # Para recorridos de todos los usuarios (trabajos nocturnos): usa lo
+        # que ya está en memoria, pero ni guarda a los demás ni cambia el
+        # orden LRU, así no expulsa a los usuarios activos
+        with self._lock:
+            entrada = self._usuarios.get(user_id)
+            if entrada is not None and entrada.desde <= a_epoch(desde):
+                return entrada
+            self.lecturas_de_paso += 1
+        return self._cargar(user_id, desde)
+
+    def _cargar(self, user_id, desde):
+        entrada = GastosUsuario(a_epoch(desde))
+        filas = sorted(
+            ((gasto_id, monto, categoria, a_epoch(fecha))
+             for gasto_id, monto, categoria, fecha in self.cargador(user_id, desde)),
+            key=lambda fila: fila[3]
+        )
+        for gasto_id, monto, categoria, fecha in filas:
+            entrada.ids.append(gasto_id)
+            entrada.montos.append(int(monto))
+            entrada.fechas.append(fecha)
+            entrada.categorias.append(internar_categoria(categoria))
+        return entrada
+
+    def agregar(self, user_id, gasto_id, monto, categoria, fecha):
+        # Si el usuario no está en memoria no hay nada que actualizar: la
+        # próxima lectura lo cargará desde Firestore con este gasto incluido.
+        with self._lock:
+            self._anotar(user_id, ("agregar", gasto_id, monto, categoria, fecha))
+            entrada = self._usuarios.get(user_id)
+            if entrada is None or a_epoch(fecha) < entrada.desde or gasto_id in entrada.ids:
+                return
+            entrada.insertar(gasto_id, monto, categoria, fecha)
+            self._recalcular(user_id)
+
+    def eliminar(self, user_id, gasto_id):
+        with self._lock:
+            self._anotar(user_id, ("quitar", [gasto_id]))
+            entrada = self._usuarios.get(user_id)
+            if entrada is not None and entrada.quitar(gasto_id):
+                self._recalcular(user_id)
+
+    def eliminar_varios(self, user_id, gasto_ids):
+        gasto_ids = list(gasto_ids)
+        with self._lock:
+            self._anotar(user_id, ("quitar", gasto_ids))
+            entrada = self._usuarios.get(user_id)
+            if entrada is None:
+                return
+            quitados = [entrada.quitar(gasto_id) for gasto_id in gasto_ids]
+            if any(quitados):
+                self._recalcular(user_id)
+
+    def invalidar(self, user_id):
+        with self._lock:
+            for carga in self._en_curso.get(user_id, ()):
+                carga.invalidada = True
+            if self._usuarios.pop(user_id, None) is not None:
+                self._bytes -= self._tamanos.pop(user_id)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "usuarios": len(self._usuarios),
+                "bytes": self._bytes,
+                "limite_bytes": self.limite_bytes,
+                "cargas": self.cargas,
+                "expulsiones": self.expulsiones,
+                "lecturas_de_paso": self.lecturas_de_paso,
+            }
+
+    def _anotar(self, user_id, cambio):
+        for carga in self._en_curso.get(user_id, ()):
+            carga.cambios.append(cambio)
+
+    def _guardar(self, user_id, entrada):
+        if user_id in self._usuarios:
+            self._bytes -= self._tamanos[user_id]
+        self._usuarios[user_id] = entrada
+        self._usuarios.move_to_end(user_id)
+        self._tamanos[user_id] = entrada.tamano_bytes()
+        self._bytes += self._tamanos[user_id]
+        self._expulsar()
+
+    def _recalcular(self, user_id):
+        self._bytes -= self._tamanos[user_id]
+        self._tamanos[user_id] = self._usuarios[user_id].tamano_bytes()
+        self._bytes += self._tamanos[user_id]
+        self._usuarios.move_to_end(user_id)
+        self._expulsar()
+
+    def _expulsar(self):
+        # Siempre se conserva al usuario más reciente aunque exceda el límite
+        while self._bytes > self.limite_bytes and len(self._usuarios) > 1:
+            user_id, _ = self._usuarios.popitem(last=False)
+            self._bytes -= self._tamanos.pop(user_id)
+            self.expulsiones += 1
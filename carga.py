@@ -0,0 +1,514 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import contextlib
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+from ciclo_estado import rss_mb
+from busqueda import tokenizar
+
+# --- Prueba de carga y resistencia ---
+#
+# Levanta la Application real de bot.py (construir_app) contra una Bot API
+# falsa en proceso y el emulador de Firestore, y simula miles de usuarios
+# concurrentes que registran gastos, eligen categorías en los botones,
+# definen presupuestos y piden reportes. Cada update se mide desde que entra
+# a la cola hasta que termina el último grupo de handlers.
+#
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python carga.py --usuarios 2000 --duracion 3h
+#
+# Con --fallos y --lentos se inyectan errores transitorios y demoras en las
+# llamadas al almacén (a través de Resiliencia.inyector) para ver la cola de
+# latencias con reintentos e interruptor de circuito.
+#
+# Sin el emulador, --almacen memoria usa firestore_memoria.py con una
+# latencia fija por llamada (--latencia-almacen) y el informe agrega los
+# documentos leídos por acción. --sembrar N carga N gastos previos por
+# usuario (repartidos en los últimos 24 meses) para medir /buscar e
+# /historial sobre historiales grandes:
+#
+#   python carga.py --almacen memoria --usuarios 1 --sembrar 50000 \
+#       --mezcla gasto=0,reporte=0,presupuesto=0,inline=0,buscar=1,historial=1 --pausa 0.05
+
+ID_BASE = 900_000_000
+BOT_ID = 1
+
+DESCRIPCIONES = [
+    "almuerzo", "uber", "mercado", "cine", "farmacia", "arriendo", "internet",
+    "gasolina", "cafe", "libros", "gimnasio", "taxi", "domicilio", "luz"
+]
+REPORTES = ["/resumen", "/total", "/ultimo", "📊 Resumen", "💰 Total", "/comparar", "/grafico"]
+
+# Mezcla de flujos por defecto (pesos relativos)
+MEZCLA = {"gasto": 55, "reporte": 25, "presupuesto": 10, "inline": 10, "buscar": 0, "historial": 0}
+CATEGORIAS = ["comida", "transporte", "salud", "ocio", "educación", "hogar", "servicios"]
+
+
+# --- Histograma logarítmico: memoria fija sin importar la duración ---
+
+class Histograma:
+    MINIMO = 1e-5
+    FACTOR = 1.05
+
+    def __init__(self):
+        self.cuentas = {}
+        self.total = 0
+        self.maximo = 0.0
+
+    def agregar(self, segundos):
+        i = 0 if segundos <= self.MINIMO else int(math.log(segundos / self.MINIMO, self.FACTOR)) + 1
+        self.cuentas[i] = self.cuentas.get(i, 0) + 1
+        self.total += 1
+        self.maximo = max(self.maximo, segundos)
+
+    def percentil(self, p):
+        if not self.total:
+            return 0.0
+        objetivo = math.ceil(self.total * p / 100)
+        acumulado = 0
+        for i in sorted(self.cuentas):
+            acumulado += self.cuentas[i]
+            if acumulado >= objetivo:
+                return min(self.MINIMO * self.FACTOR ** i, self.maximo)
+        return self.maximo
+
+    def resumen(self):
+        return {
+            "n": self.total,
+            "p50_ms": round(self.percentil(50) * 1000, 2),
+            "p95_ms": round(self.percentil(95) * 1000, 2),
+            "p99_ms": round(self.percentil(99) * 1000, 2),
+            "max_ms": round(self.maximo * 1000, 2),
+        }
+
+
+# --- Bot API falsa ---
+#
+# Responde en proceso a los métodos que usa el bot y recuerda el último
+# teclado inline enviado a cada chat, para que los usuarios simulados
+# pulsen botones que de verdad existen.
+
+class BotAPIFalsa(BaseRequest):
+    def __init__(self, latencia_ms=0.0):
+        self.latencia = latencia_ms / 1000
+        self.llamadas = {}
+        self.teclados = {}
+        self._mensaje_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        metodo = url.rsplit("/", 1)[-1]
+        self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+        if self.latencia:
+            await asyncio.sleep(random.expovariate(1 / self.latencia))
+        parametros = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._resultado(metodo, parametros)}).encode()
+
+    def _resultado(self, metodo, parametros):
+        if metodo == "getMe":
+            return {
+                "id": BOT_ID, "is_bot": True, "first_name": "Gastos", "username": "gastos_carga_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False,
+                "supports_inline_queries": True
+            }
+        if metodo.startswith("send") or metodo.startswith("edit"):
+            chat_id = int(parametros.get("chat_id", 0))
+            teclado = parametros.get("reply_markup") or {}
+            if isinstance(teclado, str):
+                teclado = json.loads(teclado)
+            self.teclados[chat_id] = [
+                boton["callback_data"]
+                for fila in teclado.get("inline_keyboard", [])
+                for boton in fila if "callback_data" in boton
+            ]
+            if "message_id" in parametros:
+                mensaje_id = int(parametros["message_id"])
+            else:
+                self._mensaje_id += 1
+                mensaje_id = self._mensaje_id
+            return {
+                "message_id": mensaje_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Gastos"},
+                "text": str(parametros.get("text", parametros.get("caption", "")))
+            }
+        return True
+
+
+# --- Simulador ---
+
+class Simulador:
+    def __init__(self, app, api, args, salida, lecturas=None):
+        self.app = app
+        self.api = api
+        self.args = args
+        self.salida = salida
+        # lecturas(): documentos leídos hasta ahora (solo con el almacén en memoria)
+        self.lecturas = lecturas
+        self.lecturas_por_accion = {}
+        self.terminado = False
+        self._update_id = 0
+        self._pendientes = {}
+        self.latencias = {}
+        self.en_handler = Histograma()
+        self.en_handler_por_accion = {}
+        self.lag = Histograma()
+        self.sin_respuesta = 0
+        self.completados = 0
+        # Lo que quedó en la cola al cumplirse la duración: app.stop() lo
+        # atiende igual, pero esas latencias son del vaciado, no de la prueba
+        self.en_cola_al_terminar = 0
+        self.drenados = 0
+        self.rss_inicial = rss_mb()
+        self.rss_maximo = self.rss_inicial
+        self.muestras_rss = []
+
+        app.add_handler(TypeHandler(Update, self._inicio), group=-100)
+        app.add_handler(TypeHandler(Update, self._fin), group=100)
+
+    async def _inicio(self, update, context):
+        pendiente = self._pendientes.get(update.update_id)
+        if pendiente:
+            pendiente[3] = time.perf_counter()
+            if self.lecturas:
+                pendiente.append(self.lecturas())
+
+    async def _fin(self, update, context):
+        pendiente = self._pendientes.pop(update.update_id, None)
+        if pendiente is None:
+            return
+        futuro, accion, encolado, inicio = pendiente[:4]
+        if self.terminado:
+            self.drenados += 1
+            return
+        if len(pendiente) > 4:
+            # Los updates se atienden de a uno: la diferencia es de este update
+            leidos = self.lecturas_por_accion.setdefault(accion, [0, 0])
+            leidos[0] += self.lecturas() - pendiente[4]
+            leidos[1] += 1
+        fin = time.perf_counter()
+        self.latencias.setdefault(accion, Histograma()).agregar(fin - encolado)
+        if inicio is not None:
+            self.en_handler.agregar(fin - inicio)
+            self.en_handler_por_accion.setdefault(accion, Histograma()).agregar(fin - inicio)
+        self.completados += 1
+        if not futuro.done():
+            futuro.set_result(None)
+
+    async def _enviar(self, accion, datos):
+        self._update_id += 1
+        datos["update_id"] = self._update_id
+        update = Update.de_json(datos, self.app.bot)
+        futuro = asyncio.get_running_loop().create_future()
+        self._pendientes[self._update_id] = [futuro, accion, time.perf_counter(), None]
+        await self.app.update_queue.put(update)
+        try:
+            await asyncio.wait_for(futuro, self.args.timeout)
+        except asyncio.TimeoutError:
+            self._pendientes.pop(datos["update_id"], None)
+            self.sin_respuesta += 1
+
+    def _usuario(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Carga{uid - ID_BASE}", "language_code": "es"}
+
+    async def texto(self, accion, uid, texto):
+        mensaje = {
+            "message_id": random.randrange(1, 2**31),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._usuario(uid),
+            "text": texto
+        }
+        if texto.startswith("/"):
+            mensaje["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        await self._enviar(accion, {"message": mensaje})
+
+    async def boton(self, accion, uid, datos):
+        await self._enviar(accion, {"callback_query": {
+            "id": str(random.randrange(2**62)),
+            "from": self._usuario(uid),
+            "chat_instance": str(uid),
+            "data": datos,
+            "message": {
+                "message_id": self.api._mensaje_id or 1,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Gastos"},
+                "text": "..."
+            }
+        }})
+
+    def botones(self, uid, prefijo):
+        return [b for b in self.api.teclados.get(uid, []) if b.startswith(prefijo)]
+
+    # --- Flujos ---
+
+    async def flujo_gasto(self, uid):
+        await self.texto("gasto:mensaje", uid, f"{random.randrange(2, 200) * 1000} {random.choice(DESCRIPCIONES)}")
+        categorias = self.botones(uid, "cat:")
+        if categorias:
+            await self.boton("gasto:categoria", uid, random.choice(categorias))
+        if self.botones(uid, "ignorar_presupuesto"):
+            await self.boton("gasto:ignorar_presupuesto", uid, "ignorar_presupuesto")
+
+    async def flujo_reporte(self, uid):
+        reporte = random.choice(REPORTES)
+        await self.texto(f"reporte:{reporte.split()[-1].lstrip('/').lower()}", uid, reporte)
+
+    async def flujo_presupuesto(self, uid):
+        await self.texto("presupuesto:inicio", uid, "/presupuesto")
+        categorias = self.botones(uid, "cat:")
+        if not categorias:
+            return
+        await self.boton("presupuesto:categoria", uid, random.choice(categorias))
+        await self.texto("presupuesto:limite", uid, str(random.randrange(1, 20) * 100_000))
+        if self.botones(uid, "confirmar_reemplazo"):
+            await self.boton("presupuesto:reemplazo", uid, "confirmar_reemplazo")
+        if self.botones(uid, "ignorar_presupuesto"):
+            await self.boton("presupuesto:ignorar", uid, "ignorar_presupuesto")
+
+    async def flujo_inline(self, uid):
+        await self._enviar("inline", {"inline_query": {
+            "id": str(random.randrange(2**62)),
+            "from": self._usuario(uid),
+            "query": random.choice(["", "total", random.choice(DESCRIPCIONES)]),
+            "offset": ""
+        }})
+
+    async def flujo_buscar(self, uid):
+        await self.texto("buscar:inicio", uid, f"/buscar {random.choice(DESCRIPCIONES)}")
+        for _ in range(random.randrange(4)):
+            siguiente = self.botones(uid, "bus:")
+            if not siguiente:
+                break
+            await self.boton("buscar:pagina", uid, siguiente[0])
+
+    async def flujo_historial(self, uid):
+        await self.texto("historial:inicio", uid, "/historial")
+        for _ in range(random.randrange(4)):
+            siguiente = self.botones(uid, "his:p:")
+            if not siguiente:
+                break
+            await self.boton("historial:pagina", uid, siguiente[0])
+
+    async def usuario(self, uid, flujos, pesos):
+        # Arranque escalonado para no disparar a todos en el mismo instante
+        await asyncio.sleep(random.uniform(0, self.args.pausa))
+        while not self.terminado:
+            flujo = random.choices(flujos, pesos)[0]
+            try:
+                await getattr(self, f"flujo_{flujo}")(uid)
+            except Exception as e:
+                print(f"⚠️ Flujo {flujo} falló para {uid}: {e}", file=self.salida)
+            await asyncio.sleep(random.expovariate(1 / self.args.pausa))
+
+    async def medir_lag(self):
+        while not self.terminado:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.1)
+            self.lag.agregar(max(0.0, time.perf_counter() - t0 - 0.1))
+
+    async def reportar(self, inicio):
+        previos = 0
+        while not self.terminado:
+            await asyncio.sleep(self.args.intervalo)
+            transcurrido = time.perf_counter() - inicio
+            rss = rss_mb()
+            self.rss_maximo = max(self.rss_maximo, rss)
+            self.muestras_rss.append((round(transcurrido), round(rss, 1)))
+            hechos = self.completados - previos
+            previos = self.completados
+            print(
+                f"[{transcurrido:7.0f}s] {hechos / self.args.intervalo:7.1f} upd/s | "
+                f"cola {len(self._pendientes):5d} | handler p95 {self.en_handler.percentil(95) * 1000:7.1f} ms | "
+                f"lag p99 {self.lag.percentil(99) * 1000:6.1f} ms | RSS {rss:7.1f} MB",
+                file=self.salida, flush=True
+            )
+
+    def informe(self, duracion):
+        rss_final = rss_mb()
+        horas = duracion / 3600
+        return {
+            "usuarios": self.args.usuarios,
+            "duracion_s": round(duracion, 1),
+            "updates": self.completados,
+            "throughput_upd_s": round(self.completados / duracion, 2) if duracion else 0,
+            "sin_respuesta": self.sin_respuesta,
+            "en_cola_al_terminar": self.en_cola_al_terminar,
+            "drenados": self.drenados,
+            "latencia_por_accion": {k: h.resumen() for k, h in sorted(self.latencias.items())},
+            "tiempo_en_handlers": self.en_handler.resumen(),
+            # Sin la espera en la cola: lo que cuesta atender cada acción
+            "tiempo_en_handlers_por_accion": {k: h.resumen() for k, h in sorted(self.en_handler_por_accion.items())},
+            "lag_event_loop": self.lag.resumen(),
+            "memoria": {
+                "rss_inicial_mb": round(self.rss_inicial, 1),
+                "rss_final_mb": round(rss_final, 1),
+                "rss_maximo_mb": round(max(self.rss_maximo, rss_final), 1),
+                "crecimiento_mb_h": round((rss_final - self.rss_inicial) / horas, 1) if horas else 0,
+                "muestras": self.muestras_rss,
+            },
+            "llamadas_bot_api": dict(sorted(self.api.llamadas.items())),
+            "lecturas_por_accion": {
+                accion: round(total / n, 1) for accion, (total, n) in sorted(self.lecturas_por_accion.items())
+            },
+        }
+
+
+def inyector_de_fallos(prob_fallo, prob_lento, demora):
+    from google.api_core.exceptions import ServiceUnavailable
+
+    def inyectar(operacion):
+        r = random.random()
+        if r < prob_fallo:
+            raise ServiceUnavailable(f"fallo inyectado en {operacion}")
+        if r < prob_fallo + prob_lento:
+            time.sleep(demora)
+    return inyectar
+
+
+def sembrar(db, usuarios, por_usuario, salida):
+    # Historial previo de cada usuario, escrito directo en lotes de 500
+    if not por_usuario:
+        return
+    inicio = time.perf_counter()
+    ahora = datetime.datetime.now(datetime.timezone.utc)
+    paso = datetime.timedelta(days=730) / por_usuario
+    for uid in usuarios:
+        gastos = db.collection("usuarios").document(str(uid)).collection("gastos")
+        lote, pendientes = db.batch(), 0
+        for i in range(por_usuario):
+            descripcion = random.choice(DESCRIPCIONES)
+            categoria = random.choice(CATEGORIAS)
+            lote.set(gastos.document(f"s{i}"), {
+                "monto": random.randrange(2, 200) * 1000,
+                "categoria": categoria,
+                "descripcion": descripcion,
+                "tokens": tokenizar(descripcion, categoria),
+                "fecha": ahora - paso * (i + 1),
+            })
+            pendientes += 1
+            if pendientes == 500:
+                lote.commit()
+                lote, pendientes = db.batch(), 0
+        if pendientes:
+            lote.commit()
+    print(f"🌱 {len(usuarios) * por_usuario} gastos sembrados en {time.perf_counter() - inicio:.1f}s",
+          file=salida, flush=True)
+
+
+def duracion_segundos(texto):
+    unidades = {"s": 1, "m": 60, "h": 3600}
+    if texto[-1] in unidades:
+        return float(texto[:-1]) * unidades[texto[-1]]
+    return float(texto)
+
+
+async def correr(args):
+    salida = sys.stdout
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:CARGA")
+    if args.almacen == "memoria":
+        from google.cloud import firestore
+        from firestore_memoria import ClienteMemoria
+
+        firestore.Client = lambda *a, **k: ClienteMemoria(args.latencia_almacen / 1000)
+        os.environ["FIRESTORE_EMULATOR_HOST"] = "memoria"
+    elif not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("❌ Define FIRESTORE_EMULATOR_HOST (emulador de Firestore); la carga no se corre contra producción.")
+
+    import bot
+
+    if args.fallos or args.lentos:
+        bot.resiliencia.inyector = inyector_de_fallos(args.fallos, args.lentos, args.demora)
+
+    api = BotAPIFalsa(args.latencia_api)
+    app = bot.construir_app(request=api, get_updates_request=BotAPIFalsa())
+    lecturas = (lambda: bot.db.contadores["lecturas"]) if args.almacen == "memoria" else None
+    sim = Simulador(app, api, args, salida, lecturas)
+    sembrar(bot.db, [ID_BASE + i for i in range(args.usuarios)], args.sembrar, salida)
+
+    mezcla = dict(MEZCLA)
+    for parte in filter(None, (args.mezcla or "").split(",")):
+        flujo, peso = parte.split("=")
+        mezcla[flujo] = float(peso)
+    flujos = [f for f, p in mezcla.items() if p > 0]
+    pesos = [mezcla[f] for f in flujos]
+
+    silencio = open(os.devnull, "w") if not args.verboso else None
+    if silencio:
+        bot.registro.redirigir(silencio)
+    with contextlib.redirect_stdout(silencio) if silencio else contextlib.nullcontext():
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+
+        print(f"🚀 {args.usuarios} usuarios durante {args.duracion:.0f}s, mezcla {mezcla}", file=salida, flush=True)
+        inicio = time.perf_counter()
+        tareas = [asyncio.create_task(sim.usuario(ID_BASE + i, flujos, pesos)) for i in range(args.usuarios)]
+        tareas += [asyncio.create_task(sim.medir_lag()), asyncio.create_task(sim.reportar(inicio))]
+
+        await asyncio.sleep(args.duracion)
+        sim.terminado = True
+        sim.en_cola_al_terminar = len(sim._pendientes)
+        duracion = time.perf_counter() - inicio
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+    informe = sim.informe(duracion)
+    informe["resiliencia"] = bot.resiliencia.estado()
+    informe["registro"] = bot.registro.estado()
+    print(json.dumps(informe, indent=2, ensure_ascii=False), file=salida)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga y resistencia del bot de gastos")
+    parser.add_argument("--usuarios", type=int, default=1000, help="usuarios simulados concurrentes")
+    parser.add_argument("--duracion", type=duracion_segundos, default=300.0, help="segundos, o con sufijo: 90s, 30m, 3h")
+    parser.add_argument("--pausa", type=float, default=20.0, help="pausa media entre acciones de un usuario (s)")
+    parser.add_argument("--latencia-api", type=float, default=40.0, help="latencia media simulada de la Bot API (ms)")
+    parser.add_argument("--mezcla", help="pesos por flujo (gasto, reporte, presupuesto, inline, buscar, "
+                                         "historial), ej: gasto=60,reporte=20,presupuesto=10,inline=10")
+    parser.add_argument("--intervalo", type=float, default=30.0, help="segundos entre líneas de progreso")
+    parser.add_argument("--timeout", type=float, default=60.0, help="espera máxima por update (s)")
+    parser.add_argument("--fallos", type=float, default=0.0, help="probabilidad de error transitorio por llamada al almacén")
+    parser.add_argument("--lentos", type=float, default=0.0, help="probabilidad de llamada lenta al almacén")
+    parser.add_argument("--demora", type=float, default=8.0, help="duración de una llamada lenta (s)")
+    parser.add_argument("--almacen", choices=("emulador", "memoria"), default="emulador",
+                        help="emulador de Firestore (FIRESTORE_EMULATOR_HOST) o firestore_memoria.py")
+    parser.add_argument("--latencia-almacen", type=float, default=20.0,
+                        help="latencia por llamada del almacén en memoria (ms)")
+    parser.add_argument("--sembrar", type=int, default=0, help="gastos previos por usuario antes de empezar")
+    parser.add_argument("--json", help="guardar el informe final en este archivo")
+    parser.add_argument("--verboso", action="store_true", help="no silenciar los print del bot")
+    asyncio.run(correr(parser.parse_args()))
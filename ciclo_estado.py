@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+
+# --- Ciclo de vida del estado por usuario y por chat ---
+#
+# python-telegram-bot guarda user_data y chat_data en memoria sin caducidad.
+# Aquí se registra la última actividad de cada usuario y chat (un
+# TypeHandler en el grupo -4) y un trabajo periódico descarta, con
+# drop_user_data / drop_chat_data, el estado de quienes llevan más de
+# `ttl_segundos` sin escribir. Las conversaciones tienen su propio
+# conversation_timeout, bastante menor, así que lo que se descarta aquí ya
+# no tiene un flujo vivo que lo use.
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tamano_profundo(obj, vistos=None):
+    vistos = set() if vistos is None else vistos
+    if id(obj) in vistos:
+        return 0
+    vistos.add(id(obj))
+    tamano = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        tamano += sum(tamano_profundo(k, vistos) + tamano_profundo(v, vistos) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        tamano += sum(tamano_profundo(v, vistos) for v in obj)
+    return tamano
+
+
+class CicloDeVida:
+    def __init__(self, ttl_segundos):
+        self.ttl = ttl_segundos
+        self.usuarios = {}
+        self.chats = {}
+        self.usuarios_descartados = 0
+        self.chats_descartados = 0
+
+    async def registrar(self, update, context):
+        ahora = time.monotonic()
+        if update.effective_user:
+            self.usuarios[update.effective_user.id] = ahora
+        if update.effective_chat:
+            self.chats[update.effective_chat.id] = ahora
+
+    def barrer(self, app):
+        limite = time.monotonic() - self.ttl
+        usuarios = [u for u in list(app.user_data) if self.usuarios.get(u, 0) < limite]
+        for user_id in usuarios:
+            app.drop_user_data(user_id)
+        chats = [c for c in list(app.chat_data) if self.chats.get(c, 0) < limite]
+        for chat_id in chats:
+            app.drop_chat_data(chat_id)
+
+        self.usuarios = {u: t for u, t in self.usuarios.items() if t >= limite}
+        self.chats = {c: t for c, t in self.chats.items() if t >= limite}
+        self.usuarios_descartados += len(usuarios)
+        self.chats_descartados += len(chats)
+        return len(usuarios), len(chats)
+
+    def reporte(self, app):
+        return {
+            "usuarios_con_estado": len(app.user_data),
+            "chats_con_estado": len(app.chat_data),
+            "bytes_user_data": tamano_profundo(dict(app.user_data)),
+            "bytes_chat_data": tamano_profundo(dict(app.chat_data)),
+            "usuarios_activos": len(self.usuarios),
+            "usuarios_descartados": self.usuarios_descartados,
+            "chats_descartados": self.chats_descartados,
+        }
@@ -0,0 +1,180 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# --- Coherencia en tiempo real de presupuestos y categorías ---
+#
+# Para cada usuario activo se abren listeners `on_snapshot` sobre
+# usuarios/{id}/presupuestos y usuarios/{id}/categorias. Firestore envía
+# primero el estado completo y luego solo los cambios, de modo que las
+# lecturas locales reflejan lo que escriban otras réplicas o la consola sin
+# volver a consultar. Los usuarios inactivos se desconectan y el número total
+# de listeners está acotado.
+#
+# `db` solo necesita exponer collection().document().collection().on_snapshot(cb)
+# devolviendo un objeto con unsubscribe(), así que en pruebas se puede usar
+# un cliente falso que llame a cb(docs, cambios, read_time) a mano.
+#
+# `al_cambiar(user_id)` se llama tras cada cambio que llega después del
+# estado inicial, para descartar lo que se armó con los valores viejos
+# (respuestas inline, reportes guardados). Corre en el hilo del listener.
+#
+# on_snapshot() y unsubscribe() se llaman siempre sin tener el lock:
+# unsubscribe() espera (join) al hilo consumidor del listener, y su callback
+# puede estar esperando justamente ese lock. Bajo el lock solo se decide
+# quién entra y quién sale de `_usuarios`.
+
+COLECCIONES = ("presupuestos", "categorias")
+
+log = logging.getLogger("gastos.coherencia")
+
+
+class _EstadoUsuario:
+    __slots__ = ("listeners", "conectado", "presupuestos", "categorias", "listos", "ultimo_uso")
+
+    def __init__(self):
+        self.listeners = []
+        self.conectado = False  # cuenta para el tope aunque sus listeners aún se estén abriendo
+        self.presupuestos = {}
+        self.categorias = set()
+        self.listos = set()
+        self.ultimo_uso = time.monotonic()
+
+
+class CoherenciaTiempoReal:
+    def __init__(self, db, max_listeners=500, inactividad_segundos=1800, al_cambiar=None):
+        self.db = db
+        self.al_cambiar = al_cambiar
+        self.max_listeners = max_listeners
+        self.inactividad_segundos = inactividad_segundos
+        self._usuarios = OrderedDict()
+        self._lock = threading.RLock()
+        self.eventos = 0
+
+    # --- Lecturas ---
+
+    def presupuestos(self, user_id):
+        estado = self._tocar(user_id)
+        with self._lock:
+            if "presupuestos" not in estado.listos:
+                return None
+            return dict(estado.presupuestos)
+
+    def categorias(self, user_id):
+        estado = self._tocar(user_id)
+        with self._lock:
+            if "categorias" not in estado.listos:
+                return None
+            return set(estado.categorias)
+
+    # --- Escrituras locales (para leer lo propio antes de que llegue el evento) ---
+
+    def guardar_presupuesto(self, user_id, categoria, limite):
+        with self._lock:
+            estado = self._usuarios.get(user_id)
+            if estado is not None:
+                estado.presupuestos[categoria] = limite
+                estado.categorias.add(categoria)
+
+    # --- Ciclo de vida de los listeners ---
+
+    def barrer(self):
+        limite = time.monotonic() - self.inactividad_segundos
+        with self._lock:
+            inactivos = [(u, self._usuarios.pop(u)) for u, e in list(self._usuarios.items()) if e.ultimo_uso < limite]
+        for user_id, estado in inactivos:
+            self._desconectar(user_id, estado)
+        return len(inactivos)
+
+    def cerrar(self):
+        with self._lock:
+            todos, self._usuarios = list(self._usuarios.items()), OrderedDict()
+        for user_id, estado in todos:
+            self._desconectar(user_id, estado)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "usuarios": len(self._usuarios),
+                "listeners": self._total_listeners(),
+                "max_listeners": self.max_listeners,
+                "eventos": self.eventos,
+            }
+
+    def _tocar(self, user_id):
+        # Se llama sin el lock: los listeners se abren y cierran fuera de él
+        with self._lock:
+            estado = self._usuarios.get(user_id)
+            if estado is not None:
+                estado.ultimo_uso = time.monotonic()
+                self._usuarios.move_to_end(user_id)
+                return estado
+
+            expulsados = []
+            while self._usuarios and self._total_listeners() + len(COLECCIONES) > self.max_listeners:
+                expulsados.append(self._usuarios.popitem(last=False))
+
+            estado = _EstadoUsuario()
+            estado.conectado = len(COLECCIONES) <= self.max_listeners
+            self._usuarios[user_id] = estado
+
+        for expulsado, estado_expulsado in expulsados:
+            self._desconectar(expulsado, estado_expulsado)
+        if not estado.conectado:
+            return estado
+
+        usuario_ref = self.db.collection("usuarios").document(user_id)
+        listeners = [
+            usuario_ref.collection(coleccion).on_snapshot(self._crear_callback(user_id, estado, coleccion))
+            for coleccion in COLECCIONES
+        ]
+        with self._lock:
+            vigente = self._usuarios.get(user_id) is estado
+            if vigente:
+                estado.listeners = listeners
+        if not vigente:
+            # Lo expulsaron mientras se abrían sus listeners
+            estado.listeners = listeners
+            self._desconectar(user_id, estado)
+        return estado
+
+    def _desconectar(self, user_id, estado):
+        # Sin el lock: unsubscribe() espera al hilo del listener
+        for listener in estado.listeners:
+            try:
+                listener.unsubscribe()
+            except Exception as e:
+                log.warning("no se pudo cerrar listener", extra={"user_id": user_id, "error": repr(e)})
+
+    def _total_listeners(self):
+        return sum(len(COLECCIONES) for e in self._usuarios.values() if e.conectado)
+
+    def _crear_callback(self, user_id, estado, coleccion):
+        def al_cambiar(docs, cambios, read_time):
+            with self._lock:
+                # Un evento tardío de un usuario ya desconectado no debe revivirlo
+                if self._usuarios.get(user_id) is not estado:
+                    return
+                self.eventos += 1
+                delta = coleccion in estado.listos and bool(cambios)
+                for cambio in cambios:
+                    doc = cambio.document
+                    borrado = cambio.type.name == "REMOVED"
+                    if coleccion == "presupuestos":
+                        if borrado:
+                            estado.presupuestos.pop(doc.id, None)
+                        else:
+                            estado.presupuestos[doc.id] = (doc.to_dict() or {}).get("limite", 0)
+                    else:
+                        if borrado:
+                            estado.categorias.discard(doc.id)
+                        else:
+                            estado.categorias.add(doc.id)
+                estado.listos.add(coleccion)
+            if delta and self.al_cambiar is not None:
+                try:
+                    self.al_cambiar(user_id)
+                except Exception as e:
+                    log.warning("al_cambiar falló", extra={"user_id": user_id, "error": repr(e)})
+        return al_cambiar
@@ -0,0 +1,140 @@
+import time
+import asyncio
+
+import httpx
+from telegram import Bot
+from telegram.request import BaseRequest, HTTPXRequest
+
+# --- Conexiones a la Bot API: interactivas y masivas por separado ---
+#
+# Las respuestas a los usuarios salen por el pool de la Application y los
+# envíos programados (resúmenes, reportes, pronósticos, recurrentes) por un
+# Bot aparte con su propio pool, más chico. Además:
+#
+# - prioridad: un envío masivo espera (hasta `cesion_max` segundos) mientras
+#   haya respuestas interactivas en vuelo, y se espacian a `masivos_por_s`
+#   para no gastar el cupo de mensajes por segundo que Telegram da al bot;
+# - keep-alive: el pool interactivo conserva sus conexiones `keepalive`
+#   segundos para que un toque tras un rato sin tráfico no pague un nuevo
+#   handshake TLS; el masivo las suelta a los pocos segundos de terminar.
+
+
+class PeticionHTTPX(HTTPXRequest):
+    # HTTPXRequest con vencimiento de keep-alive configurable
+    def __init__(self, connection_pool_size=1, keepalive=5.0, **kwargs):
+        self.keepalive = keepalive
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self):
+        limites = self._client_kwargs["limits"]
+        return httpx.AsyncClient(**{
+            **self._client_kwargs,
+            "limits": httpx.Limits(
+                max_connections=limites.max_connections,
+                max_keepalive_connections=limites.max_keepalive_connections,
+                keepalive_expiry=self.keepalive,
+            ),
+        })
+
+
+class Prioridad:
+    def __init__(self, masivos_por_s=20.0, cesion_max=0.5):
+        self.intervalo = 1 / masivos_por_s if masivos_por_s else 0
+        self.cesion_max = cesion_max
+        self.en_vuelo = 0
+        self._libre = asyncio.Event()
+        self._libre.set()
+        self._siguiente = 0.0
+        self.contadores = {"interactivas": 0, "masivas": 0, "masivas_cedidas": 0, "segundos_cedidos": 0.0}
+
+    def entrar(self):
+        self.en_vuelo += 1
+        self.contadores["interactivas"] += 1
+        self._libre.clear()
+
+    def salir(self):
+        self.en_vuelo -= 1
+        if not self.en_vuelo:
+            self._libre.set()
+
+    async def turno(self):
+        # Antes de cada envío masivo: su lugar en el ritmo y luego ceder a lo interactivo
+        self.contadores["masivas"] += 1
+        ahora = time.monotonic()
+        inicio = self._siguiente = max(ahora, self._siguiente + self.intervalo)
+        if inicio > ahora:
+            await asyncio.sleep(inicio - ahora)
+        if self.en_vuelo:
+            self.contadores["masivas_cedidas"] += 1
+            antes = time.monotonic()
+            try:
+                await asyncio.wait_for(self._libre.wait(), self.cesion_max)
+            except asyncio.TimeoutError:
+                pass  # sin hambre: tras cesion_max sale igual
+            self.contadores["segundos_cedidos"] += time.monotonic() - antes
+
+
+class PeticionPriorizada(BaseRequest):
+    # Envuelve otra petición (HTTPX o la Bot API falsa de carga.py) y avisa a Prioridad
+    def __init__(self, peticion, prioridad, interactiva):
+        self.peticion = peticion
+        self.prioridad = prioridad
+        self.interactiva = interactiva
+
+    async def initialize(self):
+        await self.peticion.initialize()
+
+    async def shutdown(self):
+        await self.peticion.shutdown()
+
+    @property
+    def read_timeout(self):
+        return self.peticion.read_timeout
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        tiempos = dict(read_timeout=read_timeout, write_timeout=write_timeout,
+                       connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+        if not self.interactiva:
+            await self.prioridad.turno()
+            return await self.peticion.do_request(url, method, request_data, **tiempos)
+        self.prioridad.entrar()
+        try:
+            return await self.peticion.do_request(url, method, request_data, **tiempos)
+        finally:
+            self.prioridad.salir()
+
+
+class Canales:
+    def __init__(self, conexiones=32, conexiones_masivas=2, keepalive=60.0, masivos_por_s=20.0, cesion_max=0.5):
+        self.conexiones = conexiones
+        self.conexiones_masivas = conexiones_masivas
+        self.keepalive = keepalive
+        self.prioridad = Prioridad(masivos_por_s, cesion_max)
+        self.masivo = None
+
+    def interactiva(self, peticion=None):
+        # Para ApplicationBuilder.request(); un pool_timeout corto: mejor un error que un toque colgado
+        if peticion is None:
+            peticion = PeticionHTTPX(self.conexiones, keepalive=self.keepalive, pool_timeout=5.0)
+        return PeticionPriorizada(peticion, self.prioridad, interactiva=True)
+
+    def crear_bot_masivo(self, token, base_url=None, peticion=None):
+        if peticion is None:
+            # Sin pool_timeout: un envío programado puede esperar su conexión lo que haga falta
+            peticion = PeticionHTTPX(self.conexiones_masivas, keepalive=5.0, pool_timeout=None)
+        peticion = PeticionPriorizada(peticion, self.prioridad, interactiva=False)
+        kwargs = {"base_url": base_url} if base_url else {}
+        self.masivo = Bot(token, request=peticion, get_updates_request=peticion, **kwargs)
+        return self.masivo
+
+    def bot(self, context):
+        # Bot para los trabajos programados; el de la Application si no hay uno aparte
+        return self.masivo or context.bot
+
+    def estadisticas(self):
+        return {
+            **{k: round(v, 1) if isinstance(v, float) else v for k, v in self.prioridad.contadores.items()},
+            "interactivas_en_vuelo": self.prioridad.en_vuelo,
+        }
@@ -0,0 +1,266 @@
+from telegram import MessageEntity, Update
+from telegram.ext import BaseHandler, ConversationHandler
+
+from registro import log
+
+# --- Despacho de updates por tablas ---
+#
+# Un solo handler en el grupo 0 decide qué función atiende cada update con
+# búsquedas exactas en diccionarios, sin probar expresiones regulares una por
+# una:
+#
+# - comandos: por nombre (lo que va entre "/" y "@" o el primer espacio);
+# - botones del teclado de respuesta: por el texto exacto;
+# - botones inline: por callback_data completo ("menu:presupuesto") o por su
+#   prefijo antes de ":" ("his" para "his:p:..."), separado una sola vez.
+#
+# Los flujos de varios pasos (presupuesto, gasto, consulta) son una máquina de
+# estados explícita por chat y usuario: `conversaciones[(chat, usuario)]`
+# guarda el flujo y el estado, cada estado tiene su propia tabla de texto y
+# callbacks, y lo que el estado no atiende pasa a las tablas generales. Las
+# funciones devuelven el estado siguiente como antes (FIN termina, None lo
+# deja igual). Dentro de un flujo, los comandos que no están en `pasan` (o
+# /cancelar) lo cancelan; la entrada de otro flujo lo reemplaza.
+#
+# `al_salir(context, flujo)` se llama cada vez que un flujo deja de estar
+# activo: al terminar (FIN), al expirar y al ser reemplazado por otro, para
+# que el bot limpie lo que guardó en chat_data/user_data para ese flujo.
+
+FIN = ConversationHandler.END
+
+
+class Ruta:
+    __slots__ = ("callback", "flujo")
+
+    def __init__(self, callback, flujo=None):
+        self.callback = callback
+        self.flujo = flujo  # flujo que empieza (o continúa) cuando la función devuelve un estado
+
+
+class Flujo:
+    __slots__ = ("nombre", "cancelar", "pasan", "callbacks")
+
+    def __init__(self, nombre, cancelar, pasan=None, callbacks=None):
+        self.nombre = nombre
+        self.cancelar = Ruta(cancelar)
+        self.pasan = pasan  # comandos que se atienden sin salir del flujo; None = todos menos /cancelar
+        self.callbacks = {clave: Ruta(f) for clave, f in (callbacks or {}).items()}
+
+    def deja_pasar(self, comando):
+        return comando != "cancelar" and (self.pasan is None or comando in self.pasan)
+
+
+class Estado:
+    __slots__ = ("texto", "callbacks")
+
+    def __init__(self, texto=None, callbacks=None):
+        self.texto = Ruta(texto) if texto else None
+        self.callbacks = {clave: Ruta(f) for clave, f in (callbacks or {}).items()}
+
+
+class Conversacion:
+    __slots__ = ("flujo", "estado", "trabajo")
+
+    def __init__(self, flujo, estado):
+        self.flujo = flujo
+        self.estado = estado
+        self.trabajo = None
+
+
+class Despachador(BaseHandler):
+    def __init__(self, texto, comando_desconocido, respaldo_callback, inline=None, plazo=None, al_expirar=None,
+                 flujo_texto=None, al_salir=None):
+        super().__init__(self._sin_ruta)
+        self.comandos = {}
+        self.botones = {}
+        self.callbacks = {}
+        self.flujos = {}
+        self.estados = {}
+        self.texto = Ruta(texto, flujo_texto)  # texto libre que no es botón ni lo espera un estado
+        self.comando_desconocido = Ruta(comando_desconocido)
+        self.respaldo_callback = Ruta(respaldo_callback)
+        self.inline = Ruta(inline) if inline else None
+        self.plazo = plazo
+        self.al_expirar = al_expirar
+        self.al_salir = al_salir
+        self.conversaciones = {}
+        self.expiradas = 0
+
+    # --- Tablas ---
+
+    def agregar_comandos(self, tabla, flujo=None):
+        self.comandos.update({nombre: Ruta(f, flujo) for nombre, f in tabla.items()})
+
+    def agregar_botones(self, tabla, flujo=None):
+        self.botones.update({texto: Ruta(f, flujo) for texto, f in tabla.items()})
+
+    def agregar_callbacks(self, tabla, flujo=None):
+        self.callbacks.update({clave: Ruta(f, flujo) for clave, f in tabla.items()})
+
+    def agregar_flujo(self, nombre, cancelar, pasan=None, callbacks=None):
+        self.flujos[nombre] = Flujo(nombre, cancelar, pasan, callbacks)
+
+    def agregar_estado(self, estado, texto=None, callbacks=None):
+        self.estados[estado] = Estado(texto, callbacks)
+
+    def rutas(self):
+        yield self.texto
+        yield self.comando_desconocido
+        yield self.respaldo_callback
+        if self.inline:
+            yield self.inline
+        for tabla in (self.comandos, self.botones, self.callbacks):
+            yield from tabla.values()
+        for flujo in self.flujos.values():
+            yield flujo.cancelar
+            yield from flujo.callbacks.values()
+        for estado in self.estados.values():
+            if estado.texto:
+                yield estado.texto
+            yield from estado.callbacks.values()
+
+    # --- Ruteo ---
+
+    @staticmethod
+    def clave(update):
+        chat, usuario = update.effective_chat, update.effective_user
+        return (chat.id if chat else None, usuario.id if usuario else None)
+
+    @staticmethod
+    def comando(mensaje):
+        # Nombre del comando en minúsculas; None si no es comando, False si es para otro bot
+        entidades = mensaje.entities
+        if not entidades or entidades[0].type != MessageEntity.BOT_COMMAND or entidades[0].offset != 0:
+            return None
+        nombre, _, destino = mensaje.text[1:entidades[0].length].partition("@")
+        if destino:
+            try:
+                propio = mensaje.get_bot().username
+            except RuntimeError:
+                propio = None
+            if propio and destino.lower() != propio.lower():
+                return False
+        return nombre.lower()
+
+    def rutear(self, update):
+        # (Ruta, args) o None
+        if update.inline_query:
+            return (self.inline, None) if self.inline else None
+        actual = self.conversaciones.get(self.clave(update))
+
+        if update.callback_query:
+            datos = update.callback_query.data
+            if datos is None:
+                return None
+            prefijo = datos.split(":", 1)[0]
+            tablas = []
+            if actual is not None:
+                tablas += [self.estados[actual.estado].callbacks, self.flujos[actual.flujo].callbacks]
+            tablas.append(self.callbacks)
+            for tabla in tablas:
+                ruta = tabla.get(datos) or tabla.get(prefijo)
+                if ruta is not None:
+                    return ruta, None
+            return self.respaldo_callback, None
+
+        mensaje = update.message
+        if mensaje is None or mensaje.text is None:
+            return None
+
+        comando = self.comando(mensaje)
+        if comando is False:
+            return None
+        if comando is not None:
+            args = mensaje.text.split()[1:]
+            ruta = self.comandos.get(comando)
+            if actual is not None:
+                flujo = self.flujos[actual.flujo]
+                otra_entrada = ruta is not None and ruta.flujo not in (None, actual.flujo)
+                if not (otra_entrada or flujo.deja_pasar(comando)):
+                    return flujo.cancelar, args
+            return ruta or self.comando_desconocido, args
+
+        boton = self.botones.get(mensaje.text)
+        if actual is not None and self.estados[actual.estado].texto is not None:
+            # El texto es para el estado, salvo el botón que abre otro flujo
+            if boton is None or boton.flujo in (None, actual.flujo):
+                return self.estados[actual.estado].texto, None
+        return boton or self.texto, None
+
+    # --- Interfaz de BaseHandler ---
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        return self.rutear(update)
+
+    async def handle_update(self, update, application, check_result, context):
+        ruta, args = check_result
+        if args is not None:
+            context.args = args
+        clave = self.clave(update)
+        resultado = await ruta.callback(update, context)
+        self._transicion(clave, ruta, resultado, update, context, application)
+        return resultado
+
+    async def _sin_ruta(self, update, context):
+        pass  # callback de BaseHandler; handle_update llama a la ruta elegida
+
+    # --- Estados ---
+
+    def _transicion(self, clave, ruta, resultado, update, context, application):
+        actual = self.conversaciones.get(clave)
+        if resultado == FIN:
+            self._salir(self.terminar(clave), context)
+            return
+        if resultado is not None:
+            flujo = ruta.flujo or (actual.flujo if actual else None)
+            if flujo is None:
+                log.warning("estado sin flujo", extra={"handler": ruta.callback.__name__, "estado": resultado})
+                return
+            if actual is not None and actual.trabajo is not None:
+                actual.trabajo.schedule_removal()
+            if actual is not None and actual.flujo != flujo:
+                self._salir(actual, context)
+            actual = self.conversaciones[clave] = Conversacion(flujo, resultado)
+        if actual is not None:
+            self._programar(clave, actual, update, context, application)
+
+    def _programar(self, clave, conversacion, update, context, application):
+        # Cada update atendido dentro del flujo reinicia el plazo
+        if conversacion.trabajo is not None:
+            conversacion.trabajo.schedule_removal()
+            conversacion.trabajo = None
+        cola = application.job_queue
+        if not self.plazo or cola is None or not cola.scheduler.running:
+            return
+        conversacion.trabajo = cola.run_once(
+            self._expirar, self.plazo, data=(clave, conversacion, update, context), name=f"flujo:{clave}"
+        )
+
+    async def _expirar(self, contexto_trabajo):
+        clave, conversacion, update, context = contexto_trabajo.job.data
+        if self.conversaciones.get(clave) is not conversacion:
+            return
+        del self.conversaciones[clave]
+        self.expiradas += 1
+        self._salir(conversacion, context)
+        if self.al_expirar is not None:
+            await self.al_expirar(update, context)
+
+    def terminar(self, clave):
+        conversacion = self.conversaciones.pop(clave, None)
+        if conversacion is not None and conversacion.trabajo is not None:
+            conversacion.trabajo.schedule_removal()
+        return conversacion
+
+    def _salir(self, conversacion, context):
+        if conversacion is not None and self.al_salir is not None:
+            self.al_salir(context, conversacion.flujo)
+
+    def estado(self, clave):
+        conversacion = self.conversaciones.get(clave)
+        return (conversacion.flujo, conversacion.estado) if conversacion else None
+
+    def estadisticas(self):
+        return {"conversaciones": len(self.conversaciones), "expiradas": self.expiradas}
@@ -0,0 +1,160 @@
+import os
+import re
+import csv
+import datetime
+import threading
+
+import numpy as np
+
+# --- Tasas de cambio locales ---
+#
+# Las tasas se guardan en un CSV local (fecha,moneda,tasa) con las unidades de
+# la moneda base que vale una unidad de cada moneda ese día. En memoria la
+# tabla es un arreglo denso tasas[día, moneda] desde el primer día conocido
+# hasta el último: los días sin dato repiten la última tasa anterior y las
+# fechas fuera del rango usan el extremo más cercano. Convertir un bloque de
+# gastos es un solo indexado vectorial, sin importar cuántas filas tenga.
+#
+# Los gastos se convierten al registrarse (la tasa de un día pasado ya no
+# cambia), así que los totales, presupuestos e índices siguen sumando
+# enteros en la moneda base.
+
+ALIAS = {
+    "$us": "USD", "us$": "USD", "usd": "USD", "dolar": "USD", "dólar": "USD",
+    "dolares": "USD", "dólares": "USD",
+    "€": "EUR", "eur": "EUR", "euro": "EUR", "euros": "EUR",
+    "£": "GBP", "gbp": "GBP",
+    "mxn": "MXN", "ars": "ARS", "clp": "CLP", "brl": "BRL",
+    "pen": "PEN", "soles": "PEN", "cop": "COP", "jpy": "JPY", "yenes": "JPY",
+}
+
+
+def leer_decimal(texto):
+    # "1.200" y "1,200" son miles; "20.50", "20,5" y "1.234,56" llevan decimales
+    texto = texto.strip()
+    if re.fullmatch(r"\d{1,3}([.,]\d{3})+", texto):
+        return float(re.sub(r"[.,]", "", texto))
+    match = re.fullmatch(r"([\d.,]*?)[.,](\d{1,2})", texto)
+    if match:
+        return float(re.sub(r"[.,]", "", match.group(1)) + "." + match.group(2))
+    return float(re.sub(r"[.,]", "", texto))
+
+
+class TablaCambio:
+    def __init__(self, base="COP", ruta=None):
+        self.base = base
+        self.ruta = ruta
+        self._puntos = {}  # (moneda, fecha) -> tasa
+        self._lock = threading.Lock()
+        self._lock_archivo = threading.Lock()
+        # (primer día ordinal, {moneda: columna}, arreglo) se reemplaza entero
+        self._tabla = (0, {base: 0}, np.ones((1, 1)))
+        if ruta and os.path.exists(ruta):
+            self.cargar_csv(ruta)
+
+    def cargar_csv(self, ruta):
+        # Reemplaza las tasas en memoria por las del archivo; con una fila
+        # inválida (ValueError con su número de línea) no cambia nada.
+        # Lee del disco: desde el bot se llama en un hilo.
+        puntos = {}
+        with open(ruta, newline="", encoding="utf-8") as f:
+            for linea, fila in enumerate(csv.DictReader(f), start=2):
+                try:
+                    clave = (fila["moneda"].strip().upper(), datetime.date.fromisoformat(fila["fecha"].strip()))
+                    tasa = float(fila["tasa"])
+                except (KeyError, AttributeError, TypeError, ValueError) as e:
+                    raise ValueError(f"línea {linea}: {e!r}") from e
+                if not tasa > 0:
+                    raise ValueError(f"línea {linea}: tasa {fila['tasa']!r} no es positiva")
+                puntos[clave] = tasa
+        with self._lock:
+            self._puntos = puntos
+            self._reconstruir()
+        return len(puntos)
+
+    def fijar(self, moneda, fecha, tasa):
+        # Escribe en el disco: desde el bot se llama en un hilo
+        moneda = moneda.upper()
+        with self._lock:
+            self._puntos[(moneda, fecha)] = float(tasa)
+            self._reconstruir()
+        if self.ruta:
+            with self._lock_archivo:
+                nuevo = not os.path.exists(self.ruta)
+                with open(self.ruta, "a", newline="", encoding="utf-8") as f:
+                    escritor = csv.writer(f)
+                    if nuevo:
+                        escritor.writerow(["fecha", "moneda", "tasa"])
+                    escritor.writerow([fecha.isoformat(), moneda, tasa])
+
+    def _reconstruir(self):
+        monedas = sorted({m for m, _ in self._puntos} - {self.base})
+        columnas = {self.base: 0, **{m: i + 1 for i, m in enumerate(monedas)}}
+        fechas = [f.toordinal() for _, f in self._puntos]
+        inicio = min(fechas, default=0)
+        dias = max(fechas, default=0) - inicio + 1
+
+        conocidas = np.full((dias, len(columnas)), np.nan)
+        conocidas[:, 0] = 1.0
+        for (moneda, fecha), tasa in self._puntos.items():
+            if moneda != self.base:
+                conocidas[fecha.toordinal() - inicio, columnas[moneda]] = tasa
+
+        # Cada hueco toma la última tasa conocida; antes de la primera, la primera
+        filas = np.arange(dias)[:, None]
+        ultima = np.maximum.accumulate(np.where(np.isnan(conocidas), -1, filas), axis=0)
+        primera = np.argmax(~np.isnan(conocidas), axis=0)
+        indice = np.where(ultima < 0, primera[None, :], ultima)
+        tasas = conocidas[indice, np.arange(len(columnas))[None, :]]
+        self._tabla = (inicio, columnas, tasas)
+
+    def monedas(self):
+        return sorted(self._tabla[1])
+
+    def moneda_de(self, token, cargada=True):
+        # Código o alias de una moneda (con tasas cargadas si `cargada`), o None
+        token = token.lower()
+        if not cargada:
+            return ALIAS.get(token)
+        moneda = ALIAS.get(token, token.upper() if len(token) == 3 and token.isalpha() else None)
+        return moneda if moneda in self._tabla[1] else None
+
+    def separar(self, texto, cargada=True):
+        # "20 usd taxi", "taxi 20,5 usd", "€12 cena" -> (monto, moneda, descripción); None si no hay moneda
+        tokens = texto.lower().split()
+        for i, token in enumerate(tokens):
+            pegado = re.fullmatch(r"(\d[\d.,]*)(\D+)|(\D+?)(\d[\d.,]*)", token)
+            if pegado:
+                numero, codigo = (pegado.group(1), pegado.group(2)) if pegado.group(1) else (pegado.group(4), pegado.group(3))
+                moneda = self.moneda_de(codigo, cargada)
+                if moneda:
+                    return leer_decimal(numero), moneda, " ".join(tokens[:i] + tokens[i + 1:])
+            if i + 1 < len(tokens):
+                siguiente = tokens[i + 1]
+                for numero, codigo in ((token, siguiente), (siguiente, token)):
+                    moneda = self.moneda_de(codigo, cargada)
+                    if moneda and re.fullmatch(r"\d[\d.,]*", numero):
+                        return leer_decimal(numero), moneda, " ".join(tokens[:i] + tokens[i + 2:])
+        return None
+
+    def sin_tasa(self, texto):
+        # Moneda conocida junto al monto pero sin tasas cargadas ("20 usd" sin tasa de USD)
+        mencionada = self.separar(texto, cargada=False)
+        if mencionada and mencionada[1] not in self._tabla[1]:
+            return mencionada[1]
+        return None
+
+    def convertir(self, montos, monedas, fechas):
+        # montos: arreglo; monedas: códigos; fechas: date o datetime. Devuelve float64 en la moneda base
+        inicio, columnas, tasas = self._tabla
+        cols = np.fromiter((columnas[m] for m in monedas), dtype=np.intp, count=len(monedas))
+        dias = np.fromiter((f.toordinal() for f in fechas), dtype=np.int64, count=len(fechas))
+        return np.asarray(montos, dtype=float) * tasas[np.clip(dias - inicio, 0, len(tasas) - 1), cols]
+
+    def a_base(self, monto, moneda, fecha):
+        if moneda == self.base:
+            return int(round(monto))
+        return int(round(self.convertir([monto], [moneda], [fecha])[0]))
+
+    def tasa(self, moneda, fecha):
+        return float(self.convertir([1.0], [moneda], [fecha])[0])
@@ -0,0 +1,222 @@
+import os
+import csv
+import argparse
+import datetime
+
+import pytz
+
+from archivo import leer_archivados, ya_archivado
+
+# --- Exportación de gastos en streaming ---
+#
+# Los gastos se leen por páginas con cursores (order_by fecha + start_after)
+# y se escriben por bloques, así que la memoria usada no depende del número
+# de filas. Se usa desde el bot (/exportar) y como script para volcados
+# completos: python exportar.py --salida ./volcado
+
+# moneda y monto_original vacíos: el gasto se registró en la moneda base
+COLUMNAS = ["user_id", "fecha", "monto", "categoria", "descripcion", "moneda", "monto_original"]
+FORMATOS = ("csv", "xlsx", "parquet")
+TAM_PAGINA = 1000
+ZONA = pytz.timezone("America/Bogota")
+
+
+def paginar_gastos(db, user_id, desde=None, hasta=None, tam_pagina=TAM_PAGINA, en_curso=()):
+    consulta = db.collection("usuarios").document(user_id).collection("gastos")
+    if desde is not None:
+        consulta = consulta.where("fecha", ">=", desde)
+    if hasta is not None:
+        consulta = consulta.where("fecha", "<", hasta)
+    consulta = consulta.order_by("fecha").limit(tam_pagina)
+
+    ultimo = None
+    while True:
+        pagina = consulta.start_after(ultimo) if ultimo is not None else consulta
+        docs = list(pagina.stream())
+        if not docs:
+            return
+        filas = [d for d in (doc.to_dict() for doc in docs) if not ya_archivado(d.get("fecha"), en_curso)]
+        if filas:
+            yield [fila_desde_doc(user_id, d) for d in filas]
+        if len(docs) < tam_pagina:
+            return
+        ultimo = docs[-1]
+
+
+def paginas_usuario(db, user_id, desde=None, hasta=None, tam_pagina=TAM_PAGINA):
+    # Meses compactados primero (ya vienen en orden), luego los originales
+    # salvo los de meses cuyo archivo todavía se está borrando
+    pagina, en_curso = [], []
+    for d in leer_archivados(db, user_id, desde, hasta, en_curso):
+        pagina.append(fila_desde_doc(user_id, d))
+        if len(pagina) >= tam_pagina:
+            yield pagina
+            pagina = []
+    if pagina:
+        yield pagina
+    yield from paginar_gastos(db, user_id, desde, hasta, tam_pagina, en_curso)
+
+
+def fila_desde_doc(user_id, d):
+    fecha = d.get("fecha")
+    if isinstance(fecha, datetime.datetime):
+        fecha = fecha.astimezone(ZONA)
+    return (
+        user_id,
+        fecha,
+        d.get("monto", 0),
+        d.get("categoria", "otros"),
+        d.get("descripcion", ""),
+        d.get("moneda", ""),
+        d.get("monto_original"),
+    )
+
+
+# --- Escritores por formato ---
+
+class EscritorCSV:
+    def __init__(self, ruta):
+        self.archivo = open(ruta, "w", newline="", encoding="utf-8")
+        self.csv = csv.writer(self.archivo)
+        self.csv.writerow(COLUMNAS)
+
+    def escribir(self, filas):
+        self.csv.writerows(
+            (u, f.isoformat() if isinstance(f, datetime.datetime) else f, m, c, d, mo, mor)
+            for u, f, m, c, d, mo, mor in filas
+        )
+
+    def cerrar(self):
+        self.archivo.close()
+
+
+class EscritorXLSX:
+    def __init__(self, ruta):
+        from openpyxl import Workbook
+
+        self.ruta = ruta
+        # write_only vuelca las filas a disco a medida que se agregan
+        self.libro = Workbook(write_only=True)
+        self.hoja = self.libro.create_sheet("gastos")
+        self.hoja.append(COLUMNAS)
+
+    def escribir(self, filas):
+        for u, f, m, c, d, mo, mor in filas:
+            if isinstance(f, datetime.datetime):
+                f = f.replace(tzinfo=None)  # Excel no admite zona horaria
+            self.hoja.append([u, f, m, c, d, mo, mor])
+
+    def cerrar(self):
+        self.libro.save(self.ruta)
+
+
+class EscritorParquet:
+    def __init__(self, ruta):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.esquema = pa.schema([
+            ("user_id", pa.string()),
+            ("fecha", pa.timestamp("ms", tz="America/Bogota")),
+            ("monto", pa.int64()),
+            ("categoria", pa.string()),
+            ("descripcion", pa.string()),
+            ("moneda", pa.string()),
+            ("monto_original", pa.float64()),
+        ])
+        self.escritor = pq.ParquetWriter(ruta, self.esquema, compression="zstd")
+
+    def escribir(self, filas):
+        if not filas:
+            return
+        columnas = list(zip(*filas))
+        tabla = self.pa.Table.from_arrays(
+            [self.pa.array(col, type=campo.type) for col, campo in zip(columnas, self.esquema)],
+            schema=self.esquema
+        )
+        self.escritor.write_table(tabla)
+
+    def cerrar(self):
+        self.escritor.close()
+
+
+ESCRITORES = {"csv": EscritorCSV, "xlsx": EscritorXLSX, "parquet": EscritorParquet}
+
+
+def exportar_usuario(db, user_id, ruta, formato="csv", desde=None, hasta=None):
+    escritor = ESCRITORES[formato](ruta)
+    filas = 0
+    try:
+        for pagina in paginas_usuario(db, user_id, desde, hasta):
+            escritor.escribir(pagina)
+            filas += len(pagina)
+    finally:
+        escritor.cerrar()
+    return filas
+
+
+# --- Volcado completo: una partición Parquet por mes ---
+
+class VolcadoPorMes:
+    def __init__(self, directorio, tam_bloque=50_000):
+        self.directorio = directorio
+        self.tam_bloque = tam_bloque
+        self.escritores = {}
+        self.pendientes = {}
+        self.filas = 0
+
+    def agregar(self, filas):
+        for fila in filas:
+            mes = fila[1].strftime("%Y-%m") if isinstance(fila[1], datetime.datetime) else "sin_fecha"
+            bloque = self.pendientes.setdefault(mes, [])
+            bloque.append(fila)
+            if len(bloque) >= self.tam_bloque:
+                self._vaciar(mes)
+        self.filas += len(filas)
+
+    def cerrar(self):
+        for mes in list(self.pendientes):
+            self._vaciar(mes)
+        for escritor in self.escritores.values():
+            escritor.cerrar()
+
+    def _vaciar(self, mes):
+        bloque = self.pendientes.pop(mes, [])
+        if not bloque:
+            return
+        if mes not in self.escritores:
+            carpeta = os.path.join(self.directorio, f"mes={mes}")
+            os.makedirs(carpeta, exist_ok=True)
+            self.escritores[mes] = EscritorParquet(os.path.join(carpeta, "gastos.parquet"))
+        self.escritores[mes].escribir(bloque)
+
+
+def volcar_todos(db, directorio, desde=None, hasta=None):
+    volcado = VolcadoPorMes(directorio)
+    try:
+        for usuario in db.collection("usuarios").select([]).stream():
+            for pagina in paginas_usuario(db, usuario.id, desde, hasta):
+                volcado.agregar(pagina)
+    finally:
+        volcado.cerrar()
+    return volcado.filas
+
+
+def _fecha_argumento(texto):
+    return ZONA.localize(datetime.datetime.strptime(texto, "%Y-%m-%d"))
+
+
+if __name__ == "__main__":
+    from google.cloud import firestore
+
+    argumentos = argparse.ArgumentParser(description="Volcado de gastos de todos los usuarios a Parquet")
+    argumentos.add_argument("--salida", required=True, help="Directorio de salida")
+    argumentos.add_argument("--desde", type=_fecha_argumento, help="AAAA-MM-DD (incluido)")
+    argumentos.add_argument("--hasta", type=_fecha_argumento, help="AAAA-MM-DD (excluido)")
+    args = argumentos.parse_args()
+
+    inicio = datetime.datetime.now()
+    total_filas = volcar_todos(firestore.Client(), args.salida, args.desde, args.hasta)
+    segundos = (datetime.datetime.now() - inicio).total_seconds()
+    print(f"✅ {total_filas} gastos exportados en {segundos:.1f}s a {args.salida}")
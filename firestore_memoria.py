@@ -0,0 +1,643 @@
+import copy
+import time
+import bisect
+import random
+import string
+import datetime
+import threading
+
+from google.api_core import exceptions as gexc
+from google.cloud.firestore_v1.transforms import Increment, Sentinel
+from google.cloud.firestore_v1.watch import ChangeType
+
+# --- Firestore en memoria ---
+#
+# Un cliente con la misma forma que google.cloud.firestore.Client para lo que
+# usa el bot: colecciones anidadas, get/set(merge)/update/create/delete,
+# lotes atómicos, Increment, get_all, collection_group, consultas con
+# where/order_by/start_after/limit/select, precondiciones last_update_time y
+# listeners on_snapshot. Sirve para las pruebas y para carga.py sin el
+# emulador. Todo pasa bajo un lock: los hilos de Resiliencia y de la
+# bitácora pueden usarlo a la vez.
+#
+# `latencia` (segundos por llamada) simula la red; `fallo` (una excepción)
+# hace fallar cada llamada mientras esté puesto. `contadores` cuenta llamadas,
+# documentos leídos y escrituras como las factura Firestore.
+#
+# Como Firestore, una consulta no recorre toda la colección: los filtros
+# array_contains usan un índice invertido y el orden de cada forma de
+# consulta (filtros + order_by) se guarda hasta la próxima escritura en la
+# colección, así que la página N con cursor cuesta lo que devuelve.
+
+UTC = datetime.timezone.utc
+EPOCA = datetime.datetime(1970, 1, 1, tzinfo=UTC)
+ALFABETO = string.ascii_letters + string.digits
+
+
+def _normalizar(valor):
+    # Firestore guarda las fechas en UTC (las ingenuas se toman como UTC)
+    if isinstance(valor, datetime.datetime):
+        return valor.replace(tzinfo=UTC) if valor.tzinfo is None else valor.astimezone(UTC)
+    if isinstance(valor, dict):
+        return {k: _normalizar(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_normalizar(v) for v in valor]
+    return valor
+
+
+def _aplicar(actual, nuevo, merge):
+    # Resuelve Increment contra el valor actual; con merge los mapas se mezclan
+    if isinstance(nuevo, Increment):
+        base = actual if isinstance(actual, (int, float)) and not isinstance(actual, bool) else 0
+        return base + nuevo.value
+    if isinstance(nuevo, Sentinel):
+        return datetime.datetime.now(UTC)
+    if isinstance(nuevo, dict):
+        base = actual if merge and isinstance(actual, dict) else {}
+        resultado = dict(base)
+        for clave, valor in nuevo.items():
+            resultado[clave] = _aplicar(base.get(clave), valor, merge)
+        return resultado
+    return _normalizar(nuevo)
+
+
+def _campo(datos, ruta):
+    actual = datos
+    for parte in ruta.split("."):
+        if not isinstance(actual, dict) or parte not in actual:
+            return _FALTA
+        actual = actual[parte]
+    return actual
+
+
+_FALTA = object()
+
+
+# --- Orden de valores (tipos primero, como Firestore) ---
+
+def _rango(valor):
+    if valor is None:
+        return (0,)
+    if isinstance(valor, bool):
+        return (1, valor)
+    if isinstance(valor, (int, float)):
+        return (2, valor)
+    if isinstance(valor, datetime.datetime):
+        return (3, valor)
+    if isinstance(valor, str):
+        return (4, valor)
+    if isinstance(valor, bytes):
+        return (5, valor)
+    if isinstance(valor, RefDocumento):
+        return (6, valor._ruta)
+    if isinstance(valor, list):
+        return (8, tuple(_rango(v) for v in valor))
+    return (9, repr(valor))
+
+
+class _Invertido:
+    __slots__ = ("clave",)
+
+    def __init__(self, clave):
+        self.clave = clave
+
+    def __lt__(self, otro):
+        return otro.clave < self.clave
+
+    def __gt__(self, otro):
+        return otro.clave > self.clave
+
+    def __eq__(self, otro):
+        return self.clave == otro.clave
+
+    def __le__(self, otro):
+        return not self > otro
+
+    def __ge__(self, otro):
+        return not self < otro
+
+
+# --- Instantáneas ---
+
+class Instantanea:
+    def __init__(self, referencia, datos, update_time=None, read_time=None, campos=None):
+        self.reference = referencia
+        self._datos = datos
+        self.update_time = update_time
+        self.create_time = update_time
+        self.read_time = read_time
+        self._campos = campos
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._datos is not None
+
+    def to_dict(self):
+        if self._datos is None:
+            return None
+        if self._campos is None:
+            return copy.deepcopy(self._datos)
+        return {c: copy.deepcopy(self._datos[c]) for c in self._campos if c in self._datos}
+
+    def get(self, campo):
+        valor = _campo(self._datos or {}, campo)
+        if valor is _FALTA:
+            raise KeyError(campo)
+        return copy.deepcopy(valor)
+
+
+class ResultadoEscritura:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class Precondicion:
+    def __init__(self, last_update_time=None, exists=None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+
+class Cambio:
+    def __init__(self, tipo, documento):
+        self.type = tipo
+        self.document = documento
+
+
+class Oyente:
+    def __init__(self, cliente, ruta, callback):
+        self.cliente = cliente
+        self.ruta = ruta
+        self.callback = callback
+
+    def unsubscribe(self):
+        self.cliente._quitar_oyente(self)
+
+
+# --- Consultas ---
+
+class Consulta:
+    def __init__(self, cliente, ruta=None, grupo=None, filtros=(), ordenes=(), limite=None, cursor=None,
+                 campos=None):
+        self._cliente = cliente
+        self._ruta = ruta          # ruta de la colección, o None para collection_group
+        self._grupo = grupo
+        self._filtros = filtros
+        self._ordenes = ordenes
+        self._limite = limite
+        self._cursor = cursor
+        self._campos = campos
+
+    def _copiar(self, **cambios):
+        args = dict(ruta=self._ruta, grupo=self._grupo, filtros=self._filtros, ordenes=self._ordenes,
+                    limite=self._limite, cursor=self._cursor, campos=self._campos)
+        args.update(cambios)
+        return Consulta(self._cliente, **args)
+
+    def where(self, campo, operador, valor):
+        return self._copiar(filtros=self._filtros + ((campo, operador, _normalizar(valor)),))
+
+    def order_by(self, campo, direction="ASCENDING"):
+        return self._copiar(ordenes=self._ordenes + ((campo, direction == "DESCENDING"),))
+
+    def limit(self, n):
+        return self._copiar(limite=n)
+
+    def start_after(self, cursor):
+        return self._copiar(cursor=cursor)
+
+    def select(self, campos):
+        return self._copiar(campos=tuple(campos))
+
+    def stream(self, transaction=None):
+        return iter(self._cliente._consultar(self))
+
+    def get(self, transaction=None):
+        return self._cliente._consultar(self)
+
+    # --- Evaluación (con el lock del cliente tomado) ---
+
+    def _orden_efectivo(self):
+        ordenes = list(self._ordenes)
+        desigualdades = [c for c, op, _ in self._filtros if op in ("<", "<=", ">", ">=", "!=")]
+        if desigualdades and not ordenes:
+            ordenes.append((desigualdades[0], False))
+        if not any(c == "__name__" for c, _ in ordenes):
+            ordenes.append(("__name__", ordenes[-1][1] if ordenes else False))
+        return ordenes
+
+    def _cumple(self, datos):
+        for campo, operador, esperado in self._filtros:
+            valor = _campo(datos, campo)
+            if valor is _FALTA:
+                return False
+            if operador == "array_contains":
+                if not isinstance(valor, list) or esperado not in valor:
+                    return False
+            elif operador == "array_contains_any":
+                if not isinstance(valor, list) or not any(e in valor for e in esperado):
+                    return False
+            elif operador == "in":
+                if valor not in esperado:
+                    return False
+            elif operador == "not-in":
+                if valor in esperado:
+                    return False
+            else:
+                a, b = _rango(valor), _rango(esperado)
+                if operador != "==" and operador != "!=" and a[0] != b[0]:
+                    return False
+                if not {
+                    "==": a == b, "!=": a != b, "<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b
+                }[operador]:
+                    return False
+        return True
+
+    def _clave(self, ordenes, ruta_doc, datos):
+        partes = []
+        for campo, desc in ordenes:
+            clave = ruta_doc if campo == "__name__" else _rango(datos.get(campo) if "." not in campo
+                                                                 else _campo(datos, campo))
+            partes.append(_Invertido(clave) if desc else clave)
+        return tuple(partes)
+
+    def _clave_cursor(self, ordenes):
+        cursor = self._cursor
+        if isinstance(cursor, Instantanea):
+            return self._clave(ordenes, cursor.reference._ruta, cursor._datos or {})
+        partes = []
+        for campo, desc in ordenes:
+            if campo not in cursor:
+                break
+            valor = cursor[campo]
+            if campo == "__name__":
+                clave = valor._ruta if isinstance(valor, RefDocumento) else f"{self._ruta}/{valor}"
+            else:
+                clave = _rango(_normalizar(valor))
+            partes.append(_Invertido(clave) if desc else clave)
+        return tuple(partes)
+
+
+# --- Referencias ---
+
+class RefColeccion(Consulta):
+    def __init__(self, cliente, ruta):
+        super().__init__(cliente, ruta=ruta)
+
+    @property
+    def id(self):
+        return self._ruta.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        if "/" not in self._ruta:
+            return None
+        return RefDocumento(self._cliente, self._ruta.rsplit("/", 1)[0])
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = "".join(random.choices(ALFABETO, k=20))
+        return RefDocumento(self._cliente, f"{self._ruta}/{document_id}")
+
+    def add(self, datos, document_id=None):
+        ref = self.document(document_id)
+        resultado = ref.create(datos)
+        return resultado.update_time, ref
+
+    def list_documents(self):
+        with self._cliente._lock:
+            ids = list(self._cliente._colecciones.get(self._ruta, {}))
+        return [self.document(i) for i in ids]
+
+    def on_snapshot(self, callback):
+        return self._cliente._agregar_oyente(self._ruta, callback)
+
+
+class RefDocumento:
+    def __init__(self, cliente, ruta):
+        self._cliente = cliente
+        self._ruta = ruta
+
+    def __eq__(self, otro):
+        return isinstance(otro, RefDocumento) and otro._ruta == self._ruta
+
+    def __hash__(self):
+        return hash(self._ruta)
+
+    def __repr__(self):
+        return f"RefDocumento({self._ruta!r})"
+
+    @property
+    def id(self):
+        return self._ruta.rsplit("/", 1)[-1]
+
+    @property
+    def path(self):
+        return self._ruta
+
+    @property
+    def parent(self):
+        return RefColeccion(self._cliente, self._ruta.rsplit("/", 1)[0])
+
+    def collection(self, nombre):
+        return RefColeccion(self._cliente, f"{self._ruta}/{nombre}")
+
+    def get(self, field_paths=None, transaction=None):
+        return self._cliente._leer([self], field_paths)[0]
+
+    def create(self, datos):
+        return self._cliente._escribir([("create", self, datos, None)])[0]
+
+    def set(self, datos, merge=False):
+        return self._cliente._escribir([("set", self, datos, merge)])[0]
+
+    def update(self, datos, option=None):
+        return self._cliente._escribir([("update", self, datos, option)])[0]
+
+    def delete(self, option=None):
+        return self._cliente._escribir([("delete", self, None, option)])[0]
+
+
+class Lote:
+    def __init__(self, cliente):
+        self._cliente = cliente
+        self._ops = []
+
+    def __len__(self):
+        return len(self._ops)
+
+    def create(self, ref, datos):
+        self._ops.append(("create", ref, datos, None))
+        return self
+
+    def set(self, ref, datos, merge=False):
+        self._ops.append(("set", ref, datos, merge))
+        return self
+
+    def update(self, ref, datos, option=None):
+        self._ops.append(("update", ref, datos, option))
+        return self
+
+    def delete(self, ref, option=None):
+        self._ops.append(("delete", ref, None, option))
+        return self
+
+    def commit(self, retry=None, timeout=None):
+        ops, self._ops = self._ops, []
+        if not ops:
+            return []
+        return self._cliente._escribir(ops)
+
+
+# --- Cliente ---
+
+class ClienteMemoria:
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.fallo = None
+        self._lock = threading.RLock()
+        self._colecciones = {}    # ruta de colección -> {id: (datos, update_time)}
+        self._oyentes = {}        # ruta de colección -> [Oyente]
+        self._invertidos = {}     # (ruta de colección, campo) -> {valor: {id}}
+        self._ordenados = {}      # forma de la consulta -> (versión, claves, filas)
+        self._versiones = {}      # ruta de colección -> escrituras
+        self._reloj = 0
+        self.contadores = {"llamadas": 0, "lecturas": 0, "escrituras": 0}
+
+    # --- API pública (la de firestore.Client) ---
+
+    def collection(self, nombre):
+        return RefColeccion(self, nombre)
+
+    def document(self, ruta):
+        return RefDocumento(self, ruta)
+
+    def collection_group(self, nombre):
+        return Consulta(self, grupo=nombre)
+
+    def batch(self):
+        return Lote(self)
+
+    def get_all(self, refs, field_paths=None, transaction=None):
+        refs = list(refs)
+        if not refs:
+            return iter([])
+        return iter(self._leer(refs, field_paths))
+
+    def write_option(self, last_update_time=None, exists=None):
+        return Precondicion(last_update_time, exists)
+
+    def close(self):
+        pass
+
+    # --- Interno ---
+
+    def _llamada(self):
+        if self.latencia:
+            time.sleep(self.latencia)
+        if self.fallo is not None:
+            raise self.fallo
+        self.contadores["llamadas"] += 1
+
+    def _tick(self):
+        self._reloj += 1
+        return EPOCA + datetime.timedelta(days=20000, microseconds=self._reloj)
+
+    def _doc(self, ruta):
+        coleccion, doc_id = ruta.rsplit("/", 1)
+        return self._colecciones.get(coleccion, {}).get(doc_id)
+
+    def _leer(self, refs, field_paths=None):
+        self._llamada()
+        with self._lock:
+            lectura = self._tick()
+            resultado = []
+            for ref in refs:
+                guardado = self._doc(ref._ruta)
+                datos, actualizado = guardado if guardado else (None, None)
+                campos = tuple(field_paths) if field_paths is not None else None
+                resultado.append(Instantanea(ref, copy.deepcopy(datos), actualizado, lectura, campos))
+            self.contadores["lecturas"] += len(refs)
+            return resultado
+
+    def _consultar(self, consulta):
+        self._llamada()
+        with self._lock:
+            ordenes = consulta._orden_efectivo()
+            claves, filas = self._ordenar(consulta, ordenes)
+            inicio = 0
+            if consulta._cursor is not None:
+                clave = consulta._clave_cursor(ordenes)
+                inicio = bisect.bisect_right(claves, clave)
+                while inicio < len(claves) and claves[inicio][:len(clave)] == clave:
+                    inicio += 1
+            fin = len(filas) if consulta._limite is None else inicio + consulta._limite
+            elegidas = filas[inicio:fin]
+            lectura = self._tick()
+            self.contadores["lecturas"] += max(1, len(elegidas))
+            return [
+                Instantanea(RefDocumento(self, ruta_doc), copy.deepcopy(datos), actualizado, lectura,
+                            consulta._campos)
+                for ruta_doc, datos, actualizado in elegidas
+            ]
+
+    def _ordenar(self, consulta, ordenes):
+        # Resultado completo y ordenado de la consulta sin cursor ni límite
+        forma = (consulta._ruta, consulta._grupo, repr(consulta._filtros), tuple(ordenes))
+        version = self._versiones.get(consulta._ruta) if consulta._ruta is not None else None
+        guardado = self._ordenados.get(forma)
+        if guardado is not None and version is not None and guardado[0] == version:
+            return guardado[1], guardado[2]
+
+        if consulta._ruta is not None:
+            fuentes = [(consulta._ruta, self._colecciones.get(consulta._ruta, {}))]
+        else:
+            fuentes = [(r, c) for r, c in self._colecciones.items() if r.rsplit("/", 1)[-1] == consulta._grupo]
+        # Un order_by sobre un campo excluye a los documentos que no lo tienen
+        requeridos = [c for c, _ in ordenes if c != "__name__"]
+        contiene = next(((c, v) for c, op, v in consulta._filtros if op == "array_contains"), None)
+        candidatos = []
+        for ruta, docs in fuentes:
+            ids = docs.keys() if contiene is None else self._invertido(ruta, contiene[0]).get(contiene[1], ())
+            for doc_id in ids:
+                datos, actualizado = docs[doc_id]
+                if any(_campo(datos, c) is _FALTA for c in requeridos) or not consulta._cumple(datos):
+                    continue
+                ruta_doc = f"{ruta}/{doc_id}"
+                candidatos.append((consulta._clave(ordenes, ruta_doc, datos), ruta_doc, datos, actualizado))
+        candidatos.sort(key=lambda c: c[0])
+        claves = [c[0] for c in candidatos]
+        filas = [c[1:] for c in candidatos]
+        if version is not None:
+            self._ordenados[forma] = (version, claves, filas)
+            if len(self._ordenados) > 1000:
+                self._ordenados.pop(next(iter(self._ordenados)))
+        return claves, filas
+
+    def _invertido(self, coleccion, campo):
+        indice = self._invertidos.get((coleccion, campo))
+        if indice is None:
+            indice = self._invertidos[(coleccion, campo)] = {}
+            for doc_id, (datos, _) in self._colecciones.get(coleccion, {}).items():
+                self._indexar(indice, campo, doc_id, datos, 1)
+        return indice
+
+    def _indexar(self, indice, campo, doc_id, datos, signo):
+        valores = _campo(datos, campo)
+        if not isinstance(valores, list):
+            return
+        for valor in valores:
+            try:
+                if signo > 0:
+                    indice.setdefault(valor, set()).add(doc_id)
+                else:
+                    indice.get(valor, set()).discard(doc_id)
+            except TypeError:
+                pass  # valores no hasheables (mapas) no se indexan: no hay array_contains sobre ellos
+
+    def _escribir(self, ops):
+        self._llamada()
+        avisos = []
+        with self._lock:
+            # Primero se validan todas las operaciones: el lote se aplica entero o nada
+            vista = {}
+            for tipo, ref, datos, extra in ops:
+                ruta = ref._ruta
+                existente = vista[ruta] if ruta in vista else self._doc(ruta)
+                if tipo == "create" and existente is not None:
+                    raise gexc.AlreadyExists(f"Document already exists: {ruta}")
+                if tipo == "update" and existente is None:
+                    raise gexc.NotFound(f"No document to update: {ruta}")
+                if tipo in ("update", "delete") and isinstance(extra, Precondicion):
+                    if extra.exists is not None and extra.exists != (existente is not None):
+                        raise gexc.FailedPrecondition(f"exists precondition failed: {ruta}")
+                    if extra.last_update_time is not None and (
+                            existente is None or existente[1] != extra.last_update_time):
+                        raise gexc.FailedPrecondition(f"update_time precondition failed: {ruta}")
+                vista[ruta] = self._nuevo_valor(tipo, existente, datos, extra)
+            actualizado = self._tick()
+            for ruta, valor in vista.items():
+                coleccion, doc_id = ruta.rsplit("/", 1)
+                docs = self._colecciones.setdefault(coleccion, {})
+                anterior = docs.get(doc_id)
+                for (ruta_indice, campo), indice in self._invertidos.items():
+                    if ruta_indice == coleccion:
+                        if anterior is not None:
+                            self._indexar(indice, campo, doc_id, anterior[0], -1)
+                        if valor is not None:
+                            self._indexar(indice, campo, doc_id, valor[0], 1)
+                if valor is None:
+                    docs.pop(doc_id, None)
+                else:
+                    docs[doc_id] = (valor[0], actualizado)
+                self._versiones[coleccion] = self._versiones.get(coleccion, 0) + 1
+                if coleccion in self._oyentes and (anterior is not None or valor is not None):
+                    avisos.append((coleccion, doc_id, anterior, valor))
+            self.contadores["escrituras"] += len(ops)
+            entregas = self._preparar_avisos(avisos, actualizado)
+        for oyente, docs, cambios in entregas:
+            oyente.callback(docs, cambios, actualizado)
+        return [ResultadoEscritura(actualizado) for _ in ops]
+
+    def _nuevo_valor(self, tipo, existente, datos, extra):
+        if tipo == "delete":
+            return None
+        actual = existente[0] if existente is not None else {}
+        if tipo in ("create", "set"):
+            return (_aplicar(actual, datos, merge=bool(extra)), None)
+        nuevo = copy.deepcopy(actual)
+        for ruta_campo, valor in datos.items():
+            partes = ruta_campo.split(".")
+            destino = nuevo
+            for parte in partes[:-1]:
+                if not isinstance(destino.get(parte), dict):
+                    destino[parte] = {}
+                destino = destino[parte]
+            destino[partes[-1]] = _aplicar(destino.get(partes[-1]), valor, merge=False)
+        return (nuevo, None)
+
+    # --- Listeners ---
+
+    def _instantaneas(self, coleccion, lectura):
+        return [
+            Instantanea(RefDocumento(self, f"{coleccion}/{doc_id}"), copy.deepcopy(datos), actualizado, lectura)
+            for doc_id, (datos, actualizado) in sorted(self._colecciones.get(coleccion, {}).items())
+        ]
+
+    def _preparar_avisos(self, avisos, lectura):
+        por_coleccion = {}
+        for coleccion, doc_id, anterior, valor in avisos:
+            ref = RefDocumento(self, f"{coleccion}/{doc_id}")
+            if valor is None:
+                cambio = Cambio(ChangeType.REMOVED, Instantanea(ref, copy.deepcopy(anterior[0]), anterior[1], lectura))
+            else:
+                tipo = ChangeType.ADDED if anterior is None else ChangeType.MODIFIED
+                cambio = Cambio(tipo, Instantanea(ref, copy.deepcopy(valor[0]), lectura, lectura))
+            por_coleccion.setdefault(coleccion, []).append(cambio)
+        entregas = []
+        for coleccion, cambios in por_coleccion.items():
+            docs = self._instantaneas(coleccion, lectura)
+            for oyente in self._oyentes.get(coleccion, []):
+                entregas.append((oyente, docs, cambios))
+        return entregas
+
+    def _agregar_oyente(self, coleccion, callback):
+        oyente = Oyente(self, coleccion, callback)
+        with self._lock:
+            self._oyentes.setdefault(coleccion, []).append(oyente)
+            lectura = self._tick()
+            docs = self._instantaneas(coleccion, lectura)
+        # Como Firestore: primero el estado completo, todo como ADDED
+        callback(docs, [Cambio(ChangeType.ADDED, d) for d in docs], lectura)
+        return oyente
+
+    def _quitar_oyente(self, oyente):
+        with self._lock:
+            oyentes = self._oyentes.get(oyente.ruta, [])
+            if oyente in oyentes:
+                oyentes.remove(oyente)
+            if not oyentes:
+                self._oyentes.pop(oyente.ruta, None)
@@ -0,0 +1,180 @@
+import os
+import math
+import logging
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+# --- Gráficos sin matplotlib ---
+#
+# Dibuja directamente con Pillow los gráficos que envía el bot: pastel por
+# categoría (equivalente a plt.pie(..., autopct="%1.1f%%", startangle=90)),
+# barras y tendencia mensual. Se dibuja al doble de tamaño y se reduce para
+# suavizar los bordes. Con GRAFICOS_MOTOR=matplotlib se usa el motor anterior,
+# que solo se importa si hace falta.
+
+MOTOR = os.getenv("GRAFICOS_MOTOR", "pillow").lower()
+
+log = logging.getLogger("gastos.graficos")
+
+TAMANO = 600
+ESCALA = 2
+# Ciclo de colores por defecto de matplotlib (tab10)
+COLORES = [
+    "#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
+    "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf",
+]
+
+_fuentes = {}
+
+
+def _fuente(tamano):
+    if tamano not in _fuentes:
+        try:
+            _fuentes[tamano] = ImageFont.truetype("DejaVuSans.ttf", tamano)
+        except OSError:
+            _fuentes[tamano] = ImageFont.load_default(size=tamano)
+    return _fuentes[tamano]
+
+
+def _lienzo():
+    lado = TAMANO * ESCALA
+    imagen = Image.new("RGB", (lado, lado), "white")
+    return imagen, ImageDraw.Draw(imagen)
+
+
+def _texto_centrado(draw, x, y, texto, tamano, color="black"):
+    draw.text((x, y), texto, fill=color, font=_fuente(tamano * ESCALA), anchor="mm")
+
+
+def _a_png(imagen):
+    imagen = imagen.resize((TAMANO, TAMANO), Image.LANCZOS)
+    buf = BytesIO()
+    imagen.save(buf, format="PNG", optimize=True)
+    buf.seek(0)
+    return buf
+
+
+def _pastel_pillow(categorias, valores, titulo):
+    imagen, draw = _lienzo()
+    lado = TAMANO * ESCALA
+    centro_x, centro_y = lado / 2, lado / 2 + 20 * ESCALA
+    radio = lado * 0.32
+    total = float(sum(valores)) or 1.0
+
+    _texto_centrado(draw, lado / 2, 30 * ESCALA, titulo, 16)
+
+    # Ángulos en sentido antihorario desde las 12, como startangle=90 en matplotlib.
+    # Pillow mide en sentido horario desde las 3, de ahí el cambio de signo.
+    angulo = 90.0
+    caja = [centro_x - radio, centro_y - radio, centro_x + radio, centro_y + radio]
+    etiquetas = []
+    for i, (categoria, valor) in enumerate(zip(categorias, valores)):
+        barrido = 360.0 * valor / total
+        draw.pieslice(caja, -(angulo + barrido), -angulo, fill=COLORES[i % len(COLORES)])
+        medio = math.radians(angulo + barrido / 2)
+        etiquetas.append((categoria, valor / total, math.cos(medio), -math.sin(medio)))
+        angulo += barrido
+
+    for categoria, fraccion, dx, dy in etiquetas:
+        _texto_centrado(draw, centro_x + dx * radio * 0.6, centro_y + dy * radio * 0.6, f"{fraccion * 100:.1f}%", 12)
+        ancla = "lm" if dx >= 0 else "rm"
+        draw.text(
+            (centro_x + dx * radio * 1.1, centro_y + dy * radio * 1.1),
+            str(categoria), fill="black", font=_fuente(13 * ESCALA), anchor=ancla
+        )
+    return _a_png(imagen)
+
+
+def _barras_pillow(categorias, valores, titulo):
+    imagen, draw = _lienzo()
+    lado = TAMANO * ESCALA
+    margen_izq, margen_der = 70 * ESCALA, 20 * ESCALA
+    arriba, abajo = 70 * ESCALA, lado - 90 * ESCALA
+    maximo = float(max(valores)) if valores else 1.0
+    maximo = maximo or 1.0
+
+    _texto_centrado(draw, lado / 2, 30 * ESCALA, titulo, 16)
+    draw.line([(margen_izq, abajo), (lado - margen_der, abajo)], fill="black", width=ESCALA)
+
+    ancho_total = lado - margen_izq - margen_der
+    paso = ancho_total / max(len(valores), 1)
+    for i, (categoria, valor) in enumerate(zip(categorias, valores)):
+        x0 = margen_izq + i * paso + paso * 0.15
+        x1 = margen_izq + (i + 1) * paso - paso * 0.15
+        y0 = abajo - (abajo - arriba) * valor / maximo
+        draw.rectangle([x0, y0, x1, abajo], fill=COLORES[i % len(COLORES)])
+        _texto_centrado(draw, (x0 + x1) / 2, y0 - 12 * ESCALA, _compacto(valor), 11)
+        _texto_centrado(draw, (x0 + x1) / 2, abajo + 18 * ESCALA, str(categoria), 11)
+    return _a_png(imagen)
+
+
+def _tendencia_pillow(meses, valores, titulo):
+    imagen, draw = _lienzo()
+    lado = TAMANO * ESCALA
+    margen_izq, margen_der = 70 * ESCALA, 40 * ESCALA
+    arriba, abajo = 70 * ESCALA, lado - 90 * ESCALA
+    maximo = float(max(valores)) if valores else 1.0
+    maximo = maximo or 1.0
+
+    _texto_centrado(draw, lado / 2, 30 * ESCALA, titulo, 16)
+    draw.line([(margen_izq, abajo), (lado - margen_der, abajo)], fill="black", width=ESCALA)
+
+    paso = (lado - margen_izq - margen_der) / max(len(valores) - 1, 1)
+    puntos = [
+        (margen_izq + i * paso, abajo - (abajo - arriba) * valor / maximo)
+        for i, valor in enumerate(valores)
+    ]
+    if len(puntos) > 1:
+        draw.line(puntos, fill=COLORES[0], width=3 * ESCALA, joint="curve")
+    r = 5 * ESCALA
+    for (x, y), mes, valor in zip(puntos, meses, valores):
+        draw.ellipse([x - r, y - r, x + r, y + r], fill=COLORES[0])
+        _texto_centrado(draw, x, y - 16 * ESCALA, _compacto(valor), 11)
+        _texto_centrado(draw, x, abajo + 18 * ESCALA, str(mes), 11)
+    return _a_png(imagen)
+
+
+def _compacto(valor):
+    if valor >= 1_000_000:
+        return f"{valor / 1_000_000:.1f}M"
+    if valor >= 1_000:
+        return f"{valor / 1_000:.0f}k"
+    return f"{valor:.0f}"
+
+
+# --- Motor matplotlib (respaldo) ---
+
+def _matplotlib(tipo, etiquetas, valores, titulo):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(6, 6))
+    if tipo == "pastel":
+        plt.pie(valores, labels=etiquetas, autopct="%1.1f%%", startangle=90)
+    elif tipo == "barras":
+        plt.bar(etiquetas, valores, color=COLORES[:len(valores)])
+    else:
+        plt.plot(etiquetas, valores, marker="o")
+    plt.title(titulo)
+    plt.tight_layout()
+
+    buf = BytesIO()
+    plt.savefig(buf, format="png")
+    plt.close()
+    buf.seek(0)
+    return buf
+
+
+_PILLOW = {"pastel": _pastel_pillow, "barras": _barras_pillow, "tendencia": _tendencia_pillow}
+
+
+def renderizar(tipo, etiquetas, valores, titulo):
+    if MOTOR == "matplotlib":
+        return _matplotlib(tipo, etiquetas, valores, titulo)
+    try:
+        return _PILLOW[tipo](etiquetas, valores, titulo)
+    except Exception as e:
+        log.warning("falló el gráfico con Pillow; usando matplotlib", extra={"error": repr(e)})
+        return _matplotlib(tipo, etiquetas, valores, titulo)
@@ -0,0 +1,92 @@
+import random
+
+import pytz
+from google.api_core import exceptions as gexc
+from google.cloud import firestore
+
+# --- Libros de gastos compartidos para chats de grupo ---
+#
+# Los gastos de un grupo se guardan en grupos/{chat_id}/gastos y el total del
+# mes por categoría se lleva en contadores repartidos en N shards:
+# grupos/{chat_id}/contadores/{AAAA-MM}/shards/{i}. Cada gasto incrementa un
+# shard elegido al azar, así varios miembros escribiendo a la vez no chocan
+# con el límite de escrituras por documento de Firestore; la lectura suma
+# los N shards en una sola consulta.
+#
+# El mes de un grupo se cuenta siempre en ZONA, sin importar la zona de quien
+# registra, para que escritura y lectura usen la misma clave AAAA-MM. El id
+# del gasto lo decide quien llama y el gasto se escribe con create(): si un
+# reintento repite un lote que ya se aplicó, Firestore lo rechaza entero y el
+# shard no suma dos veces.
+
+NUM_SHARDS = 10
+ZONA = pytz.timezone("America/Bogota")
+
+
+def grupo_ref(db, chat_id):
+    return db.collection("grupos").document(str(chat_id))
+
+
+def mes_grupo(fecha):
+    return fecha.astimezone(ZONA).strftime("%Y-%m")
+
+
+def nuevo_gasto_id(db, chat_id):
+    # Generado en el cliente, sin ir a Firestore
+    return grupo_ref(db, chat_id).collection("gastos").document().id
+
+
+def registrar_gasto_grupo(db, chat_id, gasto_id, user_id, monto, categoria, fecha, descripcion="",
+                          num_shards=NUM_SHARDS):
+    ref = grupo_ref(db, chat_id)
+    gasto_ref = ref.collection("gastos").document(gasto_id)
+    shard_ref = ref.collection("contadores").document(mes_grupo(fecha)) \
+        .collection("shards").document(str(random.randrange(num_shards)))
+
+    lote = db.batch()
+    lote.create(gasto_ref, {
+        "monto": monto,
+        "categoria": categoria,
+        "descripcion": descripcion,
+        "fecha": fecha,
+        "user_id": user_id
+    })
+    lote.set(shard_ref, {
+        "totales": {categoria: firestore.Increment(monto)},
+        "cantidad": firestore.Increment(1)
+    }, merge=True)
+    try:
+        lote.commit()
+    except gexc.AlreadyExists:
+        pass  # un intento anterior sí llegó
+    return gasto_id
+
+
+def totales_mes_grupo(db, chat_id, mes):
+    totales = {}
+    shards = grupo_ref(db, chat_id).collection("contadores").document(mes) \
+        .collection("shards").stream()
+    for shard in shards:
+        for categoria, monto in (shard.to_dict().get("totales") or {}).items():
+            totales[categoria] = totales.get(categoria, 0) + monto
+    return totales
+
+
+def presupuestos_grupo(db, chat_id):
+    docs = grupo_ref(db, chat_id).collection("presupuestos").stream()
+    return {doc.id: doc.to_dict().get("limite", 0) for doc in docs}
+
+
+def guardar_presupuesto_grupo(db, chat_id, categoria, limite, user_id):
+    ref = grupo_ref(db, chat_id)
+    lote = db.batch()
+    lote.set(ref.collection("presupuestos").document(categoria), {
+        "limite": limite,
+        "actualizado_por": user_id
+    })
+    lote.set(ref.collection("categorias").document(categoria), {"nombre": categoria}, merge=True)
+    lote.commit()
+
+
+def categorias_grupo(db, chat_id):
+    return [doc.id for doc in grupo_ref(db, chat_id).collection("categorias").stream()]
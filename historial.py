@@ -0,0 +1,46 @@
+from busqueda import aplicar_cursor, cursor_de, ordenar_recientes
+
+# --- Historial paginado y borrado en lote ---
+#
+# Cada página es una sola consulta acotada: fecha DESC, __name__ DESC,
+# start_after(cursor), limit(TAM_PAGINA). El cursor de la página siguiente
+# viaja en callback_data. El borrado junta los gastos seleccionados en
+# WriteBatch de hasta TAM_LOTE borrados, con una sola escritura del índice
+# de descripciones y una por año del índice diario en cada lote.
+
+TAM_PAGINA = 8
+TAM_LOTE = 400
+
+
+def pagina_historial(db, user_id, cursor=None, tam_pagina=TAM_PAGINA):
+    gastos_ref = db.collection("usuarios").document(user_id).collection("gastos")
+    consulta = ordenar_recientes(gastos_ref)
+    if cursor is not None:
+        consulta = aplicar_cursor(consulta, gastos_ref, cursor)
+    docs = list(consulta.limit(tam_pagina).stream())
+    siguiente = cursor_de(docs[-1]) if len(docs) == tam_pagina else None
+    return [(doc.id, doc.to_dict()) for doc in docs], siguiente
+
+
+def eliminar_gastos(db, user_id, gastos, indice=None, indice_diario=None):
+    # gastos: {gasto_id: {"monto": ..., "categoria": ..., "descripcion": ..., "fecha": ...}}
+    gastos_ref = db.collection("usuarios").document(user_id).collection("gastos")
+    ids = list(gastos)
+    for i in range(0, len(ids), TAM_LOTE):
+        lote = db.batch()
+        deltas = {}
+        for gasto_id in ids[i:i + TAM_LOTE]:
+            lote.delete(gastos_ref.document(gasto_id))
+            g = gastos[gasto_id]
+            if g.get("descripcion"):
+                clave = (g["descripcion"], g["categoria"])
+                deltas[clave] = deltas.get(clave, 0) - 1
+        if indice is not None and deltas:
+            indice.registrar_varios(lote, user_id, deltas)
+        if indice_diario is not None:
+            indice_diario.registrar_varios(lote, user_id, [
+                (gastos[gasto_id]["categoria"], gastos[gasto_id]["fecha"], -gastos[gasto_id]["monto"])
+                for gasto_id in ids[i:i + TAM_LOTE]
+            ])
+        lote.commit()
+    return ids
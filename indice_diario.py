@@ -0,0 +1,159 @@
+import datetime
+import threading
+from array import array
+from itertools import accumulate
+from collections import OrderedDict
+
+from google.api_core import exceptions as gexc
+from google.cloud import firestore
+
+# --- Índice diario de sumas acumuladas por usuario y año ---
+#
+# Un documento por usuario y año (usuarios/{id}/indices/diario-{AAAA}) con
+# {dias: {categoria: {dia_del_año: suma}}, completo: True}. Cada gasto suma
+# su monto con un Increment en la misma escritura del gasto y cada borrado lo
+# resta, así el documento no necesita transacciones. Al leerlo se arma, una
+# vez, un arreglo de sumas acumuladas por categoría (367 posiciones) y el
+# total de cualquier rango es prefijo[hasta] - prefijo[desde].
+#
+# Los documentos anteriores a este índice no tienen `completo`: la primera
+# lectura los reconstruye desde los gastos (incluido el archivo) con
+# `lector(user_id, desde, hasta)`. La reconstrucción se escribe con la
+# precondición del update_time leído antes de recorrer los gastos: si entre
+# tanto llegó un Increment (un gasto nuevo o borrado), la escritura falla y se
+# vuelve a recorrer en vez de pisar ese incremento.
+
+DIAS_ANIO = 367  # posición 0 = antes del 1 de enero; 366 = 31 de diciembre bisiesto
+INTENTOS_RECONSTRUCCION = 5
+
+
+def dia_del_anio(fecha):
+    return fecha.timetuple().tm_yday
+
+
+class IndiceDiario:
+    # lector(user_id, desde, hasta) -> iterable de {monto, categoria, fecha}
+    # zona(user_id) -> tzinfo del usuario
+    def __init__(self, db, lector, zona, max_entradas=1000):
+        self.db = db
+        self.lector = lector
+        self.zona = zona
+        self.max_entradas = max_entradas
+        self._prefijos = OrderedDict()
+        self._lock = threading.RLock()
+        self.reconstrucciones = 0
+
+    def __len__(self):
+        return len(self._prefijos)
+
+    def ref(self, user_id, anio):
+        return self.db.collection("usuarios").document(user_id).collection("indices").document(f"diario-{anio}")
+
+    def registrar(self, lote, user_id, categoria, fecha, monto):
+        # monto negativo para un borrado
+        self.registrar_varios(lote, user_id, [(categoria, fecha, monto)])
+
+    def registrar_varios(self, lote, user_id, movimientos):
+        # Una sola escritura por año tocado, sin importar cuántos gastos haya en el lote
+        tz = self.zona(user_id)
+        por_anio = {}
+        for categoria, fecha, monto in movimientos:
+            local = fecha.astimezone(tz)
+            clave = (categoria, dia_del_anio(local))
+            sumas = por_anio.setdefault(local.year, {})
+            sumas[clave] = sumas.get(clave, 0) + int(monto)
+
+        for anio, sumas in por_anio.items():
+            dias = {}
+            for (categoria, dia), monto in sumas.items():
+                dias.setdefault(categoria, {})[str(dia)] = firestore.Increment(monto)
+            lote.set(self.ref(user_id, anio), {"dias": dias}, merge=True)
+
+            with self._lock:
+                prefijos = self._prefijos.get((user_id, anio))
+                if prefijos is None:
+                    continue
+                for (categoria, dia), monto in sumas.items():
+                    acumulado = prefijos.setdefault(categoria, array("q", bytes(8 * DIAS_ANIO)))
+                    for i in range(dia, DIAS_ANIO):
+                        acumulado[i] += monto
+
+    def _recorrer(self, user_id, anio):
+        tz = self.zona(user_id)
+        desde = tz.localize(datetime.datetime(anio, 1, 1))
+        hasta = tz.localize(datetime.datetime(anio + 1, 1, 1))
+        dias = {}
+        for d in self.lector(user_id, desde, hasta):
+            dia = str(dia_del_anio(d["fecha"].astimezone(tz)))
+            por_dia = dias.setdefault(d["categoria"], {})
+            por_dia[dia] = por_dia.get(dia, 0) + int(d["monto"])
+        return dias
+
+    def _reconstruir(self, user_id, anio, doc):
+        # doc: la lectura hecha antes de recorrer los gastos
+        ref = self.ref(user_id, anio)
+        for _ in range(INTENTOS_RECONSTRUCCION):
+            dias = self._recorrer(user_id, anio)
+            try:
+                if doc.exists:
+                    ref.update({"dias": dias, "completo": True},
+                               option=self.db.write_option(last_update_time=doc.update_time))
+                else:
+                    ref.create({"dias": dias, "completo": True})
+            except (gexc.FailedPrecondition, gexc.AlreadyExists):
+                # Otro gasto (u otra reconstrucción) escribió entre la lectura y la escritura
+                doc = ref.get()
+                datos = doc.to_dict() if doc.exists else {}
+                if datos.get("completo"):
+                    return datos.get("dias", {})
+                continue
+            self.reconstrucciones += 1
+            return dias
+        raise gexc.Aborted(f"índice diario de {user_id}/{anio} sin reconstruir tras {INTENTOS_RECONSTRUCCION} intentos")
+
+    def prefijos(self, user_id, anio):
+        with self._lock:
+            prefijos = self._prefijos.get((user_id, anio))
+            if prefijos is not None:
+                self._prefijos.move_to_end((user_id, anio))
+                return prefijos
+
+        doc = self.ref(user_id, anio).get()
+        datos = doc.to_dict() if doc.exists else {}
+        dias = datos.get("dias", {}) if datos.get("completo") else self._reconstruir(user_id, anio, doc)
+
+        prefijos = {}
+        for categoria, por_dia in dias.items():
+            diario = [0] * DIAS_ANIO
+            for dia, monto in por_dia.items():
+                diario[int(dia)] += int(monto)
+            prefijos[categoria] = array("q", accumulate(diario))
+
+        with self._lock:
+            self._prefijos[(user_id, anio)] = prefijos
+            if len(self._prefijos) > self.max_entradas:
+                self._prefijos.popitem(last=False)
+        return prefijos
+
+    def por_categoria(self, user_id, desde, hasta):
+        # desde incluido, hasta excluido (fechas locales del usuario)
+        totales = {}
+        for anio in range(desde.year, hasta.year + 1):
+            inicio = dia_del_anio(desde) - 1 if anio == desde.year else 0
+            fin = dia_del_anio(hasta) - 1 if anio == hasta.year else DIAS_ANIO - 1
+            if fin <= inicio:
+                continue
+            for categoria, acumulado in self.prefijos(user_id, anio).items():
+                suma = acumulado[fin] - acumulado[inicio]
+                if suma:
+                    totales[categoria] = totales.get(categoria, 0) + suma
+        return totales
+
+    def total(self, user_id, desde, hasta, categoria=None):
+        totales = self.por_categoria(user_id, desde, hasta)
+        return totales.get(categoria, 0) if categoria else sum(totales.values())
+
+    def invalidar(self, user_id):
+        with self._lock:
+            for clave in [c for c in self._prefijos if c[0] == user_id]:
+                del self._prefijos[clave]
@@ -0,0 +1,162 @@
+import time
+import asyncio
+import contextvars
+from functools import wraps
+from collections import OrderedDict
+
+# --- Límite de consultas costosas por usuario ---
+#
+# Cada usuario tiene una cubeta de `rafaga` fichas que se rellena a
+# `por_minuto` fichas por minuto; cada consulta costosa (resumen, total,
+# gráfico, comparativas) gasta una. Lo que la consulta respondió se guarda por
+# usuario, comando y argumentos:
+#
+# - si se repite dentro de `ventana` segundos, se responde lo guardado sin
+#   calcular ni gastar ficha;
+# - si llega igual a otra que aún se está calculando para el mismo usuario,
+#   espera ese resultado en vez de calcular otra vez;
+# - sin fichas, se responde lo último guardado (de cualquier antigüedad) o se
+#   pide esperar.
+#
+# Cualquier cambio en los gastos del usuario descarta lo guardado (olvidar).
+#
+# Lo que se guarda es la lista de envíos que hizo el handler (anotar): la
+# función y sus argumentos, p. ej. (responder, texto) o (responder_foto,
+# file_id), para repetirlos tal cual.
+
+grabacion = contextvars.ContextVar("limitador_grabacion", default=None)
+
+
+class Limitador:
+    def __init__(self, rafaga=5, por_minuto=6, ventana=30, max_respuestas=5000, aviso=None):
+        self.rafaga = rafaga
+        self.por_segundo = por_minuto / 60
+        self.ventana = ventana
+        self.max_respuestas = max_respuestas
+        # aviso(update, segundos) se llama cuando no hay ficha ni respuesta guardada
+        self.aviso = aviso
+        self._cubetas = {}                 # user_id -> [fichas, último relleno]
+        self._respuestas = OrderedDict()   # (user_id, comando, args) -> (momento, envíos)
+        self._en_curso = {}                # (user_id, comando, args) -> Future
+        self.contadores = {
+            "calculadas": 0, "repetidas": 0, "colapsadas": 0,
+            "limitadas_con_respuesta": 0, "rechazadas": 0,
+        }
+
+    @property
+    def activo(self):
+        return self.rafaga > 0
+
+    # --- Cubeta de fichas ---
+
+    def _tomar_ficha(self, user_id, ahora):
+        fichas, ultimo = self._cubetas.get(user_id, (self.rafaga, ahora))
+        fichas = min(self.rafaga, fichas + (ahora - ultimo) * self.por_segundo)
+        if fichas < 1:
+            self._cubetas[user_id] = [fichas, ahora]
+            return (1 - fichas) / self.por_segundo if self.por_segundo else None
+        self._cubetas[user_id] = [fichas - 1, ahora]
+        return 0
+
+    # --- Respuestas guardadas ---
+
+    def anotar(self, funcion, *args, **kwargs):
+        envios = grabacion.get()
+        if envios is not None:
+            envios.append((funcion, args, kwargs))
+
+    async def _repetir(self, update, envios):
+        for funcion, args, kwargs in envios:
+            await funcion(update, *args, **kwargs)
+
+    def _guardar(self, clave, envios, ahora):
+        self._respuestas[clave] = (ahora, envios)
+        self._respuestas.move_to_end(clave)
+        if len(self._respuestas) > self.max_respuestas:
+            self._respuestas.popitem(last=False)
+
+    def olvidar(self, user_id):
+        for clave in [c for c in self._respuestas if c[0] == user_id]:
+            del self._respuestas[clave]
+
+    # --- Decorador para los handlers ---
+
+    def limitar(self, handler):
+        nombre = handler.__name__
+
+        @wraps(handler)
+        async def envoltura(update, context):
+            if not self.activo or update.effective_user is None:
+                return await handler(update, context)
+            user_id = str(update.effective_user.id)
+            clave = (user_id, nombre, tuple(context.args or ()))
+            ahora = time.monotonic()
+
+            guardada = self._respuestas.get(clave)
+            if guardada is not None and ahora - guardada[0] < self.ventana:
+                self.contadores["repetidas"] += 1
+                await self._repetir(update, guardada[1])
+                return
+
+            futuro = self._en_curso.get(clave)
+            if futuro is not None:
+                self.contadores["colapsadas"] += 1
+                await self._repetir(update, await asyncio.shield(futuro))
+                return
+
+            espera = self._tomar_ficha(user_id, ahora)
+            if espera:
+                if guardada is not None:
+                    self.contadores["limitadas_con_respuesta"] += 1
+                    await self._repetir(update, guardada[1])
+                else:
+                    self.contadores["rechazadas"] += 1
+                    if self.aviso is not None:
+                        await self.aviso(update, espera)
+                return
+
+            self.contadores["calculadas"] += 1
+            futuro = self._en_curso[clave] = asyncio.get_running_loop().create_future()
+            envios = []
+            token = grabacion.set(envios)
+            try:
+                resultado = await handler(update, context)
+            except BaseException as e:
+                futuro.set_exception(e)
+                futuro.exception()  # las que esperaban reciben el error; sin ellas no se avisa
+                raise
+            else:
+                futuro.set_result(envios)
+                # Solo se guarda lo que se respondió de verdad (no un error a medias)
+                if envios:
+                    self._guardar(clave, envios, time.monotonic())
+                return resultado
+            finally:
+                grabacion.reset(token)
+                del self._en_curso[clave]
+
+        return envoltura
+
+    # --- Mantenimiento ---
+
+    def barrer(self):
+        # Cubetas que ya estarían llenas y respuestas vencidas hace rato
+        ahora = time.monotonic()
+        llenas = [
+            u for u, (fichas, ultimo) in self._cubetas.items()
+            if fichas + (ahora - ultimo) * self.por_segundo >= self.rafaga
+        ]
+        for user_id in llenas:
+            del self._cubetas[user_id]
+        viejas = [c for c, (momento, _) in self._respuestas.items() if ahora - momento > 10 * self.ventana]
+        for clave in viejas:
+            del self._respuestas[clave]
+        return len(llenas), len(viejas)
+
+    def estadisticas(self):
+        return {
+            **self.contadores,
+            "cubetas": len(self._cubetas),
+            "respuestas": len(self._respuestas),
+            "en_curso": len(self._en_curso),
+        }
@@ -0,0 +1,266 @@
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import random
+import hashlib
+import asyncio
+import datetime
+import threading
+import contextvars
+from collections import Counter, deque
+from functools import wraps
+
+from telegram.ext import BaseUpdateProcessor
+
+import registro
+
+# --- Perfilado por muestreo y captura de updates lentos ---
+#
+# ProcesadorPerfilado envuelve el procesamiento de cada update (vía
+# concurrent_updates de ApplicationBuilder). Todos se cronometran y llevan la
+# línea de tiempo de sus llamadas al almacén (observador de Resiliencia); una
+# fracción `fraccion` además se perfila con un muestreador de pilas: un hilo
+# que cada `intervalo` segundos lee el frame actual del hilo del event loop
+# mientras haya algún update muestreado en curso. No instrumenta cada llamada
+# como cProfile, así que el costo no depende de cuánto código corra.
+#
+# Un update que tarda más de `umbral_ms` se guarda como JSON en `directorio`
+# (handler, llamadas al almacén, perfil si fue muestreado y el update con los
+# datos personales enmascarados). Se conservan los últimos `max_archivos`.
+
+captura_actual = contextvars.ContextVar("captura_actual", default=None)
+
+CAMPOS_PERSONALES = {"first_name", "last_name", "username", "phone_number", "email", "title", "bio"}
+CAMPOS_ID = {"id", "user_id", "chat_id"}
+CAMPOS_TEXTO = {"text", "caption", "query"}
+PROFUNDIDAD_PILA = 40
+
+
+class Captura:
+    __slots__ = ("update", "inicio", "duracion_ms", "handlers", "llamadas", "muestras", "muestreada")
+
+    def __init__(self, update, muestreada):
+        self.update = update
+        self.inicio = time.perf_counter()
+        self.duracion_ms = 0.0
+        self.handlers = []
+        self.llamadas = []
+        self.muestras = Counter()
+        self.muestreada = muestreada
+
+    def handler(self):
+        return " → ".join(self.handlers) or "sin handler"
+
+
+def colapsar_pila(frame):
+    # "archivo:función:línea;..." desde la raíz, el formato de los flamegraphs
+    partes = []
+    while frame is not None and len(partes) < PROFUNDIDAD_PILA:
+        codigo = frame.f_code
+        partes.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(partes))
+
+
+class Muestreador:
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self.activas = set()
+        self.muestras_tomadas = 0
+        self._hilo_loop = None
+        self._hay_activas = threading.Event()
+        self._hilo = None
+
+    def iniciar(self, captura):
+        self._hilo_loop = threading.get_ident()
+        self.activas.add(captura)
+        self._hay_activas.set()
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._correr, name="muestreador", daemon=True)
+            self._hilo.start()
+
+    def terminar(self, captura):
+        self.activas.discard(captura)
+        if not self.activas:
+            self._hay_activas.clear()
+
+    def _correr(self):
+        while True:
+            self._hay_activas.wait()
+            time.sleep(self.intervalo)
+            frame = sys._current_frames().get(self._hilo_loop)
+            if frame is None:
+                continue
+            pila = colapsar_pila(frame)
+            del frame
+            for captura in list(self.activas):
+                captura.muestras[pila] += 1
+            self.muestras_tomadas += 1
+
+
+def enmascarar(valor, sal, clave=None):
+    if isinstance(valor, dict):
+        return {k: enmascarar(v, sal, k) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [enmascarar(v, sal, clave) for v in valor]
+    if clave in CAMPOS_PERSONALES and isinstance(valor, str):
+        return "***"
+    if clave in CAMPOS_ID and isinstance(valor, int):
+        # Mismo usuario, mismo seudónimo dentro del proceso; no reversible
+        return "u" + hashlib.sha256(f"{sal}{valor}".encode()).hexdigest()[:10]
+    if clave in CAMPOS_TEXTO and isinstance(valor, str):
+        # Se conservan comandos, montos y la forma del texto
+        if valor.startswith("/"):
+            comando, _, resto = valor.partition(" ")
+            return comando + (" " + re.sub(r"[^\W\d_]", "x", resto) if resto else "")
+        return re.sub(r"[^\W\d_]", "x", valor)
+    return valor
+
+
+class Perfilador:
+    def __init__(self, fraccion=0.0, umbral_ms=0, directorio="capturas_lentas", max_archivos=200,
+                 intervalo=0.005, recientes=500):
+        self.fraccion = fraccion
+        self.umbral_ms = umbral_ms
+        self.directorio = directorio
+        self.max_archivos = max_archivos
+        self.muestreador = Muestreador(intervalo)
+        self.recientes = deque(maxlen=recientes)
+        self.updates = 0
+        self.muestreados = 0
+        self.capturados = 0
+        self._sal = os.urandom(8).hex()
+
+    @property
+    def activo(self):
+        return self.fraccion > 0 or self.umbral_ms > 0
+
+    # --- Enganches ---
+
+    def instrumentar(self, app):
+        # Envuelve los callbacks de los handlers (y de cada ruta del
+        # despachador) para saber cuál atendió el update, en la captura y en
+        # el contexto del registro
+        def envolver(handler):
+            if hasattr(handler, "rutas"):
+                for ruta in handler.rutas():
+                    envolver(ruta)
+                return
+            if getattr(handler.callback, "_perfilado", False):
+                return
+            callback = handler.callback
+            nombre = getattr(callback, "__name__", type(handler).__name__)
+
+            @wraps(callback)
+            async def envoltura(update, context):
+                registro.marcar_handler(nombre)
+                captura = captura_actual.get()
+                if captura is not None:
+                    captura.handlers.append(nombre)
+                return await callback(update, context)
+
+            envoltura._perfilado = True
+            handler.callback = envoltura
+
+        for grupo, handlers in app.handlers.items():
+            if grupo != 0:
+                continue  # los otros grupos son registro y medición, corren en todos los updates
+            for handler in handlers:
+                envolver(handler)
+
+    def observar_llamada(self, operacion, inicio, duracion, resultado):
+        # Observador de Resiliencia.llamar; inicio en perf_counter
+        captura = captura_actual.get()
+        if captura is not None:
+            captura.llamadas.append((operacion, (inicio - captura.inicio) * 1000, duracion * 1000, resultado))
+
+    async def procesar(self, update, coroutine):
+        self.updates += 1
+        muestreada = random.random() < self.fraccion
+        captura = Captura(update, muestreada)
+        token = captura_actual.set(captura)
+        if muestreada:
+            self.muestreados += 1
+            self.muestreador.iniciar(captura)
+        try:
+            await coroutine
+        finally:
+            if muestreada:
+                self.muestreador.terminar(captura)
+            captura.duracion_ms = (time.perf_counter() - captura.inicio) * 1000
+            captura_actual.reset(token)
+            self._cerrar(captura)
+
+    # --- Resultados ---
+
+    def _cerrar(self, captura):
+        archivo = None
+        if self.umbral_ms and captura.duracion_ms >= self.umbral_ms:
+            self.capturados += 1
+            archivo = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{self.capturados:06d}.json"
+            datos = self._serializar(captura)
+            asyncio.get_running_loop().run_in_executor(None, self._escribir, archivo, datos)
+        self.recientes.append((
+            captura.duracion_ms, captura.handler(), len(captura.llamadas),
+            sum(d for _, _, d, _ in captura.llamadas), archivo
+        ))
+
+    def _serializar(self, captura):
+        update = captura.update
+        payload = update.to_dict() if hasattr(update, "to_dict") else repr(update)
+        return {
+            "duracion_ms": round(captura.duracion_ms, 1),
+            "handler": captura.handler(),
+            "llamadas_almacen": [
+                {"operacion": op, "inicio_ms": round(ini, 1), "duracion_ms": round(dur, 1), "resultado": res}
+                for op, ini, dur, res in captura.llamadas
+            ],
+            "muestreado": captura.muestreada,
+            "perfil": [
+                {"pila": pila, "muestras": n} for pila, n in captura.muestras.most_common()
+            ],
+            "update": enmascarar(payload, self._sal),
+        }
+
+    def _escribir(self, archivo, datos):
+        os.makedirs(self.directorio, exist_ok=True)
+        with open(os.path.join(self.directorio, archivo), "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False, indent=1)
+        existentes = sorted(a for a in os.listdir(self.directorio) if a.endswith(".json"))
+        for viejo in existentes[:-self.max_archivos]:
+            os.remove(os.path.join(self.directorio, viejo))
+
+    def mas_lentos(self, n=10):
+        return heapq.nlargest(n, self.recientes, key=lambda r: r[0])
+
+    def leer_captura(self, archivo):
+        with open(os.path.join(self.directorio, archivo), encoding="utf-8") as f:
+            return json.load(f)
+
+    def estado(self):
+        return {
+            "fraccion": self.fraccion,
+            "umbral_ms": self.umbral_ms,
+            "updates": self.updates,
+            "muestreados": self.muestreados,
+            "capturados": self.capturados,
+            "muestras": self.muestreador.muestras_tomadas,
+        }
+
+
+class ProcesadorPerfilado(BaseUpdateProcessor):
+    def __init__(self, perfilador, max_concurrent_updates=1):
+        super().__init__(max_concurrent_updates)
+        self.perfilador = perfilador
+
+    async def do_process_update(self, update, coroutine):
+        await self.perfilador.procesar(update, coroutine)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,90 @@
+import numpy as np
+
+from cache_gastos import nombre_categoria
+
+# --- Pronóstico del gasto a fin de mes ---
+#
+# Cada (usuario, categoría) es una fila de una matriz de gasto diario del mes
+# en curso. El ritmo diario es un promedio con pesos exponenciales (media
+# vida de MEDIA_VIDA_DIAS) sobre los días ya vividos, de modo que un gasto
+# grande a principio de mes pesa cada vez menos. Los gastos recurrentes
+# (ids rec-...) cuentan en lo gastado pero no en el ritmo: no se repiten en
+# el mes. Una categoría con menos de MIN_DIAS_CON_GASTO días de gasto no se
+# extrapola. Con el ritmo se proyecta el total a fin de mes y el día en que se
+# cruzaría el límite. Todo el cálculo es vectorial: una sola pasada sirve
+# para un usuario o para todos.
+
+MEDIA_VIDA_DIAS = 7
+MIN_DIAS = 5  # antes de esto el ritmo es puro ruido
+MIN_DIAS_CON_GASTO = 3
+SEGUNDOS_DIA = 86400
+
+
+def matriz_diaria(gastos_usuario, inicio_epoch, dias_mes):
+    fechas = np.frombuffer(gastos_usuario.fechas, dtype=gastos_usuario.fechas.typecode)
+    desde = np.searchsorted(fechas, inicio_epoch)
+    fechas = fechas[desde:]
+    montos = np.frombuffer(gastos_usuario.montos, dtype=gastos_usuario.montos.typecode)[desde:]
+    categorias = np.frombuffer(gastos_usuario.categorias, dtype=gastos_usuario.categorias.typecode)[desde:]
+
+    recurrente = np.fromiter(
+        (gasto_id.startswith("rec-") for gasto_id in gastos_usuario.ids[desde:]), dtype=bool, count=len(fechas)
+    )
+
+    dias = np.clip((fechas - inicio_epoch) // SEGUNDOS_DIA, 0, dias_mes - 1)
+    unicas, filas = np.unique(categorias, return_inverse=True)
+    total = np.zeros((len(unicas), dias_mes))
+    np.add.at(total, (filas, dias), montos)
+    variable = np.zeros((len(unicas), dias_mes))
+    np.add.at(variable, (filas[~recurrente], dias[~recurrente]), montos[~recurrente])
+    return [nombre_categoria(int(c)) for c in unicas], total, variable
+
+
+def proyectar(total, variable, transcurridos, dias_mes, limites):
+    # total y variable (F, D); transcurridos, dias_mes y limites (F,), límite NaN si no hay
+    t = np.arange(total.shape[1])
+    vivido = t[None, :] < transcurridos[:, None]
+    edad = transcurridos[:, None] - 1 - t[None, :]
+    pesos = np.where(vivido, 0.5 ** (edad / MEDIA_VIDA_DIAS), 0.0)
+    ritmo = (variable * pesos).sum(axis=1) / np.maximum(pesos.sum(axis=1), 1e-9)
+    ritmo = np.where(((variable > 0) & vivido).sum(axis=1) >= MIN_DIAS_CON_GASTO, ritmo, 0.0)
+
+    gastado = (total * vivido).sum(axis=1)
+    proyectado = gastado + ritmo * (dias_mes - transcurridos)
+
+    faltante = limites - gastado
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dia_exceso = transcurridos + np.ceil(faltante / ritmo)
+    cruza = (faltante > 0) & (ritmo > 0) & (dia_exceso <= dias_mes) & (transcurridos >= MIN_DIAS)
+    return gastado, proyectado, np.where(cruza, dia_exceso, np.nan)
+
+
+def pronosticar(entradas):
+    # entradas: [(user_id, gastos_usuario, presupuestos, inicio_epoch, dia_actual, dias_mes)]
+    # devuelve {user_id: {categoria: (gastado, proyectado, dia_exceso o None)}}
+    totales, variables, claves, transcurridos, dias, limites = [], [], [], [], [], []
+    ancho = max((e[5] for e in entradas), default=0)
+    for user_id, gastos_usuario, presupuestos, inicio_epoch, dia_actual, dias_mes in entradas:
+        categorias, total, variable = matriz_diaria(gastos_usuario, inicio_epoch, dias_mes)
+        # Las categorías con presupuesto y sin gastos también tienen fila
+        extra = [c for c in presupuestos if c not in categorias]
+        categorias = categorias + extra
+        relleno = ((0, len(extra)), (0, ancho - dias_mes))
+        totales.append(np.pad(total, relleno))
+        variables.append(np.pad(variable, relleno))
+        for categoria in categorias:
+            claves.append((user_id, categoria))
+            limites.append(presupuestos.get(categoria, np.nan))
+        transcurridos += [dia_actual] * len(categorias)
+        dias += [dias_mes] * len(categorias)
+
+    resultado = {e[0]: {} for e in entradas}
+    if not claves:
+        return resultado
+    gastado, proyectado, dia_exceso = proyectar(
+        np.vstack(totales), np.vstack(variables), np.array(transcurridos), np.array(dias), np.array(limites, dtype=float)
+    )
+    for i, (user_id, categoria) in enumerate(claves):
+        dia = None if np.isnan(dia_exceso[i]) else int(dia_exceso[i])
+        resultado[user_id][categoria] = (float(gastado[i]), float(proyectado[i]), dia)
+    return resultado
@@ -0,0 +1,127 @@
+import calendar
+
+from google.api_core import exceptions as gexc
+
+from busqueda import tokenizar
+
+# --- Gastos recurrentes ---
+#
+# Cada regla es un documento pequeño en la colección raíz `recurrentes`:
+# {u: user_id, m: monto, c: categoria, d: dia_del_mes, t: descripcion} y
+# `mo` con la moneda si no es la base (el monto se convierte al materializar).
+# El campo `d` funciona como índice por fecha de vencimiento: el trabajo
+# diario solo consulta las reglas que vencen hoy, sin recorrer usuarios.
+# Los gastos generados usan el id rec-{regla}-{AAAAMM} y se escriben con
+# create(): si otra corrida (otra réplica, un reintento) ya lo creó, el lote
+# falla entero con AlreadyExists en vez de sumar dos veces al índice diario,
+# y se repite regla por regla saltando las que ya están.
+
+# Dos escrituras por regla (gasto e índice diario) dentro del límite de 500 por lote
+TAM_LOTE = 250
+
+
+def guardar_regla(db, user_id, monto, categoria, dia, descripcion="", moneda=None):
+    regla = {
+        "u": user_id,
+        "m": monto,
+        "c": categoria,
+        "d": dia,
+        "t": descripcion
+    }
+    if moneda:
+        regla["mo"] = moneda
+    _, ref = db.collection("recurrentes").add(regla)
+    return ref.id
+
+
+def reglas_usuario(db, user_id):
+    docs = db.collection("recurrentes").where("u", "==", user_id).stream()
+    return sorted(((doc.id, doc.to_dict()) for doc in docs), key=lambda r: r[1]["d"])
+
+
+def borrar_regla(db, user_id, regla_id):
+    ref = db.collection("recurrentes").document(regla_id)
+    doc = ref.get()
+    if not doc.exists or doc.to_dict().get("u") != user_id:
+        return False
+    ref.delete()
+    return True
+
+
+def reglas_del_dia(db, fecha):
+    reglas = list(db.collection("recurrentes").where("d", "==", fecha.day).stream())
+    # El último día del mes también vencen las reglas de días que no existen (31 en abril)
+    if fecha.day == calendar.monthrange(fecha.year, fecha.month)[1]:
+        reglas += list(db.collection("recurrentes").where("d", ">", fecha.day).stream())
+    return reglas
+
+
+def materializar(db, reglas, fecha, indice_diario=None, tabla_cambio=None):
+    creados = []
+    for i in range(0, len(reglas), TAM_LOTE):
+        bloque = reglas[i:i + TAM_LOTE]
+        refs = [
+            db.collection("usuarios").document(regla.get("u")).collection("gastos")
+            .document(f"rec-{regla.id}-{fecha:%Y%m}")
+            for regla in bloque
+        ]
+        # Los gastos ya creados (segunda corrida o reintento tras un commit
+        # que sí llegó) se saltan para no sumarlos dos veces al índice diario
+        existentes = {doc.id for doc in db.get_all(refs) if doc.exists}
+
+        datos = [regla.to_dict() for regla in bloque]
+        montos = [r["m"] for r in datos]
+        if tabla_cambio is not None:
+            # Todo el bloque se convierte con la tasa del día en una sola operación
+            base = tabla_cambio.base
+            montos = tabla_cambio.convertir(
+                montos, [r.get("mo") or base for r in datos], [fecha] * len(datos)
+            ).round().astype(int).tolist()
+
+        nuevos = []
+        for regla, r, monto, gasto_ref in zip(bloque, datos, montos, refs):
+            if gasto_ref.id in existentes:
+                continue
+            gasto = {
+                "monto": monto,
+                "categoria": r["c"],
+                "descripcion": r.get("t", ""),
+                "tokens": tokenizar(r.get("t", ""), r["c"]),
+                "fecha": fecha,
+                "recurrente": regla.id
+            }
+            if r.get("mo"):
+                gasto["moneda"] = r["mo"]
+                gasto["monto_original"] = r["m"]
+            nuevos.append((gasto_ref, gasto, (r["u"], gasto_ref.id, monto, r["c"], r.get("t", ""))))
+
+        try:
+            creados += _crear(db, nuevos, fecha, indice_diario)
+        except gexc.AlreadyExists:
+            # Alguno se creó entre la lectura y el commit: nada del lote se
+            # aplicó, se repite de a uno y se saltan los que ya existen
+            for nuevo in nuevos:
+                try:
+                    creados += _crear(db, [nuevo], fecha, indice_diario)
+                except gexc.AlreadyExists:
+                    pass
+    return creados
+
+
+def _crear(db, nuevos, fecha, indice_diario):
+    if not nuevos:
+        return []
+    lote = db.batch()
+    for gasto_ref, gasto, creado in nuevos:
+        lote.create(gasto_ref, gasto)
+        if indice_diario is not None:
+            indice_diario.registrar(lote, creado[0], gasto["categoria"], fecha, gasto["monto"])
+    try:
+        lote.commit()
+    except Exception:
+        # Los incrementos ya aplicados en memoria no llegaron (o no se sabe)
+        if indice_diario is not None:
+            for _, _, creado in nuevos:
+                indice_diario.invalidar(creado[0])
+        raise
+    return [creado for _, _, creado in nuevos]
@@ -0,0 +1,177 @@
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import datetime
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+# --- Registro estructurado sin bloquear el event loop ---
+#
+# Los handlers del bot solo arman un LogRecord y lo dejan en una cola acotada
+# (put_nowait: si está llena el registro se descarta y se cuenta, nunca se
+# espera). Un QueueListener en su propio hilo le da formato JSON y lo escribe
+# en stdout. Cada línea lleva el usuario y el handler del update en curso
+# (contextvars), y al terminar cada update se emite una línea con su
+# duración. Los niveles ruidosos se pueden muestrear (LOG_MUESTREO).
+
+log = logging.getLogger("gastos")
+
+contexto = contextvars.ContextVar("contexto_registro", default=None)
+
+# Atributos propios de LogRecord; lo demás viene de `extra` y va al JSON
+_ESTANDAR = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class ContextoUpdate:
+    __slots__ = ("user_id", "inicio", "handlers")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.inicio = time.perf_counter()
+        self.handlers = []
+
+
+class ColaSinBloqueo(QueueHandler):
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+    def prepare(self, record):
+        # El formato se hace en el hilo del listener; la cola no sale del
+        # proceso, así que el registro viaja tal cual (args y traceback incluidos)
+        return record
+
+
+class FiltroContexto(logging.Filter):
+    # Corre en el hilo que registra: agrega el contexto del update y aplica el muestreo
+    def __init__(self, muestreo):
+        super().__init__()
+        self.muestreo = muestreo
+        self.muestreados_fuera = 0
+
+    def filter(self, record):
+        tasa = self.muestreo.get(record.levelno)
+        if tasa is not None and random.random() >= tasa:
+            self.muestreados_fuera += 1
+            return False
+        ctx = contexto.get()
+        if ctx is not None:
+            if not hasattr(record, "user_id"):
+                record.user_id = ctx.user_id
+            if ctx.handlers:
+                record.handler = " → ".join(ctx.handlers)
+        return True
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        datos = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "msg": record.getMessage(),
+            "funcion": record.funcName,
+        }
+        for clave, valor in vars(record).items():
+            if clave not in _ESTANDAR:
+                datos[clave] = valor
+        if record.exc_info:
+            datos["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+_cola = None
+_listener = None
+_filtro = None
+_salida = None
+
+
+def leer_muestreo(texto):
+    # "DEBUG=0.05,INFO=1" -> {10: 0.05, 20: 1.0}
+    muestreo = {}
+    for parte in filter(None, (texto or "").split(",")):
+        nivel, tasa = parte.split("=")
+        muestreo[logging.getLevelName(nivel.strip().upper())] = float(tasa)
+    return muestreo
+
+
+def configurar(nivel="INFO", muestreo="", tam_cola=10000):
+    global _cola, _listener, _filtro, _salida
+    if _listener is not None:
+        return
+    _cola = ColaSinBloqueo(queue.Queue(tam_cola))
+    _filtro = FiltroContexto(leer_muestreo(muestreo))
+    _cola.addFilter(_filtro)
+    _salida = logging.StreamHandler(sys.stdout)
+    _salida.setFormatter(FormatoJSON())
+
+    log.setLevel(nivel)
+    log.addHandler(_cola)
+    log.propagate = False
+    # Las advertencias de las librerías (telegram, httpx, apscheduler) también
+    raiz = logging.getLogger()
+    raiz.setLevel(logging.WARNING)
+    raiz.addHandler(_cola)
+
+    _listener = QueueListener(_cola.queue, _salida)
+    _listener.start()
+    atexit.register(detener)
+
+
+def redirigir(stream):
+    # Cambia el destino del listener (carga.py lo silencia)
+    if _salida is not None:
+        _salida.setStream(stream)
+
+
+def detener():
+    global _listener
+    if _listener is not None:
+        try:
+            _listener.stop()  # escribe lo que quede en la cola
+        except queue.Full:
+            pass  # sin lugar para el centinela; el hilo es daemon y muere con el proceso
+        _listener = None
+
+
+def estado():
+    if _cola is None:
+        return {}
+    return {
+        "en_cola": _cola.queue.qsize(),
+        "descartados": _cola.descartados,
+        "muestreados_fuera": _filtro.muestreados_fuera,
+    }
+
+
+# --- Contexto por update (TypeHandlers al principio y al final) ---
+
+async def iniciar_update(update, context):
+    user = getattr(update, "effective_user", None)
+    contexto.set(ContextoUpdate(user.id if user else None))
+
+
+async def terminar_update(update, context):
+    ctx = contexto.get()
+    if ctx is None:
+        return
+    log.info(
+        "update procesado",
+        extra={"duracion_ms": round((time.perf_counter() - ctx.inicio) * 1000, 1)}
+    )
+    contexto.set(None)
+
+
+def marcar_handler(nombre):
+    ctx = contexto.get()
+    if ctx is not None:
+        ctx.handlers.append(nombre)
@@ -0,0 +1,211 @@
+import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from google.api_core import exceptions as gexc
+
+# --- Resiliencia de las llamadas al almacén ---
+#
+# Toda operación contra Firestore pasa por Resiliencia.llamar: corre en un
+# pool de hilos propio (nunca en el event loop), con un plazo por operación,
+# reintentos con backoff exponencial y jitter completo solo si es idempotente,
+# y un interruptor de circuito compartido por el backend. Con el circuito
+# abierto las llamadas fallan de inmediato; los comandos de solo lectura
+# pueden responder con el último valor conocido (leer_con_respaldo).
+#
+# Un plazo vencido libera al handler, pero el hilo sigue hasta que la
+# llamada de Firestore termine por su cuenta; el pool acotado evita que se
+# acumulen sin límite.
+
+TRANSITORIOS = (
+    gexc.ServiceUnavailable, gexc.DeadlineExceeded, gexc.InternalServerError,
+    gexc.TooManyRequests, gexc.Aborted, gexc.RetryError,
+    ConnectionError, TimeoutError,
+)
+# Motivo de una llamada que el circuito rechazó sin enviarla: es la única
+# falla en la que se sabe que la escritura no llegó al backend
+CIRCUITO_ABIERTO = "circuito abierto"
+
+
+class AlmacenNoDisponible(Exception):
+    def __init__(self, operacion, motivo):
+        super().__init__(f"{operacion}: {motivo}")
+        self.operacion = operacion
+        self.motivo = motivo
+
+
+class Interruptor:
+    def __init__(self, umbral_fallos, enfriamiento):
+        self.umbral_fallos = umbral_fallos
+        self.enfriamiento = enfriamiento
+        self.estado = "cerrado"
+        self.fallos_seguidos = 0
+        self.aperturas = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        with self._lock:
+            if self.estado == "cerrado":
+                return True
+            if self.estado == "abierto" and time.monotonic() - self._abierto_desde >= self.enfriamiento:
+                self.estado = "semiabierto"
+                self._prueba_en_curso = False
+            if self.estado == "semiabierto" and not self._prueba_en_curso:
+                # Una sola llamada de prueba decide si se cierra o se vuelve a abrir
+                self._prueba_en_curso = True
+                return "prueba"
+            return False
+
+    def liberar(self):
+        # La llamada de prueba se canceló sin resultado: otra puede probar
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def exito(self):
+        with self._lock:
+            self.estado = "cerrado"
+            self.fallos_seguidos = 0
+            self._prueba_en_curso = False
+
+    def fallo(self):
+        with self._lock:
+            self.fallos_seguidos += 1
+            if self.estado == "semiabierto" or self.fallos_seguidos >= self.umbral_fallos:
+                if self.estado != "abierto":
+                    self.aperturas += 1
+                self.estado = "abierto"
+                self._abierto_desde = time.monotonic()
+                self._prueba_en_curso = False
+
+
+class Resiliencia:
+    def __init__(self, plazo=5.0, reintentos=3, espera_base=0.1, espera_max=2.0,
+                 umbral_fallos=5, enfriamiento=30.0, hilos=16, max_respaldos=20000):
+        self.plazo = plazo
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+        self.interruptor = Interruptor(umbral_fallos, enfriamiento)
+        self.max_respaldos = max_respaldos
+        self._respaldos = OrderedDict()
+        self._ejecutor = ThreadPoolExecutor(hilos, thread_name_prefix="almacen")
+        self.operaciones = {}
+        # Gancho para inyectar fallos o demoras en pruebas de carga: se llama
+        # en el hilo antes de cada intento con el nombre de la operación
+        self.inyector = None
+        # observador(operacion, inicio, duracion, resultado) tras cada llamada,
+        # con inicio en perf_counter; lo usa el perfilador de updates lentos
+        self.observador = None
+
+    def _metrica(self, operacion):
+        m = self.operaciones.get(operacion)
+        if m is None:
+            m = self.operaciones[operacion] = {
+                "llamadas": 0, "reintentos": 0, "plazos_vencidos": 0,
+                "errores": 0, "rechazadas": 0, "respaldos_servidos": 0
+            }
+        return m
+
+    def _ejecutar(self, operacion, funcion, args, kwargs):
+        if self.inyector:
+            self.inyector(operacion)
+        return funcion(*args, **kwargs)
+
+    async def llamar(self, operacion, funcion, *args, **kwargs):
+        if self.observador is None:
+            return await self._llamar(operacion, funcion, *args, **kwargs)
+        inicio = time.perf_counter()
+        resultado = "ok"
+        try:
+            return await self._llamar(operacion, funcion, *args, **kwargs)
+        except AlmacenNoDisponible as e:
+            resultado = f"no disponible: {e.motivo}"
+            raise
+        except Exception as e:
+            resultado = type(e).__name__
+            raise
+        finally:
+            self.observador(operacion, inicio, time.perf_counter() - inicio, resultado)
+
+    async def _llamar(self, operacion, funcion, *args, idempotente=True, plazo=None, **kwargs):
+        m = self._metrica(operacion)
+        m["llamadas"] += 1
+        plazo = self.plazo if plazo is None else plazo
+        intentos = 1 + (self.reintentos if idempotente else 0)
+        loop = asyncio.get_running_loop()
+        motivo = CIRCUITO_ABIERTO
+
+        for intento in range(intentos):
+            permiso = self.interruptor.permitir()
+            if not permiso:
+                m["rechazadas"] += 1
+                raise AlmacenNoDisponible(operacion, motivo)
+            try:
+                tarea = loop.run_in_executor(
+                    self._ejecutor, partial(self._ejecutar, operacion, funcion, args, kwargs)
+                )
+                resultado = await asyncio.wait_for(tarea, plazo)
+            except asyncio.TimeoutError:
+                m["plazos_vencidos"] += 1
+                motivo = f"plazo de {plazo}s vencido"
+            except TRANSITORIOS as e:
+                m["errores"] += 1
+                motivo = f"{type(e).__name__}: {e}"
+            except Exception:
+                # Errores de la aplicación (datos inválidos, NotFound...) no
+                # dicen nada de la salud del backend
+                self.interruptor.exito()
+                raise
+            except BaseException:
+                # Cancelada (el update o el trabajo se abandonó): si era la
+                # prueba del circuito semiabierto, sin soltarla no se cerraría nunca
+                if permiso == "prueba":
+                    self.interruptor.liberar()
+                raise
+            else:
+                self.interruptor.exito()
+                return resultado
+
+            self.interruptor.fallo()
+            if intento + 1 < intentos:
+                m["reintentos"] += 1
+                await asyncio.sleep(random.uniform(0, min(self.espera_max, self.espera_base * 2 ** intento)))
+
+        raise AlmacenNoDisponible(operacion, motivo)
+
+    async def leer_con_respaldo(self, clave, operacion, funcion, *args, **kwargs):
+        # Devuelve (valor, antigüedad en segundos o None si es fresco)
+        try:
+            valor = await self.llamar(operacion, funcion, *args, idempotente=True, **kwargs)
+        except AlmacenNoDisponible:
+            guardado = self._respaldos.get(clave)
+            if guardado is None:
+                raise
+            self._metrica(operacion)["respaldos_servidos"] += 1
+            valor, instante = guardado
+            return valor, time.time() - instante
+        self._respaldos[clave] = (valor, time.time())
+        self._respaldos.move_to_end(clave)
+        if len(self._respaldos) > self.max_respaldos:
+            self._respaldos.popitem(last=False)
+        return valor, None
+
+    def estado(self):
+        return {
+            "interruptor": {
+                "estado": self.interruptor.estado,
+                "fallos_seguidos": self.interruptor.fallos_seguidos,
+                "aperturas": self.interruptor.aperturas,
+            },
+            "respaldos": len(self._respaldos),
+            "operaciones": {k: dict(v) for k, v in sorted(self.operaciones.items())},
+        }
+
+    def cerrar(self):
+        self._ejecutor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,183 @@
+import contextvars
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from registro import log
+
+# --- Respuestas agrupadas por update ---
+#
+# Mientras se atiende un update, lo que los handlers quieren decir (responder,
+# editar) se junta en un lote en vez de ir a la Bot API de inmediato. Al
+# terminar el update (TypeHandler en el grupo 98) el lote sale con el mínimo
+# de llamadas: los textos seguidos con el mismo parse_mode van en un solo
+# mensaje separados por una línea en blanco, los teclados inline se apilan y
+# lo que venga después de una edición entra en la misma edición. Si el
+# handler marcó el mensaje del botón como reemplazable, la primera respuesta
+# edita ese mensaje en lugar de mandar uno nuevo.
+#
+# Fuera de un update (trabajos de job_queue) no hay lote y todo sale directo.
+
+LIMITE_TEXTO = 4096  # máximo de un mensaje de Telegram
+MARCAS_MARKDOWN = set("_*`[")
+
+lote_actual = contextvars.ContextVar("respuestas_lote", default=None)
+
+estadisticas = {"updates": 0, "partes": 0, "llamadas": 0}
+
+
+class Parte:
+    __slots__ = ("texto", "parse_mode", "teclado", "editar", "reemplazo", "extra")
+
+    def __init__(self, texto, parse_mode=None, reply_markup=None, editar=False, **extra):
+        self.texto = texto
+        self.parse_mode = parse_mode
+        self.teclado = reply_markup
+        self.editar = editar
+        self.reemplazo = False
+        self.extra = extra
+
+    def admite(self, otra):
+        # ¿Puede `otra` ir en el mismo mensaje que esta?
+        if otra.editar or self.extra or otra.extra or self._modo_comun(otra) is False:
+            return False
+        if len(self.texto) + 2 + len(otra.texto) > LIMITE_TEXTO:
+            return False
+        if self.teclado is None and otra.teclado is None:
+            return True
+        inline = all(t is None or isinstance(t, InlineKeyboardMarkup) for t in (self.teclado, otra.teclado))
+        if inline:
+            return True
+        # Un teclado de respuesta (o ForceReply) solo acompaña a texto sin teclado, y no cabe en una edición
+        return not self.editar and (self.teclado is None or otra.teclado is None)
+
+    def _modo_comun(self, otra):
+        # Texto plano sin marcas se lee igual con Markdown (v1); False si no se pueden mezclar
+        if self.parse_mode == otra.parse_mode:
+            return self.parse_mode
+        for plano, marcado in ((self, otra), (otra, self)):
+            if plano.parse_mode is None and marcado.parse_mode == "Markdown" and not MARCAS_MARKDOWN & set(plano.texto):
+                return "Markdown"
+        return False
+
+    def unir(self, otra):
+        self.parse_mode = self._modo_comun(otra)
+        self.texto = f"{self.texto}\n\n{otra.texto}"
+        if otra.teclado is None:
+            return
+        if self.teclado is None:
+            self.teclado = otra.teclado
+        else:
+            self.teclado = InlineKeyboardMarkup(tuple(self.teclado.inline_keyboard) + tuple(otra.teclado.inline_keyboard))
+
+
+class Lote:
+    __slots__ = ("update", "partes", "reemplazar")
+
+    def __init__(self, update):
+        self.update = update
+        self.partes = []
+        self.reemplazar = False
+
+
+def combinar(partes, reemplazar=False):
+    mensajes = []
+    for parte in partes:
+        previo = mensajes[-1] if mensajes else None
+        if previo is not None and previo.admite(parte):
+            previo.unir(parte)
+        else:
+            mensajes.append(parte)
+
+    if reemplazar and mensajes and not mensajes[0].editar:
+        primero = mensajes[0]
+        if not primero.extra and (primero.teclado is None or isinstance(primero.teclado, InlineKeyboardMarkup)):
+            primero.editar = True
+            primero.reemplazo = True
+    return mensajes
+
+
+# --- API para los handlers ---
+
+def _lote(update):
+    lote = lote_actual.get()
+    return lote if lote is not None and lote.update is update else None
+
+
+def agregar(update, texto, editar=False, **kwargs):
+    # True si quedó en el lote del update; False si hay que enviarlo ya
+    lote = _lote(update)
+    if lote is None:
+        return False
+    lote.partes.append(Parte(texto, editar=editar, **kwargs))
+    return True
+
+
+def reemplazar(update):
+    # La primera respuesta de este update edita el mensaje del botón pulsado
+    lote = _lote(update)
+    if lote is not None and update.callback_query:
+        lote.reemplazar = True
+
+
+async def editar(update, texto, **kwargs):
+    if not agregar(update, texto, editar=True, **kwargs):
+        await update.callback_query.edit_message_text(texto, **kwargs)
+
+
+# --- Enganches (TypeHandlers al principio y al final de cada update) ---
+
+async def iniciar_update(update, context):
+    lote_actual.set(Lote(update))
+
+
+async def vaciar(update, context):
+    lote = _lote(update)
+    if lote is None:
+        return
+    lote_actual.set(None)
+    estadisticas["updates"] += 1
+    await _enviar_lote(lote)
+
+
+async def enviar_pendientes(update):
+    # Antes de algo que no se agrupa (una foto, un documento), para no alterar el orden
+    lote = _lote(update)
+    if lote is not None and lote.partes:
+        await _enviar_lote(lote)
+
+
+async def _enviar_lote(lote):
+    partes, lote.partes = lote.partes, []
+    reemplazar, lote.reemplazar = lote.reemplazar, False
+    estadisticas["partes"] += len(partes)
+    for mensaje in combinar(partes, reemplazar):
+        await _enviar(lote.update, mensaje)
+
+
+async def _enviar(update, mensaje):
+    kwargs = dict(mensaje.extra, parse_mode=mensaje.parse_mode, reply_markup=mensaje.teclado)
+    if mensaje.editar:
+        estadisticas["llamadas"] += 1
+        try:
+            await update.callback_query.edit_message_text(mensaje.texto, **kwargs)
+            return
+        except BadRequest as e:
+            if not mensaje.reemplazo:
+                raise
+            # El mensaje del botón ya no se puede editar: va como mensaje nuevo
+            log.warning("no se pudo reemplazar el mensaje", extra={"error": str(e)})
+
+    if update.message:
+        destino = update.message
+    elif update.callback_query and update.callback_query.message:
+        destino = update.callback_query.message
+    else:
+        log.warning("no se pudo enviar mensaje: update sin message ni callback")
+        return
+    estadisticas["llamadas"] += 1
+    await destino.reply_text(mensaje.texto, **kwargs)
+
+
+def estado():
+    return dict(estadisticas)
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# Las pruebas corren contra firestore_memoria: bot.py se importa con el
+# cliente en memoria en lugar de firestore.Client y sin credenciales
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:PRUEBAS")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "memoria")
+
+from google.cloud import firestore  # noqa: E402
+
+import firestore_memoria  # noqa: E402
+
+firestore.Client = firestore_memoria.ClienteMemoria
+
+
+@pytest.fixture
+def db():
+    return firestore_memoria.ClienteMemoria()
@@ -0,0 +1,151 @@
+import datetime
+
+import pytest
+
+import archivo
+import bot
+from archivo import ZONA, compactar_usuario, leer_archivados
+from exportar import paginas_usuario
+from firestore_memoria import Lote, RefDocumento
+
+CORTE = ZONA.localize(datetime.datetime(2025, 1, 1))
+
+
+def sembrar(db, user_id, n=30):
+    gastos = db.collection("usuarios").document(user_id).collection("gastos")
+    esperado = []
+    for i in range(n):
+        fecha = ZONA.localize(datetime.datetime(2024, 10 + i % 3, 1 + i % 27, 12, i))
+        gasto = {"monto": 1000 + i, "categoria": ["comida", "ocio"][i % 2], "descripcion": f"gasto {i % 4}",
+                 "fecha": fecha}
+        if i % 5 == 0:
+            gasto.update(moneda="USD", monto_original=2.5 + i)
+        gastos.document(f"g{i}").set(gasto)
+        esperado.append(gasto)
+    # Uno reciente que no se compacta
+    gastos.document("nuevo").set({"monto": 7, "categoria": "comida", "descripcion": "hoy",
+                                  "fecha": ZONA.localize(datetime.datetime(2025, 2, 1))})
+    return esperado
+
+
+def leidos(user_id):
+    return sorted(
+        (g["monto"], g["categoria"], g.get("descripcion"), g.get("moneda"), g.get("monto_original"))
+        for g in bot.leer_gastos(user_id)
+    )
+
+
+def esperados(gastos):
+    return sorted(
+        (g["monto"], g["categoria"], g["descripcion"], g.get("moneda"), g.get("monto_original"))
+        for g in gastos
+    ) + [(7, "comida", "hoy", None, None)]
+
+
+def originales(db, user_id):
+    return len(list(db.collection("usuarios").document(user_id).collection("gastos").stream()))
+
+
+def archivos(db, user_id):
+    return {d.id: d.to_dict() for d in db.collection("usuarios").document(user_id).collection("archivo").stream()}
+
+
+def test_compacta_y_conserva_descripcion_y_moneda():
+    db = bot.db
+    gastos = sembrar(db, "a1")
+    assert compactar_usuario(db, "a1", CORTE) == 30
+    assert originales(db, "a1") == 1
+    assert sorted(archivos(db, "a1")) == ["2024-10", "2024-11", "2024-12"]
+    assert not any(d["borrando"] for d in archivos(db, "a1").values())
+    assert leidos("a1") == sorted(esperados(gastos))
+
+    filas = [f for pagina in paginas_usuario(db, "a1") for f in pagina]
+    assert len(filas) == 31
+    assert {f[4] for f in filas} == {"gasto 0", "gasto 1", "gasto 2", "gasto 3", "hoy"}
+    assert sum(1 for f in filas if f[5] == "USD") == 6
+
+    # Una segunda pasada no cambia nada
+    assert compactar_usuario(db, "a1", CORTE) == 0
+    assert leidos("a1") == sorted(esperados(gastos))
+
+
+def test_caida_durante_el_borrado_no_duplica_ni_pierde(monkeypatch):
+    db = bot.db
+    gastos = sembrar(db, "a2")
+    monkeypatch.setattr(archivo, "TAM_LOTE", 4)
+    commit = Lote.commit
+    llamadas = {"n": 0}
+
+    def commit_que_cae(self, *args, **kwargs):
+        llamadas["n"] += 1
+        if llamadas["n"] == 2:
+            raise RuntimeError("proceso caído")
+        return commit(self, *args, **kwargs)
+
+    monkeypatch.setattr(Lote, "commit", commit_que_cae)
+    with pytest.raises(RuntimeError):
+        compactar_usuario(db, "a2", CORTE)
+    monkeypatch.setattr(Lote, "commit", commit)
+
+    # A medio borrar: el mes está en el archivo y todavía quedan originales
+    assert archivos(db, "a2")["2024-10"]["borrando"]
+    assert 1 < originales(db, "a2") < 31
+    assert leidos("a2") == sorted(esperados(gastos))
+    assert len([f for p in paginas_usuario(db, "a2") for f in p]) == 31
+
+    # Mientras tanto llega un gasto viejo nuevo para ese mes: no se borra sin archivarlo
+    db.collection("usuarios").document("a2").collection("gastos").document("tarde").set({
+        "monto": 555, "categoria": "salud", "descripcion": "tarde",
+        "fecha": ZONA.localize(datetime.datetime(2024, 10, 15))
+    })
+    gastos.append({"monto": 555, "categoria": "salud", "descripcion": "tarde"})
+
+    compactar_usuario(db, "a2", CORTE)
+    assert originales(db, "a2") == 1
+    assert not any(d["borrando"] for d in archivos(db, "a2").values())
+    assert leidos("a2") == sorted(esperados(gastos))
+
+
+def test_caida_antes_de_bajar_la_bandera(monkeypatch):
+    db = bot.db
+    gastos = sembrar(db, "a3")
+    update = RefDocumento.update
+
+    def update_que_cae(self, datos, option=None):
+        if "borrando" in datos:
+            raise RuntimeError("proceso caído")
+        return update(self, datos, option)
+
+    monkeypatch.setattr(RefDocumento, "update", update_que_cae)
+    with pytest.raises(RuntimeError):
+        compactar_usuario(db, "a3", CORTE)
+    monkeypatch.setattr(RefDocumento, "update", update)
+
+    # Ya no quedan originales de octubre, pero la bandera no se queda puesta
+    assert archivos(db, "a3")["2024-10"]["borrando"]
+    compactar_usuario(db, "a3", CORTE)
+    assert not any(d["borrando"] for d in archivos(db, "a3").values())
+    assert leidos("a3") == sorted(esperados(gastos))
+
+
+def test_lee_archivos_viejos_sin_descripciones():
+    db = bot.db
+    sembrar(db, "a4", n=6)
+    compactar_usuario(db, "a4", CORTE)
+    ref = db.collection("usuarios").document("a4").collection("archivo").document("2024-10")
+    datos = ref.get().to_dict()
+    for campo in ("descripciones", "descripciones_idx", "extranjeros"):
+        datos.pop(campo)
+    ref.set(datos)
+    filas = list(leer_archivados(db, "a4"))
+    assert len(filas) == 6
+    assert {f["descripcion"] for f in filas if f["fecha"].month == 10} == {""}
+
+
+def test_mes_demasiado_grande_se_queda_como_original(monkeypatch):
+    db = bot.db
+    gastos = sembrar(db, "a5")
+    monkeypatch.setattr(archivo, "MAX_BYTES_MES", 100)
+    assert compactar_usuario(db, "a5", CORTE) == 0
+    assert originales(db, "a5") == 31
+    assert leidos("a5") == sorted(esperados(gastos))
@@ -0,0 +1,52 @@
+import asyncio
+
+from google.api_core.exceptions import ServiceUnavailable
+
+import bot
+from autocategoria import IndiceDescripciones
+from resiliencia import Resiliencia
+
+
+def registrar(db, indice, user_id, descripcion, categoria, veces=1):
+    for _ in range(veces):
+        lote = db.batch()
+        indice.registrar(lote, user_id, descripcion, categoria)
+        lote.commit()
+
+
+def test_una_lectura_por_usuario(db):
+    indice = IndiceDescripciones(db)
+    registrar(db, indice, "u1", "Uber", "transporte", veces=3)
+    assert not indice.cargado("u1")
+
+    lecturas = db.contadores["lecturas"]
+    assert indice.sugerir("u1", "uber") == "transporte"
+    for _ in range(9):
+        indice.sugerir("u1", "almuerzo")
+    assert db.contadores["lecturas"] == lecturas + 1
+
+    # Lo registrado después se refleja en memoria sin volver a leer
+    registrar(db, indice, "u1", "almuerzo", "comida", veces=2)
+    assert indice.sugerir("u1", "Almuerzo") == "comida"
+    assert db.contadores["lecturas"] == lecturas + 1
+    assert indice.estadisticas()["consultas"] == 11
+    assert indice.estadisticas()["aciertos_memoria"] == round(1 - 1 / 11, 3)
+
+
+def test_una_carga_tardia_no_pisa_lo_que_ya_esta(db):
+    indice = IndiceDescripciones(db)
+    viejo = indice.leer("u2")
+    indice.cargar("u2", {})
+    registrar(db, indice, "u2", "cine", "ocio", veces=2)
+    assert indice.cargar("u2", viejo) == {"cine": {"ocio": 2}}
+
+
+def test_sin_almacen_no_hay_sugerencia_pero_no_falla(monkeypatch):
+    monkeypatch.setattr(bot, "resiliencia", Resiliencia(plazo=1, reintentos=0))
+    monkeypatch.setattr(bot.db, "fallo", ServiceUnavailable("caído"))
+    assert asyncio.run(bot.sugerir_categoria("u3", "uber")) is None
+    assert not bot.indice_descripciones.cargado("u3")
+
+    monkeypatch.setattr(bot.db, "fallo", None)
+    assert asyncio.run(bot.sugerir_categoria("u3", "uber")) is None
+    assert bot.indice_descripciones.cargado("u3")
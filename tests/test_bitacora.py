@@ -0,0 +1,237 @@
+import asyncio
+import datetime
+import sqlite3
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import pytz
+
+import bot
+from bitacora import Bitacora
+from resiliencia import Resiliencia
+
+
+def gasto(monto=1000, categoria="comida"):
+    return {"monto": monto, "categoria": categoria, "descripcion": "", "tokens": [],
+            "fecha": pytz.timezone("America/Bogota").localize(datetime.datetime.now())}
+
+
+class Lenta:
+    # Resiliencia con un commit de Firestore que tarda: el gasto sigue en la bitácora un rato
+    def __init__(self, demora):
+        self.demora = demora
+        self.resiliencia = Resiliencia(plazo=5, reintentos=0)
+
+    async def llamar(self, operacion, funcion, *args, **kwargs):
+        await asyncio.sleep(self.demora)
+        return await self.resiliencia.llamar(operacion, funcion, *args, **kwargs)
+
+
+def bitacora_en(tmp_path, resiliencia=None, plazo=5.0):
+    return Bitacora(
+        str(tmp_path / "bitacora.db"), bot.db, resiliencia or Resiliencia(plazo=5, reintentos=0),
+        bot.preparar_volcado, al_volcar=bot.gastos_volcados, al_fallar=bot.volcado_fallido, plazo=plazo
+    )
+
+
+def confirmar(user_id, gasto_id):
+    update = MagicMock()
+    query = update.callback_query
+    query.data = "confirmar_eliminar"
+    query.from_user.id = int(user_id)
+    query.answer = AsyncMock()
+    query.edit_message_text = AsyncMock()
+    contexto = MagicMock()
+    contexto.user_data = {"ultimo_id": gasto_id}
+    return update, contexto
+
+
+def mensaje(user_id, gasto):
+    update = MagicMock()
+    update.effective_user.id = int(user_id)
+    update.effective_chat.type = "private"
+    update.message.reply_text = AsyncMock()
+    contexto = MagicMock()
+    contexto.user_data = {"gasto": gasto}
+    contexto.chat_data = {}
+    return update, contexto
+
+
+def existe(user_id, gasto_id):
+    return bot.db.collection("usuarios").document(user_id).collection("gastos").document(gasto_id).get().exists
+
+
+# --- Borrar un gasto que sigue en la bitácora ---
+
+def test_borrar_espera_el_volcado_y_no_resucita(tmp_path, monkeypatch):
+    user_id = "4501"
+    bitacora = bitacora_en(tmp_path, Lenta(0.2))
+    monkeypatch.setattr(bot, "bitacora", bitacora)
+    update, contexto = confirmar(user_id, "b1")
+
+    async def escenario():
+        assert await bitacora.anotar(user_id, "b1", gasto())
+        bot.cache_gastos.agregar(user_id, "b1", 1000, "comida", gasto()["fecha"])
+        await bot.callback_confirmar(update, contexto)
+        await asyncio.sleep(0.3)
+        await bitacora.cerrar()
+
+    asyncio.run(escenario())
+    update.callback_query.edit_message_text.assert_awaited_once_with("✅ Gasto eliminado correctamente.")
+    assert not existe(user_id, "b1")
+    assert bitacora.estado()["pendientes"] == 0
+
+
+def test_borrar_con_el_volcado_atrasado_pide_esperar(tmp_path, monkeypatch):
+    user_id = "4502"
+    bitacora = bitacora_en(tmp_path, Lenta(1.0))
+    monkeypatch.setattr(bot, "bitacora", bitacora)
+    monkeypatch.setattr(bot, "resiliencia", Resiliencia(plazo=0.05, reintentos=0))
+    update, contexto = confirmar(user_id, "b2")
+
+    async def escenario():
+        assert await bitacora.anotar(user_id, "b2", gasto())
+        await bot.callback_confirmar(update, contexto)
+        await bitacora.cerrar()
+
+    asyncio.run(escenario())
+    texto = update.callback_query.edit_message_text.await_args.args[0]
+    assert texto.startswith("⏳")
+    # Se puede volver a intentar con el mismo botón
+    assert contexto.user_data["ultimo_id"] == "b2"
+    bot.resiliencia.cerrar()
+
+
+def test_borrar_un_gasto_que_no_existe_lo_dice(monkeypatch):
+    user_id = "4503"
+    monkeypatch.setattr(bot, "bitacora", None)
+    # En memoria quedó un gasto que Firestore ya no tiene
+    bot.gastos_recientes(user_id)
+    bot.cache_gastos.agregar(user_id, "fantasma", 1000, "comida", gasto()["fecha"])
+    assert bot.gastos_recientes(user_id).ultimo()[0] == "fantasma"
+    update, contexto = confirmar(user_id, "fantasma")
+
+    asyncio.run(bot.callback_confirmar(update, contexto))
+
+    update.callback_query.edit_message_text.assert_awaited_once_with("⚠️ No se encontró el gasto a eliminar.")
+    assert bot.gastos_recientes(user_id).ultimo() is None
+    assert "ultimo_id" not in contexto.user_data
+
+
+# --- Anotar ---
+
+def test_anotar_con_el_disco_trabado_vence_y_no_duplica(tmp_path):
+    bitacora = bitacora_en(tmp_path, plazo=0.05)
+    soltar = threading.Event()
+    insertar = bitacora._insertar
+
+    def trabado(filas):
+        soltar.wait(5)
+        insertar(filas)
+
+    bitacora._insertar = trabado
+
+    async def escenario():
+        inicio = asyncio.get_running_loop().time()
+        assert not await bitacora.anotar("4504", "t1", gasto())
+        assert asyncio.get_running_loop().time() - inicio < 1
+        # El bot lo escribe directo con create(); si la fila llega igual, el volcado choca con AlreadyExists
+        bot.db.collection("usuarios").document("4504").collection("gastos").document("t1").create(gasto())
+        soltar.set()
+        for _ in range(100):
+            if not bitacora.estado()["pendientes"] and bitacora.contadores["commits"]:
+                break
+            await asyncio.sleep(0.01)
+        await bitacora.cerrar()
+
+    asyncio.run(escenario())
+    assert bitacora.contadores["sin_anotar"] == 1
+    assert bitacora.contadores["ya_aplicados"] == 1 and bitacora.contadores["volcados"] == 0
+
+
+def test_escritor_sobrevive_a_un_error_inesperado(tmp_path):
+    bitacora = bitacora_en(tmp_path)
+    insertar = bitacora._insertar
+    errores = [RuntimeError("inesperado")]
+
+    def falla_una_vez(filas):
+        if errores:
+            raise errores.pop()
+        insertar(filas)
+
+    bitacora._insertar = falla_una_vez
+
+    async def escenario():
+        assert not await asyncio.wait_for(bitacora.anotar("4505", "e1", gasto()), 1)
+        assert await asyncio.wait_for(bitacora.anotar("4505", "e2", gasto()), 1)
+        await bitacora.cerrar()
+
+    asyncio.run(escenario())
+    assert bitacora.contadores["sin_anotar"] == 1 and bitacora.contadores["anotados"] == 1
+
+
+def test_cerrar_a_mitad_de_una_escritura_no_pierde_el_grupo(tmp_path):
+    ruta = tmp_path / "bitacora.db"
+    bitacora = bitacora_en(tmp_path)
+    soltar = threading.Event()
+    insertar = bitacora._insertar
+    llamadas = []
+
+    def lento(filas):
+        llamadas.append(len(filas))
+        if len(llamadas) == 1:
+            soltar.wait(5)
+        insertar(filas)
+
+    bitacora._insertar = lento
+
+    async def escenario():
+        anotado = asyncio.create_task(bitacora.anotar("4506", "c1", gasto()))
+        await asyncio.sleep(0.05)
+        asyncio.get_running_loop().call_later(0.05, soltar.set)
+        await bitacora.cerrar()
+        return await anotado
+
+    assert asyncio.run(escenario())
+    assert llamadas == [1, 1]
+    assert sqlite3.connect(ruta).execute("SELECT id FROM pendientes").fetchall() == [("c1",)]
+
+
+# --- Escritura directa (sin bitácora) ---
+
+def test_commit_lento_se_reintenta_sin_duplicar(monkeypatch):
+    user_id = "4507"
+    monkeypatch.setattr(bot, "bitacora", None)
+    monkeypatch.setattr(bot, "resiliencia", Resiliencia(plazo=0.05, reintentos=0))
+    lote_original = bot.db.batch
+
+    def lote_lento():
+        # El commit llega a Firestore, pero después del plazo
+        lote = lote_original()
+        commit = lote.commit
+        lote.commit = lambda: (time.sleep(0.2), commit())[1]
+        return lote
+
+    monkeypatch.setattr(bot.db, "batch", lote_lento)
+    update, contexto = mensaje(user_id, {"monto": 5000, "descripcion": "xqzw", "categoria": "comida"})
+    gastos = bot.db.collection("usuarios").document(user_id).collection("gastos")
+
+    async def escenario():
+        assert await bot.guardar_gasto_con_categoria(update, contexto) == bot.HANDLE_GASTO_CATEGORIA
+        texto = update.message.reply_text.await_args.args[0]
+        assert texto.startswith("⏳")
+        await asyncio.sleep(0.3)
+        assert len(list(gastos.stream())) == 1
+        indice = bot.indice_diario.ref(user_id, datetime.date.today().year).get().to_dict()
+
+        # El botón de reintento vuelve a guardar con el mismo id: create() choca y no suma de nuevo
+        monkeypatch.setattr(bot.db, "batch", lote_original)
+        await bot.guardar_gasto_con_categoria(update, contexto)
+        assert update.message.reply_text.await_args_list[1].args[0].startswith("💾")
+        assert bot.indice_diario.ref(user_id, datetime.date.today().year).get().to_dict() == indice
+
+    asyncio.run(escenario())
+    assert len(list(gastos.stream())) == 1
+    assert "id" not in contexto.user_data["gasto"]
+    bot.resiliencia.cerrar()
@@ -0,0 +1,125 @@
+import datetime
+import threading
+
+import pytz
+
+from cache_gastos import CacheGastos
+
+TZ = pytz.timezone("America/Bogota")
+DESDE = TZ.localize(datetime.datetime(2025, 2, 1))
+
+
+def fecha(dia, hora=12, mes=3):
+    return TZ.localize(datetime.datetime(2025, mes, dia, hora))
+
+
+def cargador_de(gastos):
+    # gastos: {user_id: [(id, monto, categoria, fecha)]}
+    return lambda user_id, desde: [g for g in gastos.get(user_id, []) if g[3] >= desde]
+
+
+def test_rangos_incluyen_desde_y_excluyen_hasta():
+    gastos = {"u": [
+        ("a", 100, "comida", fecha(1, 0)),
+        ("b", 200, "ocio", fecha(10)),
+        ("c", 400, "comida", fecha(15, 0)),
+        ("d", 800, "comida", fecha(20)),
+    ]}
+    entrada = CacheGastos(cargador_de(gastos), 1 << 20).obtener("u", DESDE)
+
+    # Un gasto justo en el borde entra por `desde` y queda fuera por `hasta`
+    assert entrada.total(desde=fecha(1, 0), hasta=fecha(15, 0)) == 300
+    assert entrada.total(desde=fecha(15, 0), hasta=fecha(20, 12)) == 400
+    assert entrada.total(desde=fecha(1, 0), categoria="comida") == 1300
+    assert entrada.total(categoria="transporte") == 0
+    assert entrada.por_categoria(hasta=fecha(20)) == {"comida": 500, "ocio": 200}
+    assert entrada.por_categoria(desde=fecha(10, 13)) == {"comida": 1200}
+
+
+def test_agregar_sin_duplicar_ni_antes_de_desde():
+    cache = CacheGastos(cargador_de({"u": [("a", 100, "comida", fecha(5))]}), 1 << 20)
+    entrada = cache.obtener("u", DESDE)
+
+    cache.agregar("u", "a", 100, "comida", fecha(5))          # ya estaba
+    cache.agregar("u", "viejo", 50, "comida", fecha(20, mes=1))  # anterior a `desde`
+    cache.agregar("u", "b", 300, "ocio", fecha(2))
+    assert entrada.ids == ["b", "a"] and entrada.total() == 400
+    assert entrada.ultimo()[0] == "a"
+
+    # De un usuario que no está en memoria no se guarda nada
+    cache.agregar("otro", "x", 1, "comida", fecha(5))
+    assert cache.estadisticas()["usuarios"] == 1
+
+
+def test_eliminar_varios():
+    gastos = {"u": [(f"g{i}", 10 * i, "comida", fecha(i + 1)) for i in range(5)]}
+    cache = CacheGastos(cargador_de(gastos), 1 << 20)
+    entrada = cache.obtener("u", DESDE)
+    bytes_antes = cache.estadisticas()["bytes"]
+
+    cache.eliminar_varios("u", (g for g in ["g1", "g3", "no-existe"]))
+    assert entrada.ids == ["g0", "g2", "g4"] and entrada.total() == 60
+    assert cache.estadisticas()["bytes"] <= bytes_antes
+
+
+def test_expulsa_por_lru_al_pasar_el_limite():
+    gastos = {u: [(f"{u}{i}", 100, "comida", fecha(i + 1)) for i in range(20)] for u in ("a", "b", "c")}
+    cache = CacheGastos(cargador_de(gastos), 1 << 20)
+    cache.obtener("a", DESDE)
+    cache.limite_bytes = cache.estadisticas()["bytes"] * 2 + 1  # caben dos usuarios
+
+    cache.obtener("b", DESDE)
+    cache.obtener("a", DESDE)   # `a` pasa a ser el más reciente
+    cache.obtener("c", DESDE)   # sale `b`, el menos usado
+
+    assert cache.estadisticas()["usuarios"] == 2 and cache.expulsiones == 1
+    cargas = cache.cargas
+    cache.obtener("a", DESDE)
+    assert cache.cargas == cargas
+    cache.obtener("b", DESDE)
+    assert cache.cargas == cargas + 1
+    assert cache.estadisticas()["bytes"] <= cache.limite_bytes
+
+
+def test_escrituras_durante_una_carga_no_se_pierden():
+    en_firestore = [("viejo", 100, "comida", fecha(3)), ("borrado", 200, "ocio", fecha(4))]
+    leyendo, soltar = threading.Event(), threading.Event()
+
+    def cargador(user_id, desde):
+        foto = list(en_firestore)
+        leyendo.set()
+        soltar.wait(5)
+        return foto
+
+    cache = CacheGastos(cargador, 1 << 20)
+    resultado = []
+    hilo = threading.Thread(target=lambda: resultado.append(cache.obtener("u", DESDE)))
+    hilo.start()
+    leyendo.wait(5)
+    # El event loop registra y borra mientras la carga sigue en su hilo
+    cache.agregar("u", "nuevo", 50, "comida", fecha(6))
+    cache.eliminar("u", "borrado")
+    soltar.set()
+    hilo.join(5)
+
+    entrada = cache.obtener("u", DESDE)
+    assert entrada is resultado[0]
+    assert entrada.ids == ["viejo", "nuevo"] and entrada.total() == 150
+
+
+def test_invalidar_durante_una_carga_la_descarta():
+    leyendo, soltar = threading.Event(), threading.Event()
+
+    def cargador(user_id, desde):
+        leyendo.set()
+        soltar.wait(5)
+        return [("a", 100, "comida", fecha(3))]
+
+    cache = CacheGastos(cargador, 1 << 20)
+    hilo = threading.Thread(target=cache.obtener, args=("u", DESDE))
+    hilo.start()
+    leyendo.wait(5)
+    cache.invalidar("u")  # p. ej. el usuario cambió de zona horaria
+    soltar.set()
+    hilo.join(5)
+    assert cache.estadisticas()["usuarios"] == 0
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+
+import bot
+from coherencia import CoherenciaTiempoReal
+
+
+def presupuesto(db, user_id, categoria, limite):
+    db.collection("usuarios").document(user_id).collection("presupuestos").document(categoria).set({"limite": limite})
+
+
+def test_estado_inicial_y_cambios_externos(db):
+    presupuesto(db, "u1", "comida", 100)
+    cambios = []
+    coherencia = CoherenciaTiempoReal(db, al_cambiar=cambios.append)
+
+    assert coherencia.presupuestos("u1") == {"comida": 100}
+    assert coherencia.categorias("u1") == set()
+    # El estado inicial no cuenta como cambio
+    assert cambios == []
+
+    lecturas = db.contadores["lecturas"]
+    presupuesto(db, "u1", "ocio", 50)
+    db.collection("usuarios").document("u1").collection("presupuestos").document("comida").delete()
+    db.collection("usuarios").document("u1").collection("categorias").document("mascotas").set({})
+
+    assert coherencia.presupuestos("u1") == {"ocio": 50}
+    assert coherencia.categorias("u1") == {"mascotas"}
+    assert db.contadores["lecturas"] == lecturas
+    assert cambios == ["u1", "u1", "u1"]
+
+
+def test_cambios_de_otro_usuario_no_invalidan(db):
+    cambios = []
+    coherencia = CoherenciaTiempoReal(db, al_cambiar=cambios.append)
+    coherencia.presupuestos("u1")
+    presupuesto(db, "u2", "comida", 10)
+    assert cambios == []
+
+
+def test_listeners_acotados_y_barrido(db):
+    coherencia = CoherenciaTiempoReal(db, max_listeners=4, inactividad_segundos=0)
+    for user_id in ("a", "b", "c"):
+        coherencia.presupuestos(user_id)
+    assert coherencia.estadisticas()["listeners"] == 4
+    assert coherencia.barrer() == 2
+    assert coherencia.estadisticas()["listeners"] == 0
+
+    # Un evento tardío de un usuario desconectado no lo revive
+    presupuesto(db, "c", "comida", 1)
+    assert coherencia.estadisticas()["usuarios"] == 0
+
+
+class Watch:
+    # Como el Watch de Firestore: unsubscribe() espera al hilo consumidor, que
+    # puede estar entregando un último evento (y ese callback toma el lock)
+    def __init__(self, callback, colgados):
+        self.callback = callback
+        self.colgados = colgados
+        callback([], [], None)
+
+    def unsubscribe(self):
+        hilo = threading.Thread(target=self.callback, args=([], [], None))
+        hilo.start()
+        hilo.join(0.5)
+        self.colgados.append(hilo.is_alive())
+
+
+class ClienteWatch:
+    def __init__(self):
+        self.colgados = []
+
+    def collection(self, nombre):
+        return self
+
+    def document(self, nombre):
+        return self
+
+    def on_snapshot(self, callback):
+        return Watch(callback, self.colgados)
+
+
+def test_desconectar_no_espera_al_listener_con_el_lock():
+    db = ClienteWatch()
+    coherencia = CoherenciaTiempoReal(db, max_listeners=2, inactividad_segundos=0)
+    for user_id in ("a", "b"):
+        assert coherencia.presupuestos(user_id) == {}
+    # "a" salió por LRU al conectar a "b"; luego el barrido y el cierre
+    coherencia.barrer()
+    coherencia.presupuestos("c")
+    coherencia.cerrar()
+    assert db.colgados == [False] * 6
+    assert coherencia.estadisticas()["usuarios"] == 0
+
+
+def test_un_cambio_invalida_inline_y_reportes_guardados(db):
+    async def correr():
+        loop = asyncio.get_running_loop()
+        coherencia = CoherenciaTiempoReal(
+            db, al_cambiar=lambda user_id: loop.call_soon_threadsafe(bot.invalidar_inline, user_id)
+        )
+        coherencia.presupuestos("u1")
+        bot.respuestas_inline["u1"] = (0, [])
+        bot.limitador._respuestas[("u1", "resumen", ())] = (0, [])
+
+        # El evento llega desde otro hilo, como los de Firestore
+        await asyncio.to_thread(presupuesto, db, "u1", "comida", 100)
+        await asyncio.sleep(0)
+
+        assert "u1" not in bot.respuestas_inline
+        assert ("u1", "resumen", ()) not in bot.limitador._respuestas
+    asyncio.run(correr())
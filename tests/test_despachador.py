@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from telegram import Update
+
+import bot
+import carga
+from despachador import Conversacion, Despachador, FIN, Ruta
+
+UID = 42
+
+# Matriz de ruteo: cada entrada (comando, botón del teclado, callback, inline)
+# en cada estado de cada flujo, con el nombre de la función que la atiende.
+# Se generó con la versión de ConversationHandler y se revisó caso por caso
+# al pasar al despachador; un cambio de ruteo tiene que actualizarla.
+MATRIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "matriz_despachador.json")
+
+ESTADOS = {
+    "ninguno": None,
+    "presupuesto/ESCOGER_CATEGORIA": ("presupuesto", bot.ESCOGER_CATEGORIA),
+    "presupuesto/ESPECIFICAR_CATEGORIA_PERSONALIZADA": ("presupuesto", bot.ESPECIFICAR_CATEGORIA_PERSONALIZADA),
+    "presupuesto/ESPECIFICAR_LIMITE": ("presupuesto", bot.ESPECIFICAR_LIMITE),
+    "presupuesto/PREGUNTAR_ACCION_POST_PRESUPUESTO": ("presupuesto", bot.PREGUNTAR_ACCION_POST_PRESUPUESTO),
+    "presupuesto/CONFIRMAR_SOBREESCRITURA": ("presupuesto", bot.CONFIRMAR_SOBREESCRITURA),
+    "consulta/ESPERANDO_CATEGORIA_CONSULTA": ("consulta", bot.ESPERANDO_CATEGORIA_CONSULTA),
+    "gasto/HANDLE_GASTO_CATEGORIA": ("gasto", bot.HANDLE_GASTO_CATEGORIA),
+    "gasto/HANDLE_GASTO_PERSONALIZADA": ("gasto", bot.HANDLE_GASTO_PERSONALIZADA),
+    "gasto/ESPECIFICAR_LIMITE_GASTO": ("gasto", bot.ESPECIFICAR_LIMITE_GASTO),
+    "gasto/PREGUNTAR_ACCION_POST_PRESUPUESTO_GASTO": ("gasto", bot.PREGUNTAR_ACCION_POST_PRESUPUESTO_GASTO),
+    "gasto/ESCOGER_CATEGORIA": ("gasto", bot.ESCOGER_CATEGORIA),
+    "gasto/CONFIRMAR_SOBREESCRITURA": ("gasto", bot.CONFIRMAR_SOBREESCRITURA),
+}
+COMANDOS = ["start", "menu", "resumen", "total", "ultimo", "eliminar", "grafico", "comparar 7", "comparar_detalle",
+            "exportar mes", "grupo", "recurrente", "zona", "tasa", "buscar uber", "rango 2025-01-01 2025-02-01",
+            "memoria", "lentos", "historial", "presupuesto_grupo", "presupuesto", "consultar", "cancelar", "xyz",
+            "RESUMEN", "total@gastos_carga_bot", "total@otro_bot"]
+BOTONES = ["📋 Menú", "📝 Registrar gasto", "📊 Resumen", "📈 Comparar", "💰 Total", "📌 Último", "🗑️ Eliminar",
+           "📉 Gráfico", "💼 Presupuesto", "5000 almuerzo", "comida"]
+CALLBACKS = ["menu:registrar_gasto", "menu:presupuesto", "menu:resumen", "menu:comparar", "menu:total", "menu:ultimo",
+             "menu:eliminar", "menu:grafico", "cat:comida", "catref:personalizada", "cancelar_presupuesto",
+             "reintentar_limite", "otro_presupuesto", "registrar_gasto", "salir", "establecer_presupuesto:comida",
+             "ignorar_presupuesto", "confirmar_reemplazo", "cancelar_reemplazo", "consulta_categoria:comida",
+             "cambiar_cat:abc", "confirmar_eliminar", "cancelar_eliminar", "bus:k:1:2", "his:p", "his:s:abc",
+             "his:del", "his:ok", "his:volver", "his:p:1:abc", "rec_borrar:r1", "desconocido"]
+
+
+class Updates:
+    def __init__(self):
+        self.n = 0
+
+    def _id(self):
+        self.n += 1
+        return self.n
+
+    def mensaje(self, texto):
+        n = self._id()
+        m = {"message_id": n, "date": int(time.time()), "chat": {"id": UID, "type": "private"},
+             "from": {"id": UID, "is_bot": False, "first_name": "x"}, "text": texto}
+        if texto.startswith("/"):
+            m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        return {"update_id": n, "message": m}
+
+    def boton(self, datos):
+        n = self._id()
+        return {"update_id": n, "callback_query": {
+            "id": str(n), "from": {"id": UID, "is_bot": False, "first_name": "x"}, "chat_instance": "1",
+            "data": datos, "message": {"message_id": 1, "date": int(time.time()),
+                                       "chat": {"id": UID, "type": "private"},
+                                       "from": {"id": 1, "is_bot": True, "first_name": "b"}, "text": "..."}}}
+
+    def inline(self):
+        n = self._id()
+        return {"update_id": n, "inline_query": {
+            "id": "1", "from": {"id": UID, "is_bot": False, "first_name": "x"}, "query": "", "offset": ""}}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # construir_app crea el Bot masivo de canales; se restaura al terminar
+    monkeypatch.setattr(bot.canales, "masivo", bot.canales.masivo)
+    aplicacion = bot.construir_app(request=carga.BotAPIFalsa(), get_updates_request=carga.BotAPIFalsa())
+
+    async def iniciar():
+        await aplicacion.initialize()
+        await aplicacion.bot.get_me()
+
+    asyncio.run(iniciar())
+    return aplicacion
+
+
+def despachador_de(app):
+    return next(h for h in app.handlers[0] if isinstance(h, Despachador))
+
+
+def nombre_de(callback):
+    while hasattr(callback, "__wrapped__"):
+        callback = callback.__wrapped__
+    return callback.__name__
+
+
+def test_matriz_de_ruteo(app):
+    despachador = despachador_de(app)
+    visto = []
+
+    def registrar(nombre):
+        async def atender(update, context):
+            visto.append(nombre)
+        return atender
+
+    for ruta in despachador.rutas():
+        ruta.callback = registrar(nombre_de(ruta.callback))
+
+    updates = Updates()
+    entradas = ([("/" + c, updates.mensaje("/" + c)) for c in COMANDOS]
+                + [(b, updates.mensaje(b)) for b in BOTONES]
+                + [("cb " + c, updates.boton(c)) for c in CALLBACKS]
+                + [("inline", updates.inline())])
+
+    async def recorrer():
+        obtenido = {}
+        for nombre_estado, estado in ESTADOS.items():
+            for etiqueta, datos in entradas:
+                despachador.conversaciones.clear()
+                if estado:
+                    despachador.conversaciones[(UID, UID)] = Conversacion(*estado)
+                visto.clear()
+                await app.process_update(Update.de_json(datos, app.bot))
+                obtenido[f"{nombre_estado} | {etiqueta}"] = " → ".join(visto) or "—"
+        return obtenido
+
+    with open(MATRIZ, encoding="utf-8") as f:
+        esperado = json.load(f)
+    obtenido = asyncio.run(recorrer())
+    distintos = {k: (esperado.get(k), v) for k, v in obtenido.items() if esperado.get(k) != v}
+    assert len(obtenido) == len(esperado) == 923
+    assert not distintos
+
+
+def test_flujo_reemplazado_no_deja_su_marca(app):
+    despachador = despachador_de(app)
+    updates = Updates()
+    bot.db.collection("usuarios").document(str(UID)).collection("presupuestos").document("comida").set({"limite": 1000})
+
+    async def escenario():
+        await app.process_update(Update.de_json(updates.mensaje("/presupuesto"), app.bot))
+        assert despachador.estado((UID, UID)) == ("presupuesto", bot.ESCOGER_CATEGORIA)
+        assert app.chat_data[UID]["conversation"] == "presupuesto"
+
+        # /consultar reemplaza al flujo de presupuesto: su marca no puede quedar,
+        # o handle_message ignoraría todo gasto escrito después
+        await app.process_update(Update.de_json(updates.mensaje("/consultar"), app.bot))
+        assert despachador.estado((UID, UID))[0] == "consulta"
+        assert "conversation" not in app.chat_data[UID]
+
+        await app.process_update(Update.de_json(updates.boton("consulta_categoria:comida"), app.bot))
+        assert despachador.estado((UID, UID)) is None
+        await app.process_update(Update.de_json(updates.mensaje("5000 xqzw"), app.bot))
+        assert despachador.estado((UID, UID)) == ("gasto", bot.HANDLE_GASTO_CATEGORIA)
+
+    asyncio.run(escenario())
+
+
+def test_al_salir_en_fin_expiracion_y_reemplazo():
+    salidas = []
+
+    async def entrar(update, context):
+        return 1
+
+    async def terminar(update, context):
+        return FIN
+
+    despachador = Despachador(entrar, entrar, entrar, al_salir=lambda context, flujo: salidas.append(flujo))
+    app = type("App", (), {"job_queue": None})()
+    clave = (UID, UID)
+    despachador._transicion(clave, Ruta(entrar, "a"), 1, None, None, app)
+    despachador._transicion(clave, Ruta(entrar, "a"), 2, None, None, app)
+    assert salidas == []
+    despachador._transicion(clave, Ruta(entrar, "b"), 1, None, None, app)
+    assert salidas == ["a"]
+    despachador._transicion(clave, Ruta(terminar), FIN, None, None, app)
+    assert salidas == ["a", "b"]
+
+    despachador._transicion(clave, Ruta(entrar, "c"), 1, None, None, app)
+    conversacion = despachador.conversaciones[clave]
+    trabajo = type("Trabajo", (), {"job": type("Job", (), {"data": (clave, conversacion, None, None)})()})()
+    asyncio.run(despachador._expirar(trabajo))
+    assert salidas == ["a", "b", "c"] and despachador.estado(clave) is None
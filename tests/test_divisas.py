@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import numpy as np
+import pytest
+
+import bot
+from divisas import TablaCambio, leer_decimal
+
+DIA = datetime.date(2025, 3, 10)
+
+
+def tabla_con(tmp_path, filas):
+    ruta = tmp_path / "tasas.csv"
+    ruta.write_text("fecha,moneda,tasa\n" + "".join(f"{f},{m},{t}\n" for f, m, t in filas), encoding="utf-8")
+    return TablaCambio("COP", str(ruta))
+
+
+@pytest.mark.parametrize("texto, valor", [
+    ("1.200", 1200), ("1,200", 1200), ("1.234.567", 1234567), ("20.50", 20.5), ("20,5", 20.5),
+    ("1.234,56", 1234.56), ("1,234.56", 1234.56), ("4100", 4100), (" 7 ", 7),
+])
+def test_leer_decimal(texto, valor):
+    assert leer_decimal(texto) == valor
+
+
+def test_separar_monto_moneda_y_descripcion(tmp_path):
+    tabla = tabla_con(tmp_path, [(DIA, "USD", 4000), (DIA, "EUR", 4400)])
+    assert tabla.separar("20 usd taxi") == (20, "USD", "taxi")
+    assert tabla.separar("taxi 20,5 usd") == (20.5, "USD", "taxi")
+    assert tabla.separar("€12 cena") == (12, "EUR", "cena")
+    assert tabla.separar("cena 12eur") == (12, "EUR", "cena")
+    assert tabla.separar("dólares 3 propina") == (3, "USD", "propina")
+    # Sin moneda, o con una sin tasas cargadas, no se separa
+    assert tabla.separar("5000 almuerzo") is None
+    assert tabla.separar("20 gbp libro") is None
+    assert tabla.sin_tasa("20 gbp libro") == "GBP"
+
+
+def test_convertir_rellena_huecos_y_extremos(tmp_path):
+    siguiente = DIA + datetime.timedelta(days=3)
+    tabla = tabla_con(tmp_path, [(DIA, "USD", 4000), (siguiente, "USD", 4200), (siguiente, "EUR", 4500)])
+    fechas = [DIA - datetime.timedelta(days=30), DIA + datetime.timedelta(days=1), siguiente,
+              datetime.datetime(2030, 1, 1), DIA, DIA]
+    convertido = tabla.convertir([1, 2, 1, 1, 1000, 1], ["USD", "USD", "USD", "USD", "COP", "EUR"], fechas)
+    # Antes del primer dato, la primera tasa; en un hueco, la anterior; después del último, la última
+    np.testing.assert_allclose(convertido, [4000, 8000, 4200, 4200, 1000, 4500])
+    assert tabla.a_base(2.5, "USD", DIA) == 10000
+
+
+def test_recargar_reemplaza_y_rechaza_filas_invalidas(tmp_path):
+    tabla = tabla_con(tmp_path, [(DIA, "USD", 4000), (DIA, "EUR", 4400)])
+    ruta = tmp_path / "tasas.csv"
+    ruta.write_text(f"fecha,moneda,tasa\n{DIA},USD,4100\n", encoding="utf-8")
+    assert tabla.cargar_csv(str(ruta)) == 1
+    assert tabla.monedas() == ["COP", "USD"] and tabla.tasa("USD", DIA) == 4100
+
+    ruta.write_text(f"fecha,moneda,tasa\n{DIA},USD,4200\n{DIA},EUR,cuatro mil\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="línea 3"):
+        tabla.cargar_csv(str(ruta))
+    assert tabla.tasa("USD", DIA) == 4100
+
+
+def test_comando_recargar_con_un_archivo_mal_formado(tmp_path, monkeypatch):
+    tabla = tabla_con(tmp_path, [(DIA, "USD", 4000)])
+    (tmp_path / "tasas.csv").write_text(f"fecha,moneda,tasa\n{DIA},USD\n", encoding="utf-8")
+    monkeypatch.setattr(bot, "tabla_cambio", tabla)
+    monkeypatch.setattr(bot, "es_admin", lambda user_id: True)
+    update = MagicMock()
+    update.effective_user.id = 4300
+    update.message.reply_text = AsyncMock()
+    contexto = MagicMock()
+    contexto.args = ["recargar"]
+
+    asyncio.run(bot.tasas(update, contexto))
+
+    texto = update.message.reply_text.await_args.args[0]
+    assert texto.startswith("❌") and "línea 2" in texto
+    assert tabla.tasa("USD", DIA) == 4000
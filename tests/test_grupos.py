@@ -0,0 +1,73 @@
+import datetime
+import threading
+
+import pytz
+
+from firestore_memoria import Lote
+from grupos import (
+    NUM_SHARDS, mes_grupo, nuevo_gasto_id, presupuestos_grupo, registrar_gasto_grupo, totales_mes_grupo,
+    guardar_presupuesto_grupo
+)
+
+BOGOTA = pytz.timezone("America/Bogota")
+
+
+def test_incrementos_concurrentes_en_shards(db):
+    hilos, por_hilo = 16, 50
+    fecha = BOGOTA.localize(datetime.datetime(2025, 3, 10, 12))
+    barrera = threading.Barrier(hilos)
+
+    def miembro(n):
+        barrera.wait()
+        for i in range(por_hilo):
+            categoria = "comida" if i % 2 else "ocio"
+            registrar_gasto_grupo(db, "g1", nuevo_gasto_id(db, "g1"), f"u{n}", 100 + n, categoria, fecha)
+
+    trabajadores = [threading.Thread(target=miembro, args=(n,)) for n in range(hilos)]
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+
+    totales = totales_mes_grupo(db, "g1", "2025-03")
+    esperado = sum(100 + n for n in range(hilos)) * por_hilo // 2
+    assert totales == {"comida": esperado, "ocio": esperado}
+    shards = list(db.collection("grupos").document("g1").collection("contadores").document("2025-03")
+                  .collection("shards").stream())
+    assert 1 < len(shards) <= NUM_SHARDS
+    assert sum(s.to_dict()["cantidad"] for s in shards) == hilos * por_hilo
+    assert len(list(db.collection("grupos").document("g1").collection("gastos").stream())) == hilos * por_hilo
+
+
+def test_reintento_de_un_lote_aplicado_no_suma_dos_veces(db, monkeypatch):
+    fecha = BOGOTA.localize(datetime.datetime(2025, 3, 10, 12))
+    commit = Lote.commit
+
+    def aplicado_sin_respuesta(self, *args, **kwargs):
+        commit(self, *args, **kwargs)
+        raise TimeoutError("la respuesta no llegó")
+
+    gasto_id = nuevo_gasto_id(db, "g2")
+    monkeypatch.setattr(Lote, "commit", aplicado_sin_respuesta)
+    try:
+        registrar_gasto_grupo(db, "g2", gasto_id, "u1", 5000, "comida", fecha)
+    except TimeoutError:
+        pass
+    monkeypatch.setattr(Lote, "commit", commit)
+    # Lo que haría Resiliencia: repetir la misma llamada
+    registrar_gasto_grupo(db, "g2", gasto_id, "u1", 5000, "comida", fecha)
+    assert totales_mes_grupo(db, "g2", "2025-03") == {"comida": 5000}
+
+
+def test_mismo_mes_al_escribir_y_al_leer(db):
+    # 31 de enero a las 23:30 en Bogotá ya es 1 de febrero en Tokio
+    instante = BOGOTA.localize(datetime.datetime(2025, 1, 31, 23, 30))
+    en_tokio = instante.astimezone(pytz.timezone("Asia/Tokyo"))
+    registrar_gasto_grupo(db, "g3", nuevo_gasto_id(db, "g3"), "u1", 700, "comida", en_tokio)
+    assert mes_grupo(en_tokio) == mes_grupo(instante) == "2025-01"
+    assert totales_mes_grupo(db, "g3", mes_grupo(instante)) == {"comida": 700}
+
+
+def test_presupuesto_de_grupo(db):
+    guardar_presupuesto_grupo(db, "g4", "comida", 300000, "u1")
+    assert presupuestos_grupo(db, "g4") == {"comida": 300000}
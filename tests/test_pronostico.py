@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytz
+
+import bot
+from cache_gastos import CacheGastos
+
+ACTIVO = "4100"
+INACTIVOS = [str(4101 + i) for i in range(30)]
+
+
+def preparar(user_id, monto):
+    usuario = bot.db.collection("usuarios").document(user_id)
+    usuario.set({"zona_horaria": "America/Bogota"})
+    usuario.collection("presupuestos").document("comida").set({"limite": 1000})
+    fecha = pytz.timezone("America/Bogota").localize(datetime.datetime.now())
+    usuario.collection("gastos").document("p1").set({
+        "monto": monto, "categoria": "comida", "descripcion": "", "fecha": fecha
+    })
+
+
+def test_trabajo_nocturno_no_expulsa_a_los_activos(monkeypatch):
+    # Un cache que solo da para un usuario
+    cache = CacheGastos(bot.cargar_gastos_recientes, limite_bytes=1)
+    monkeypatch.setattr(bot, "cache_gastos", cache)
+    monkeypatch.setattr(bot, "pronosticos", {})
+    monkeypatch.setattr(bot, "avisos_pronostico", {})
+    for user_id in [ACTIVO] + INACTIVOS:
+        preparar(user_id, 900)
+
+    bot.pronostico_usuario(ACTIVO)
+    activo = bot.gastos_recientes(ACTIVO)
+    cargas = cache.cargas
+
+    presupuestos, resultados = bot.calcular_pronosticos_todos()
+
+    assert {ACTIVO, *INACTIVOS} <= set(presupuestos) and set(presupuestos) == set(resultados)
+    # El activo sigue en memoria y los demás se leyeron de paso, sin guardarse
+    assert cache.estadisticas()["usuarios"] == 1 and cache.cargas == cargas
+    assert bot.gastos_recientes_de_paso(ACTIVO) is activo
+    assert cache.lecturas_de_paso >= len(INACTIVOS)
+    # Solo se renueva el pronóstico guardado de quien ya lo tenía
+    assert set(bot.pronosticos) == {ACTIVO}
+
+
+def test_barrido_descarta_pronosticos_y_avisos_viejos(monkeypatch):
+    ayer = datetime.datetime.now(pytz.timezone("America/Bogota")).date() - datetime.timedelta(days=1)
+    hoy = datetime.datetime.now(pytz.timezone("America/Bogota")).date()
+    mes = hoy.strftime("%Y-%m")
+    for user_id in ("4200", "4201"):
+        monkeypatch.setitem(bot.zonas_usuario, user_id, "America/Bogota")
+    monkeypatch.setattr(bot, "pronosticos", {"4200": (ayer, {}), "4201": (hoy, {})})
+    monkeypatch.setattr(bot, "avisos_pronostico", {"4200": ("2001-01", {"comida"}), "4201": (mes, {"ocio"})})
+
+    contexto = MagicMock()
+    contexto.application.user_data = {}
+    contexto.application.chat_data = {}
+    asyncio.run(bot.barrer_estado(contexto))
+
+    assert set(bot.pronosticos) == {"4201"}
+    assert set(bot.avisos_pronostico) == {"4201"}
+    assert bot.reporte_memoria(contexto.application)["avisos_pronostico"] == 1
+
+
+def test_pronosticar_presupuestos_avisa_con_lo_calculado(monkeypatch):
+    monkeypatch.setattr(bot, "pronosticos", {})
+    monkeypatch.setattr(bot, "avisos_pronostico", {})
+    monkeypatch.setattr(bot.canales, "masivo", None)
+    monkeypatch.setattr(bot, "calcular_pronosticos_todos", lambda: (
+        {"4300": {"comida": 1000}}, {"4300": {"comida": (900, 3000, 12)}}
+    ))
+    contexto = MagicMock()
+    contexto.bot.send_message = AsyncMock()
+    asyncio.run(bot.pronosticar_presupuestos(contexto))
+    assert contexto.bot.send_message.await_count == 1
+    # Sin guardar un pronóstico para un usuario que no lo tenía
+    assert bot.pronosticos == {}
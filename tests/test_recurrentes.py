@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytz
+
+import bot
+from indice_diario import IndiceDiario
+from recurrentes import guardar_regla, materializar
+
+BOGOTA, TOKIO, KIRITIMATI, PAGO = "3101", "3102", "3103", "3104"
+ZONAS = {
+    BOGOTA: "America/Bogota",        # UTC-5
+    TOKIO: "Asia/Tokyo",             # UTC+9
+    KIRITIMATI: "Pacific/Kiritimati",  # UTC+14
+    PAGO: "Pacific/Pago_Pago",       # UTC-11
+}
+
+
+def correr(instante):
+    bot_masivo = MagicMock()
+    bot_masivo.send_message = AsyncMock()
+    contexto = MagicMock()
+    contexto.bot = bot_masivo
+    asyncio.run(bot.materializar_recurrentes(contexto, instante=instante))
+    return bot_masivo.send_message
+
+
+def gastos(user_id):
+    return {d.id: d.to_dict() for d in bot.db.collection("usuarios").document(user_id).collection("gastos").stream()}
+
+
+def dias_locales():
+    return {u: sorted(g["fecha"].astimezone(pytz.timezone(ZONAS[u])).day for g in gastos(u).values())
+            for u in ZONAS}
+
+
+def test_vence_en_la_fecha_local_de_cada_dueno(monkeypatch):
+    monkeypatch.setattr(bot.canales, "masivo", None)
+    for user_id, zona in ZONAS.items():
+        bot.db.collection("usuarios").document(user_id).set({"zona_horaria": zona})
+        bot.zonas_usuario.pop(user_id, None)
+        for dia in (14, 15, 16):
+            guardar_regla(bot.db, user_id, 1000 * dia, "servicios", dia, f"dia {dia}")
+
+    # 07:00 en Bogotá del 15 de marzo: 21:00 del 15 en Tokio, 02:00 del 16 en
+    # Kiritimati y 01:00 del 15 en Pago Pago
+    instante = pytz.utc.localize(datetime.datetime(2025, 3, 15, 12))
+    enviados = correr(instante)
+
+    assert dias_locales() == {BOGOTA: [15], TOKIO: [15], KIRITIMATI: [16], PAGO: [15]}
+    # Una notificación por usuario
+    assert sorted(c.kwargs["chat_id"] for c in enviados.call_args_list) == sorted(int(u) for u in ZONAS)
+
+    # Un día después cada uno avanza exactamente una fecha local, sin repetir
+    correr(instante + datetime.timedelta(days=1))
+    assert dias_locales() == {BOGOTA: [15, 16], TOKIO: [15, 16], KIRITIMATI: [16], PAGO: [15, 16]}
+
+    # Repetir la misma corrida no duplica nada
+    correr(instante + datetime.timedelta(days=1))
+    assert sum(len(gastos(u)) for u in ZONAS) == 7
+
+
+# --- Corridas concurrentes e índice diario ---
+
+def indice_en(db):
+    tz = pytz.timezone("America/Bogota")
+    lector = lambda user_id, desde, hasta: [
+        d.to_dict() for d in db.collection("usuarios").document(user_id).collection("gastos").stream()
+    ]
+    return IndiceDiario(db, lector, lambda user_id: tz)
+
+
+def test_dos_corridas_a_la_vez_no_suman_dos_veces(db, monkeypatch):
+    indice = indice_en(db)
+    for user_id in ("5101", "5102"):
+        guardar_regla(db, user_id, 1000, "servicios", 15, "internet")
+    reglas = list(db.collection("recurrentes").stream())
+    fecha = pytz.timezone("America/Bogota").localize(datetime.datetime(2025, 3, 15, 7))
+
+    # Las dos réplicas leen antes de que alguna escriba: ninguna ve gastos existentes
+    monkeypatch.setattr(db, "get_all", lambda refs: [])
+    primera = materializar(db, reglas[:1], fecha, indice)
+    segunda = materializar(db, reglas, fecha, indice)
+
+    assert len(primera) == 1 and [c[0] for c in segunda] == [reglas[1].get("u")]
+    indice.invalidar("5101")
+    indice.invalidar("5102")
+    desde, hasta = datetime.date(2025, 3, 1), datetime.date(2025, 4, 1)
+    assert indice.total("5101", desde, hasta) == 1000
+    assert indice.total("5102", desde, hasta) == 1000
+
+
+def test_reconstruccion_no_pisa_un_incremento_concurrente(db):
+    indice = indice_en(db)
+    fecha = pytz.timezone("America/Bogota").localize(datetime.datetime(2025, 3, 15, 7))
+    gastos_ref = db.collection("usuarios").document("5201").collection("gastos")
+    gastos_ref.document("viejo").set({"monto": 100, "categoria": "comida", "fecha": fecha})
+    # Documento de antes del índice: sin `completo`
+    indice.ref("5201", 2025).set({"dias": {"comida": {"1": 7}}})
+
+    lector = indice.lector
+    nuevos = ["nuevo"]
+
+    def lector_con_gasto_en_medio(user_id, desde, hasta):
+        leidos = lector(user_id, desde, hasta)
+        if nuevos:
+            # Llega un gasto después de recorrer y antes de escribir la reconstrucción
+            lote = db.batch()
+            lote.set(gastos_ref.document(nuevos.pop()), {"monto": 50, "categoria": "comida", "fecha": fecha})
+            indice.registrar(lote, "5201", "comida", fecha, 50)
+            lote.commit()
+        return leidos
+
+    indice.lector = lector_con_gasto_en_medio
+    assert indice.total("5201", datetime.date(2025, 1, 1), datetime.date(2026, 1, 1)) == 150
+    assert indice.ref("5201", 2025).get().to_dict() == {"dias": {"comida": {"74": 150}}, "completo": True}
@@ -0,0 +1,208 @@
+import asyncio
+import datetime
+import threading
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import pytz
+from google.api_core.exceptions import ServiceUnavailable
+
+import bot
+from recurrentes import guardar_regla, reglas_usuario
+from resiliencia import Resiliencia, AlmacenNoDisponible
+
+
+def caido(operacion):
+    raise ServiceUnavailable(f"fallo inyectado en {operacion}")
+
+
+# --- Resiliencia ---
+
+def test_reintenta_errores_transitorios():
+    r = Resiliencia(plazo=1, reintentos=3, espera_base=0.001)
+    fallos = [ServiceUnavailable("uno"), ServiceUnavailable("dos")]
+
+    def leer():
+        if fallos:
+            raise fallos.pop()
+        return 7
+
+    assert asyncio.run(r.llamar("leer", leer)) == 7
+    assert r.operaciones["leer"]["reintentos"] == 2
+    r.cerrar()
+
+
+def test_no_idempotente_no_se_reintenta():
+    r = Resiliencia(plazo=1, reintentos=3, espera_base=0.001)
+    intentos = []
+
+    def escribir():
+        intentos.append(1)
+        raise ServiceUnavailable("caído")
+
+    with pytest.raises(AlmacenNoDisponible):
+        asyncio.run(r.llamar("escribir", escribir, idempotente=False))
+    assert len(intentos) == 1
+    r.cerrar()
+
+
+def test_circuito_abierto_responde_con_respaldo():
+    r = Resiliencia(plazo=1, reintentos=0, umbral_fallos=3, enfriamiento=60)
+    llamadas = []
+
+    async def escenario():
+        assert await r.leer_con_respaldo("k", "total", lambda: 5) == (5, None)
+        r.inyector = caido
+        for _ in range(3):
+            valor, antiguedad = await r.leer_con_respaldo("k", "total", lambda: 6)
+            assert valor == 5 and antiguedad is not None
+        assert r.interruptor.estado == "abierto"
+        # Con el circuito abierto la llamada ni siquiera sale
+        r.inyector = None
+        with pytest.raises(AlmacenNoDisponible):
+            await r.llamar("otra", lambda: llamadas.append(1))
+
+    asyncio.run(escenario())
+    assert not llamadas
+    r.cerrar()
+
+
+def test_prueba_cancelada_no_traba_el_circuito():
+    r = Resiliencia(plazo=5, reintentos=0, umbral_fallos=1, enfriamiento=0.05)
+    soltar = threading.Event()
+
+    async def escenario():
+        r.inyector = caido
+        with pytest.raises(AlmacenNoDisponible):
+            await r.llamar("leer", lambda: 1)
+        r.inyector = None
+        await asyncio.sleep(0.06)
+
+        # La llamada de prueba del semiabierto se cancela (update abandonado)
+        prueba = asyncio.create_task(r.llamar("leer", soltar.wait, 1))
+        await asyncio.sleep(0.01)
+        assert r.interruptor.estado == "semiabierto"
+        prueba.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await prueba
+        soltar.set()
+
+        assert await r.llamar("leer", lambda: 2) == 2
+        assert r.interruptor.estado == "cerrado"
+
+    asyncio.run(escenario())
+    r.cerrar()
+
+
+# --- Handlers: nada de Firestore en el event loop ---
+
+ZONA = "Asia/Tokyo"
+
+
+@pytest.fixture
+def almacen(monkeypatch):
+    # Hilo de cada llamada al almacén; una resiliencia propia para no abrir
+    # el interruptor compartido con las otras pruebas
+    monkeypatch.setattr(bot, "resiliencia", Resiliencia(plazo=2, reintentos=0, umbral_fallos=1000))
+    hilos = []
+    llamada = bot.db._llamada
+
+    def registrar():
+        hilos.append(threading.current_thread().name)
+        llamada()
+
+    monkeypatch.setattr(bot.db, "_llamada", registrar)
+    yield hilos
+    bot.resiliencia.cerrar()
+
+
+def preparar(user_id):
+    usuario = bot.db.collection("usuarios").document(user_id)
+    usuario.set({"zona_horaria": ZONA})
+    bot.zonas_usuario.pop(user_id, None)
+    usuario.collection("presupuestos").document("comida").set({"limite": 1000})
+    fecha = pytz.timezone(ZONA).localize(datetime.datetime.now())
+    usuario.collection("gastos").document("g1").set({
+        "monto": 5000, "categoria": "comida", "descripcion": "almuerzo",
+        "tokens": ["almuerzo"], "fecha": fecha
+    })
+    guardar_regla(bot.db, user_id, 1000, "servicios", 5, "internet")
+
+
+def update_de(user_id, datos="", args=()):
+    update = MagicMock()
+    update.effective_user.id = int(user_id)
+    update.message.reply_text = AsyncMock()
+    update.message.reply_photo = AsyncMock()
+    update.inline_query.query = ""
+    update.inline_query.from_user.id = int(user_id)
+    update.inline_query.answer = AsyncMock()
+    query = update.callback_query
+    query.from_user.id = int(user_id)
+    query.data = datos
+    query.answer = AsyncMock()
+    query.edit_message_text = AsyncMock()
+    query.message.reply_text = AsyncMock()
+    contexto = MagicMock()
+    contexto.args = list(args)
+    contexto.user_data = {}
+    contexto.chat_data = {}
+    return update, contexto
+
+
+def regla_de(user_id):
+    return reglas_usuario(bot.db, user_id)[0][0]
+
+
+HANDLERS = {
+    "verificar_presupuesto": lambda u, c, uid: bot.verificar_presupuesto(u, uid, "comida"),
+    "guardar_presupuesto": lambda u, c, uid: bot.guardar_presupuesto(uid, "ocio", 20000, u),
+    "consulta_presupuesto": lambda u, c, uid: bot.consulta_presupuesto(u, c),
+    "cambiar_categoria_gasto": lambda u, c, uid: bot.cambiar_categoria_gasto(u, c),
+    "consulta_inline": lambda u, c, uid: bot.consulta_inline(u, c),
+    "recurrente": lambda u, c, uid: bot.recurrente(u, c),
+    "borrar_recurrente": lambda u, c, uid: bot.borrar_recurrente(u, c),
+    "grafico": lambda u, c, uid: bot.grafico.__wrapped__(u, c),
+    "grafico_tendencia": lambda u, c, uid: bot.grafico_tendencia(u, uid),
+    "buscar": lambda u, c, uid: bot.buscar(u, c),
+}
+DATOS = {"cambiar_categoria_gasto": "cambiar_cat:g1", "borrar_recurrente": "rec_borrar:{regla}"}
+ARGS = {"buscar": ["almuerzo"]}
+
+
+@pytest.mark.parametrize("nombre", sorted(HANDLERS))
+def test_handlers_leen_fuera_del_event_loop(almacen, nombre):
+    user_id = str(3900 + sorted(HANDLERS).index(nombre))
+    preparar(user_id)
+    datos = DATOS.get(nombre, "").format(regla=regla_de(user_id))
+    update, contexto = update_de(user_id, datos, ARGS.get(nombre, ()))
+
+    async def atender():
+        await bot.precargar_zona(update, contexto)
+        await HANDLERS[nombre](update, contexto, user_id)
+
+    almacen.clear()
+    asyncio.run(atender())
+    assert almacen, "el handler no tocó el almacén"
+    assert threading.main_thread().name not in almacen
+    assert bot.zonas_usuario[user_id] == ZONA
+
+
+@pytest.mark.parametrize("nombre", sorted(HANDLERS))
+def test_handlers_con_el_almacen_caido(almacen, monkeypatch, nombre):
+    user_id = str(3950 + sorted(HANDLERS).index(nombre))
+    preparar(user_id)
+    datos = DATOS.get(nombre, "").format(regla=regla_de(user_id))
+    update, contexto = update_de(user_id, datos, ARGS.get(nombre, ()))
+    monkeypatch.setattr(bot.db, "fallo", ServiceUnavailable("caído"))
+
+    async def atender():
+        # Sin la zona se sigue con la por defecto, sin guardarla
+        await bot.precargar_zona(update, contexto)
+        assert bot.zona_usuario(user_id).zone == bot.ZONA_POR_DEFECTO
+        await HANDLERS[nombre](update, contexto, user_id)
+
+    # Lo atrapa manejar_error con un aviso al usuario, no un error suelto del cliente
+    with pytest.raises(AlmacenNoDisponible):
+        asyncio.run(atender())
+    assert user_id not in bot.zonas_usuario
@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import pytz
+
+import bot
+import respuestas
+
+ZONA = "America/Bogota"
+
+
+def preparar(user_id):
+    usuario = bot.db.collection("usuarios").document(user_id)
+    usuario.set({"zona_horaria": ZONA})
+    usuario.collection("presupuestos").document("comida").set({"limite": 1000})
+    fecha = pytz.timezone(ZONA).localize(datetime.datetime.now())
+    usuario.collection("gastos").document("g1").set({
+        "monto": 500, "categoria": "comida", "descripcion": "almuerzo", "fecha": fecha
+    })
+
+
+def update_de(user_id, texto=None, datos=None):
+    update = MagicMock()
+    update.effective_user.id = int(user_id)
+    update.message = None
+    update.callback_query = None
+    if texto is not None:
+        update.message = MagicMock()
+        update.message.text = texto
+        update.message.reply_text = AsyncMock()
+    else:
+        query = update.callback_query = MagicMock()
+        query.from_user.id = int(user_id)
+        query.data = datos
+        query.answer = AsyncMock()
+        query.edit_message_text = AsyncMock()
+        query.message.reply_text = AsyncMock()
+    contexto = MagicMock()
+    contexto.user_data = {"categoria_presupuesto": "comida", "nuevo_limite": 2000}
+    contexto.chat_data = {}
+    return update, contexto
+
+
+def llamadas(update):
+    if update.message is not None:
+        return update.message.reply_text.await_count
+    query = update.callback_query
+    return query.edit_message_text.await_count + query.message.reply_text.await_count
+
+
+# handler, texto del mensaje, datos del botón, llamadas a la Bot API al vaciar
+CASOS = {
+    "presupuesto": (bot.presupuesto, "/presupuesto", None, 1),
+    "especificar_limite_no_numerico": (bot.especificar_limite, "abc", None, 1),
+    "especificar_limite_ya_existe": (bot.especificar_limite, "2000", None, 1),
+    "especificar_limite_menor_a_lo_gastado": (bot.especificar_limite, "100", None, 1),
+    "confirmar_reemplazo": (bot.confirmar_reemplazo, None, "confirmar_reemplazo", 1),
+    "consulta_presupuesto": (bot.consulta_presupuesto, "/consulta", None, 1),
+    "cambiar_categoria_gasto": (bot.cambiar_categoria_gasto, None, "cambiar_cat:g1", 1),
+    "handle_message_teclado_de_categorias": (bot.handle_message, "5000 xqzw", None, 1),
+    "handle_message_formato_invalido": (bot.handle_message, "xqzw", None, 1),
+    "categoria_personalizada_presupuesto": (bot.seleccionar_categoria_presupuesto, None, "catref:personalizada", 1),
+    "escoger_categoria": (bot.escoger_categoria, None, "cat:comida", 1),
+    "guardar_categoria_personalizada": (bot.guardar_categoria_personalizada_presupuesto, "ocio", None, 1),
+    "reintentar_limite": (bot.reintentar_especificar_limite, None, "reintentar_limite", 1),
+    "cancelar_reemplazo": (bot.cancelar_reemplazo, None, "cancelar_reemplazo", 1),
+    # Edita el mensaje del botón y manda las categorías: una sola edición
+    "otro_presupuesto": (bot.manejar_accion_post_presupuesto, None, "otro_presupuesto", 1),
+    "salir": (bot.manejar_accion_post_presupuesto, None, "salir", 1),
+    "cancelar_presupuesto": (bot.cancelar_presupuesto, None, "cancelar_presupuesto", 1),
+    "responder_consulta_presupuesto": (bot.responder_consulta_presupuesto, None, "consulta_categoria:comida", 1),
+    "menu_desconocido": (bot.manejar_menu_inline, None, "menu:xyz", 1),
+    "busqueda_expirada": (bot.paginar_busqueda, None, "bus:k:1:2", 1),
+    "borrar_recurrente": (bot.borrar_recurrente, None, "rec_borrar:r1", 1),
+    "iniciar_establecer_presupuesto": (bot.iniciar_establecer_presupuesto, None, "establecer_presupuesto:comida", 1),
+    "ignorar_presupuesto": (bot.ignorar_presupuesto, None, "ignorar_presupuesto", 1),
+    "historial_expirado": (bot.callback_historial, None, "his:p", 1),
+}
+
+
+@pytest.mark.parametrize("nombre", sorted(CASOS))
+def test_respuestas_salen_en_el_lote_del_update(nombre):
+    handler, texto, datos, esperadas = CASOS[nombre]
+    user_id = str(4400 + sorted(CASOS).index(nombre))
+    preparar(user_id)
+    update, contexto = update_de(user_id, texto, datos)
+
+    async def atender():
+        await respuestas.iniciar_update(update, contexto)
+        await handler(update, contexto)
+        # Nada sale mientras el handler corre
+        assert llamadas(update) == 0
+        await respuestas.vaciar(update, contexto)
+
+    asyncio.run(atender())
+    assert llamadas(update) == esperadas